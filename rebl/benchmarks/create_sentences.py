@@ -0,0 +1,49 @@
+import argparse
+import json
+import tempfile
+import time
+from os import path
+
+from ..md.sentence_creation import SentenceCreator
+from ..utils import input_stream_gen_lines
+
+_sample = path.dirname(path.dirname(__file__)) + '/tests/resources/md/sample_docs_first_hunderd/msmarco_doc_00.gz'
+
+
+def offsets(sentences):
+    return [[(token.text, token.start_pos, token.end_pos) for token in sentence] for sentence in sentences]
+
+
+def run(create, texts):
+    t = time.time()
+    results = [offsets(create(text, identifier)) for identifier, text in texts]
+    return results, time.time() - t
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-i',
+        '--in_file',
+        help='JSONL file with documents, default is the bundled msmarco_doc_00 sample',
+        default=_sample
+    )
+    parser.add_argument(
+        '-f',
+        '--fields',
+        nargs='*',
+        help='Fields to create sentences for',
+        default=['title', 'headings', 'body']
+    )
+    args = parser.parse_args()
+    texts = []
+    for line in input_stream_gen_lines(args.in_file):
+        document = json.loads(line)
+        texts += [(document['docid'], document[field]) for field in args.fields]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        sentence_creator = SentenceCreator({'fields': args.fields, 'out_file': tmp_dir + '/benchmark.parquet'})
+        reference, reference_time = run(sentence_creator.create_sentences_with_removed_chars, texts)
+        fast, fast_time = run(sentence_creator.create_sentences, texts)
+    assert reference == fast, 'Fast path creates different sentences'
+    print(f'Texts: {len(texts)}; Per token correction: {reference_time:.2f}s; Fast path: {fast_time:.2f}s; '
+          f'Speedup: {reference_time / fast_time:.2f}x', flush=True)
@@ -0,0 +1,57 @@
+import argparse
+import gzip
+import random
+import tempfile
+import time
+from os import path
+
+from ..utils.gzip_index import GzipIndex, IndexedGzipReader
+
+_sample = path.dirname(path.dirname(__file__)) + '/tests/resources/md/sample_docs_first_hunderd/msmarco_doc_00.gz'
+
+
+def read_lines(source, offsets):
+    t = time.time()
+    lines = []
+    for offset in offsets:
+        source.seek(offset)
+        lines.append(source.readline())
+    return lines, time.time() - t
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-r',
+        '--repeat',
+        help='Number of copies of the bundled msmarco_doc_00 sample in the gzip file',
+        default='50'
+    )
+    parser.add_argument(
+        '-d',
+        '--documents',
+        help='Number of documents to read, in random order',
+        default='100'
+    )
+    args = parser.parse_args()
+    with gzip.open(_sample, 'rb') as f:
+        data = f.read() * int(args.repeat)
+    offsets, offset = [], 0
+    for line in data.splitlines(keepends=True):
+        offsets.append(offset)
+        offset += len(line)
+    offsets = random.Random(0).sample(offsets, int(args.documents))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        source_file = tmp_dir + '/msmarco_doc_00.gz'
+        with open(source_file, 'wb') as f:
+            f.write(gzip.compress(data))
+        t = time.time()
+        index = GzipIndex.load_or_build(source_file)
+        build_time = time.time() - t
+        with gzip.open(source_file, 'rb') as source:
+            reference, reference_time = read_lines(source, offsets)
+        with IndexedGzipReader(source_file) as source:
+            indexed, indexed_time = read_lines(source, offsets)
+    assert reference == indexed, 'Indexed reads give different documents'
+    print(f'Uncompressed: {len(data) >> 20} MiB; Documents: {len(offsets)}; gzip seek: {reference_time:.2f}s; '
+          f'Index build: {build_time:.2f}s ({len(index)} checkpoints); Indexed: {indexed_time:.2f}s', flush=True)
@@ -0,0 +1,68 @@
+import argparse
+import tempfile
+import time
+from os import path
+
+import pyarrow.parquet as pq
+
+from ..ed import EntityDisambiguation
+from ..md import MentionDetection
+from ..pipeline import FusedPipeline
+
+_resources = path.dirname(path.dirname(__file__)) + '/tests/resources/'
+_source = _resources + 'md/hard_examples_with_expected_output/example_docs_20.txt.gz'
+
+
+def two_stages(in_file, out_file, md_file, fields, base_url, wiki_version):
+    # Model loading is included, the fused pipeline loads both models as well
+    t = time.time()
+    MentionDetection(in_file=in_file, out_file=md_file, fields=fields, cont=False).write_batches_to_parquet()
+    EntityDisambiguation(md_file=md_file, fields=fields, source_file=in_file, out_file=out_file, base_url=base_url,
+                         wiki_version=wiki_version, cont=False).process()
+    return time.time() - t
+
+
+def fused(in_file, out_file, fields, base_url, wiki_version):
+    t = time.time()
+    FusedPipeline(in_file=in_file, out_file=out_file, fields=fields, base_url=base_url,
+                  wiki_version=wiki_version).process()
+    return time.time() - t
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-i',
+        '--in_file',
+        help='JSONL file to tag, default is the bundled example_docs_20',
+        default=_source
+    )
+    parser.add_argument(
+        '-f',
+        '--fields',
+        nargs='*',
+        help='Fields to tag',
+        default=['title', 'headings', 'body']
+    )
+    parser.add_argument(
+        '-b',
+        '--base_url',
+        help='Location of base_url for REL ED model, default is the bundled test model',
+        default=_resources + 'ed/'
+    )
+    parser.add_argument(
+        '-w',
+        '--wiki_version',
+        help='Wikipedia version to use',
+        default='wiki_test'
+    )
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        two_stage_time = two_stages(args.in_file, tmp_dir + '/ed.parquet', tmp_dir + '/md.parquet', args.fields,
+                                    args.base_url, args.wiki_version)
+        print(f'Two stages: {two_stage_time:.2f} seconds', flush=True)
+        fused_time = fused(args.in_file, tmp_dir + '/fused.parquet', args.fields, args.base_url, args.wiki_version)
+        print(f'Fused: {fused_time:.2f} seconds', flush=True)
+        two_stage_output = pq.read_table(tmp_dir + '/ed.parquet').to_pydict()
+        assert two_stage_output == pq.read_table(tmp_dir + '/fused.parquet').to_pydict(), \
+            'Fused output differs from the two stage output'
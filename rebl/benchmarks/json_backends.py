@@ -0,0 +1,49 @@
+import argparse
+import time
+from os import path
+
+from ..utils import input_stream_gen_lines
+from ..utils.json_codec import JsonCodec, available_backends
+
+_sample = path.dirname(path.dirname(__file__)) + '/tests/resources/md/sample_docs_first_hunderd/msmarco_doc_00.gz'
+
+
+def docs_per_second(function, items, repeat):
+    t = time.time()
+    for _ in range(repeat):
+        for item in items:
+            function(item)
+    return repeat * len(items) / (time.time() - t)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-i',
+        '--in_file',
+        help='JSONL file with documents, default is the bundled msmarco_doc_00 sample',
+        default=_sample
+    )
+    parser.add_argument(
+        '-id',
+        '--identifier',
+        help='Identifier key of the documents',
+        default='docid'
+    )
+    parser.add_argument(
+        '-r',
+        '--repeat',
+        help='Number of passes over the documents per measurement',
+        default='20'
+    )
+    args = parser.parse_args()
+    lines = list(input_stream_gen_lines(args.in_file))
+    documents = [JsonCodec('json').loads(line) for line in lines]
+    for backend in available_backends():
+        codec = JsonCodec(backend)
+        loads = docs_per_second(codec.loads, lines, int(args.repeat))
+        identifiers = docs_per_second(lambda line: codec.identifier(line, args.identifier), lines, int(args.repeat))
+        dumps = docs_per_second(codec.dumps, documents, int(args.repeat))
+        compact = docs_per_second(lambda document: codec.dumps(document, compact=True), documents, int(args.repeat))
+        print(f'{backend}: loads {loads:.0f} docs/s; identifier only {identifiers:.0f} docs/s; '
+              f'dumps {dumps:.0f} docs/s; compact dumps {compact:.0f} docs/s', flush=True)
@@ -0,0 +1,58 @@
+import argparse
+import tempfile
+import time
+from os import path
+
+from ..md import MentionDetection
+
+_sample = path.dirname(path.dirname(__file__)) + '/tests/resources/md/sample_docs_first_hunderd/msmarco_doc_00.gz'
+
+
+def sentences_per_second(md):
+    sentences = 0
+    t = time.time()
+    for batch, _, __, ___ in md.mention_detect_sentence_batch_gen():
+        sentences += len(batch)
+    return sentences, sentences / (time.time() - t)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-i',
+        '--in_file',
+        help='JSONL file to tag, default is the bundled msmarco_doc_00 sample',
+        default=_sample
+    )
+    parser.add_argument(
+        '-t',
+        '--tagger',
+        help='Tagger that is used, default is ner-fast',
+        default='ner-fast'
+    )
+    parser.add_argument(
+        '-pb',
+        '--predict_batch_size',
+        help='Sentences per batch for count batching',
+        default='100'
+    )
+    parser.add_argument(
+        '-tb',
+        '--token_budget',
+        help='Tokens per batch for token batching',
+        default='5000'
+    )
+    parser.add_argument(
+        '-bw',
+        '--bucket_window',
+        help='Number of sentences bucketed by length for token batching',
+        default='2000'
+    )
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for batching in ['count', 'tokens']:
+            md = MentionDetection(in_file=args.in_file, out_file=tmp_dir + '/benchmark.parquet', tagger=args.tagger,
+                                  predict_batch_size=args.predict_batch_size, token_budget=args.token_budget,
+                                  bucket_window=args.bucket_window, batching=batching)
+            n, speed = sentences_per_second(md)
+            print(f'Batching: {batching}; Sentences: {n}; Sentences/s: {speed:.2f}', flush=True)
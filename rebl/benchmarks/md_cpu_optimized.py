@@ -0,0 +1,60 @@
+import argparse
+import tempfile
+import time
+from os import path
+
+import pyarrow.parquet as pq
+import torch
+
+from ..md import MentionDetection
+from ..md.cpu_inference import flair_device, set_threads
+
+_resources = path.dirname(path.dirname(__file__)) + '/tests/resources/md/hard_examples_with_expected_output/'
+_fixtures = ['example_docs_2.txt.gz', 'example_docs_20.txt.gz']
+
+
+def mentions(out_file):
+    table = pq.read_table(out_file, columns=['identifier', 'field', 'start_pos', 'end_pos', 'tag']).to_pydict()
+    return set(zip(*table.values()))
+
+
+def tag(in_file, out_file, **kwargs):
+    # The reference run is also loaded and tagged on cpu, so only quantization and inference mode are compared
+    with flair_device(torch.device('cpu')):
+        md = MentionDetection(in_file=in_file, out_file=out_file, cont=False, **kwargs)
+        t = time.time()
+        md.write_batches_to_parquet()
+        return time.time() - t
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-t',
+        '--tagger',
+        help='Tagger that is used, default is ner-fast',
+        default='ner-fast'
+    )
+    parser.add_argument(
+        '-it',
+        '--intra_op_threads',
+        help='Number of intra-op torch threads for both runs',
+        default=None
+    )
+    args = parser.parse_args()
+    set_threads(args.intra_op_threads, 1)  # The thread settings of the optimized run, for both runs
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for fixture in _fixtures:
+            in_file = _resources + fixture
+            reference_time = tag(in_file, tmp_dir + '/reference.parquet', tagger=args.tagger)
+            optimized_time = tag(in_file, tmp_dir + '/optimized.parquet', tagger=args.tagger, cpu_optimized=True,
+                                 intra_op_threads=args.intra_op_threads)
+            reference = mentions(tmp_dir + '/reference.parquet')
+            optimized = mentions(tmp_dir + '/optimized.parquet')
+            correct = len(reference & optimized)
+            precision = correct / len(optimized) if optimized else 1.
+            recall = correct / len(reference) if reference else 1.
+            print(f'{fixture}; Mentions: {len(reference)} reference, {len(optimized)} optimized; '
+                  f'Precision: {precision:.4f}; Recall: {recall:.4f}; '
+                  f'Time: {reference_time:.2f}s reference, {optimized_time:.2f}s optimized; '
+                  f'Speedup: {reference_time / optimized_time:.2f}x', flush=True)
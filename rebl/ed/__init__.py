@@ -1,3 +1,4 @@
 from .entity_disambiguation import EntityDisambiguation
+from .parallel_entity_disambiguation import ParallelEntityDisambiguation
 
-__all__ = ['EntityDisambiguation']
+__all__ = ['EntityDisambiguation', 'ParallelEntityDisambiguation']
@@ -0,0 +1,76 @@
+import json
+import os
+from collections import OrderedDict
+
+from REL.mention_detection import MentionDetection
+
+
+def _uncached(function):
+    # REL may wrap the lookups in an unbounded functools.lru_cache, the bounded cache below replaces it
+    return getattr(function, '__wrapped__', function)
+
+
+class CandidateCache:
+
+    def __init__(self, max_size, cache_file=None):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.counters = {'hits': 0, 'misses': 0}
+        if cache_file is not None and os.path.isfile(cache_file):  # Warm cache written by an earlier run or shard
+            self.load(cache_file)
+
+    def get(self, key):
+        if key in self.entries:
+            self.counters['hits'] += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        self.counters['misses'] += 1
+        return None
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def load(self, cache_file):
+        with open(cache_file, 'r') as f:
+            for line in f:
+                kind, key, value = json.loads(line)
+                self.put((kind, key), value)
+
+    def save(self, cache_file):
+        # Least recently used first, so loading keeps the same order. Written next to the file and moved in place.
+        with open(cache_file + '.tmp', 'w') as f:
+            for (kind, key), value in self.entries.items():
+                f.write(json.dumps([kind, key, value]) + '\n')
+        os.replace(cache_file + '.tmp', cache_file)
+
+    def report(self):
+        lookups = sum(self.counters.values())
+        hit_rate = self.counters['hits'] / lookups if lookups else 0.
+        counters = '; '.join(f'{key}: {value}' for key, value in self.counters.items())
+        return f'{counters}; entries: {len(self.entries)}; hit rate: {hit_rate:.4f}'
+
+
+class CachedMentionDetection(MentionDetection):
+    # REL candidate selection with the normalized mention of every surface form, and the candidates with their
+    # p(e|m) of every normalized mention, kept in a CandidateCache
+
+    def __init__(self, base_url, wiki_version, cache):
+        super().__init__(base_url, wiki_version)
+        self.cache = cache
+
+    def preprocess_mention(self, m):
+        normalized = self.cache.get(('mention', m))
+        if normalized is None:
+            normalized = _uncached(MentionDetection.preprocess_mention)(self, m)
+            self.cache.put(('mention', m), normalized)
+        return normalized
+
+    def get_candidates(self, mention):
+        candidates = self.cache.get(('candidates', mention))
+        if candidates is None:
+            candidates = _uncached(MentionDetection.get_candidates)(self, mention)
+            self.cache.put(('candidates', mention), candidates)
+        return candidates
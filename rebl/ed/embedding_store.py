@@ -0,0 +1,128 @@
+import argparse
+import hashlib
+import os
+import sqlite3
+
+import numpy as np
+
+from ..utils.sidecar_index import building_dir, file_state, hash_positions, load_arrays, read_meta
+
+_ARRAYS = ['matrix', 'hashes', 'rows', 'keys', 'key_offsets']
+
+
+def key_hash(word):
+    return int.from_bytes(hashlib.blake2b(word.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def store_dir(db_file):
+    return db_file[:-3] + '_mmap'
+
+
+def export_embeddings(db_file, out_dir=None, table_name='embeddings', batch_size=100000):
+    # One pass over the sqlite table: the embeddings go to a float32 matrix in table order, the words to one byte
+    # array with offsets, and a sorted array of 64 bit word hashes points to the matrix rows.
+    out_dir = out_dir or store_dir(db_file)
+    db = sqlite3.connect(db_file)
+    rows, key_bytes = db.execute(f'SELECT count(*), total(length(CAST(word AS BLOB))) FROM {table_name}').fetchone()
+    first = db.execute(f'SELECT emb FROM {table_name} LIMIT 1').fetchone()
+    dimensions = len(first[0]) // 4 if first is not None else 0
+    with building_dir(out_dir, file_state(db_file), table_name=table_name, rows=rows, dimensions=dimensions) \
+            as tmp_dir:
+        matrix = np.lib.format.open_memmap(os.path.join(tmp_dir, 'matrix.npy'), mode='w+', dtype=np.float32,
+                                           shape=(rows, dimensions))
+        keys = np.lib.format.open_memmap(os.path.join(tmp_dir, 'keys.npy'), mode='w+', dtype=np.uint8,
+                                         shape=(int(key_bytes),))
+        hashes = np.empty(rows, dtype=np.uint64)
+        key_offsets = np.zeros(rows + 1, dtype=np.int64)
+        cursor = db.execute(f'SELECT word, emb FROM {table_name}')
+        row = 0
+        while True:
+            batch = cursor.fetchmany(batch_size)
+            if not batch:
+                break
+            for word, emb in batch:
+                matrix[row] = np.frombuffer(emb, dtype=np.float32)
+                encoded = word.encode('utf-8')
+                hashes[row] = key_hash(word)
+                key_offsets[row + 1] = key_offsets[row] + len(encoded)
+                keys[key_offsets[row]:key_offsets[row + 1]] = np.frombuffer(encoded, dtype=np.uint8)
+                row += 1
+            print(f'Exported {row} of {rows} embeddings', flush=True)
+        db.close()
+        matrix.flush()
+        keys.flush()
+        del matrix, keys
+        order = np.argsort(hashes, kind='stable')
+        np.save(os.path.join(tmp_dir, 'hashes.npy'), hashes[order])
+        np.save(os.path.join(tmp_dir, 'rows.npy'), order.astype(np.int64))
+        np.save(os.path.join(tmp_dir, 'key_offsets.npy'), key_offsets)
+    return out_dir
+
+
+class MappedEmbeddings:
+    # Read only, memory mapped replacement of the embedding lookups of REL's GenericLookup. All processes on a host
+    # that map the same files share them through the page cache.
+
+    def __init__(self, matrix, hashes, rows, keys, key_offsets):
+        self.matrix = matrix
+        self.hashes = hashes
+        self.rows = rows
+        self.keys = keys
+        self.key_offsets = key_offsets
+
+    @classmethod
+    def load(cls, db_file, out_dir=None):
+        out_dir = out_dir or store_dir(db_file)
+        if read_meta(out_dir, file_state(db_file)) is None:
+            raise IOError(f'No export of the current {db_file} in {out_dir}, run python -m rebl.ed.embedding_store')
+        return cls(*load_arrays(out_dir, _ARRAYS))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def key(self, row):
+        return self.keys[self.key_offsets[row]:self.key_offsets[row + 1]].tobytes().decode('utf-8')
+
+    def lookup_rows(self, words):
+        # Matrix row of every word, -1 for words without an embedding
+        hashes = np.fromiter((key_hash(word) for word in words), dtype=np.uint64, count=len(words))
+        positions = hash_positions(self.hashes, hashes, words, lambda position: self.key(int(self.rows[position])))
+        result = np.full(len(words), -1, dtype=np.int64)
+        found = positions >= 0
+        result[found] = self.rows[positions[found]]
+        return result
+
+    def emb(self, words, table_name='embeddings'):
+        # Same result as GenericLookup.emb: a float32 vector per word, None if there is no embedding
+        words = list(words)
+        rows = self.lookup_rows(words)
+        found = np.flatnonzero(rows >= 0)
+        vectors = self.matrix[rows[found]]  # One gather for all words
+        result = [None] * len(words)
+        for i, vector in zip(found.tolist(), vectors):
+            result[i] = vector
+        return result
+
+
+def embedding_db_files(base_url, wiki_version):
+    return [os.path.join(base_url, 'generic', 'common_drawl.db'),
+            os.path.join(base_url, wiki_version, 'generated', 'entity_word_embedding.db')]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-b',
+        '--base_url',
+        required=True,
+        help='Location of base_url for REL ED model'
+    )
+    parser.add_argument(
+        '-w',
+        '--wiki_version',
+        required=True,
+        help='Wikipedia version to use'
+    )
+    args = parser.parse_args()
+    for db_file in embedding_db_files(args.base_url, args.wiki_version):
+        print(f'Exporting {db_file} to {export_embeddings(db_file)}', flush=True)
@@ -1,16 +1,20 @@
 import argparse
-import gzip
-import json
+import os
 import time
 
 import pandas as pd
-import pyarrow as pa
-import pyarrow.parquet as pq
 from REL.entity_disambiguation import EntityDisambiguation as RelED
 from REL.mention_detection import MentionDetection
 from REL.utils import process_results
 
-from ..utils import input_stream_gen_lines
+from ..utils import DocidIndex, input_stream_gen_lines
+from ..utils.checkpoint import committed_parts, exit_on_sigterm, part_dir, read_checkpoint, read_parts, \
+    remove_parts, str_to_bool, write_checkpoint
+from ..utils.json_codec import codec
+from .candidate_cache import CachedMentionDetection, CandidateCache
+from .embedding_store import MappedEmbeddings, embedding_db_files
+from .entity_writer import EntityParquetWriter
+from .mention_reader import SortedMentionReader
 
 
 class EntityDisambiguation:
@@ -21,144 +25,227 @@ class EntityDisambiguation:
             "mode": "eval",
             "model_path": "{}/{}/generated/model".format(self.arguments['base_url'], self.arguments['wiki_version'])
         }
-        self.out_file = self.arguments['out_file']
+        self.set_out_file(self.arguments['out_file'])
         self.fields = self.create_fields()
         self.fields_inverted = {value: key for key, value in self.fields.items()}
         self.ids = self.get_ids()
-        self.stream_parquet_md_file = self.stream_md_parquet_file_per_entry(self.arguments['md_file'])
-        self.stream_raw_source_file = input_stream_gen_lines(self.arguments['source_file'])
-        self.mention_detection = MentionDetection(self.arguments['base_url'], self.arguments['wiki_version'])
+        self.set_document_range(int(self.arguments['start_doc']), self.arguments['stop_doc'])
+        self.candidate_cache = None
+        if int(self.arguments['candidate_cache_size']) > 0:
+            self.candidate_cache = CandidateCache(int(self.arguments['candidate_cache_size']),
+                                                  self.arguments['candidate_cache_file'])
+            self.mention_detection = CachedMentionDetection(self.arguments['base_url'], self.arguments['wiki_version'],
+                                                            self.candidate_cache)
+        else:
+            self.mention_detection = MentionDetection(self.arguments['base_url'], self.arguments['wiki_version'])
         self.model = RelED(self.arguments['base_url'], self.arguments['wiki_version'], self.config,
                            reset_embeddings=True)
+        if self.arguments['mapped_embeddings']:  # Replaces the sqlite embedding lookups, candidates stay in sqlite
+            generic_db, wiki_db = embedding_db_files(self.arguments['base_url'], self.arguments['wiki_version'])
+            self.model.g_emb = MappedEmbeddings.load(generic_db)
+            self.model.emb = MappedEmbeddings.load(wiki_db)
         self.docs_done = 0
+        self.jsonl = None
+        self.rows = 0
+        self.row_groups = 0
+        self.document_range = None
+
+    def set_out_file(self, out_file):
+        self.out_file = out_file
+        self.checkpoint_file = out_file[:-8] + '_checkpoint.json'
+        self.part_dir = part_dir(out_file)
 
     def get_ids(self):
-        ids = dict()
-        try:
-            with gzip.open(self.arguments['source_file']) as f:
-                for i, line in enumerate(f):
-                    docid = json.loads(line)[self.arguments['identifier']]
-                    ids[docid] = i
-        except OSError:
-            try:
-                with open(self.arguments['source_file']) as f:
-                    for i, line in enumerate(f):
-                        docid = json.loads(line)[self.arguments['identifier']]
-                        ids[docid] = i
-            except json.decoder.JSONDecodeError:
-                with open(self.arguments['source_file'], 'r') as f:
-                    for i, line in enumerate(f):
-                        identifier, _ = line.strip().split('\t')
-                        ids[identifier] = i
-        except json.decoder.JSONDecodeError:
-            with gzip.open(self.arguments['source_file'], 'r') as f:
-                for i, line in enumerate(f):
-                    identifier, _ = line.decode().strip().split('\t')
-                    ids[identifier] = i
-        return ids
+        # Built once per source file and memory mapped afterwards, see DocidIndex
+        return DocidIndex.load_or_build(self.arguments['source_file'], self.arguments['identifier'],
+                                        self.arguments['docid_index'])
+
+    def set_document_range(self, start_doc=0, stop_doc=None):
+        # Only documents with an ordinal in [start_doc, stop_doc) are disambiguated, reading the source file starts at
+        # the offset of start_doc
+        self.start_doc = start_doc
+        self.stop_doc = int(stop_doc) if stop_doc is not None else None
+        self.stream_parquet_md_file = self.stream_md_parquet_file_per_entry(self.arguments['md_file'])
+        skip_to = self.ids.offset(start_doc) if start_doc < len(self.ids) else 0
+        self.stream_raw_source_file = input_stream_gen_lines(self.arguments['source_file'], skip_to=skip_to)
 
     def stream_md_parquet_file_per_entry(self, filename):
-        lines = []
-        for batch in pq.ParquetFile(filename).iter_batches():
-            df = batch.to_pandas()
-            lines += [line for line in df.iterrows()]
-        lines = sorted(lines, key=lambda a: (self.ids[a[1]['identifier']], a[1]['field'], a[1]['start_pos']))
-        for line in lines:
-            yield line
+        # One (document ordinal, field index, spans, tags, scores) group at a time, sorted runs are spilled to disk
+        yield from self.mention_reader(filename).groups()
+
+    def mention_reader(self, filename):
+        return SortedMentionReader(filename, self.ids, self.fields,
+                                   sort_buffer_size=int(self.arguments['sort_buffer_size']),
+                                   spill_dir=self.arguments['spill_dir'], start_doc=self.start_doc,
+                                   stop_doc=self.stop_doc)
 
     def create_fields(self):
-        if self.arguments['fields']:
-            return {i: f for i, f in enumerate(self.arguments['fields'])}
-        return {v[0]: k for k, v in pd.read_parquet(self.arguments['fields_file']).to_dict().items()}
+        return self.fields_of(self.arguments)
+
+    @staticmethod
+    def fields_of(arguments):
+        if arguments['fields']:
+            return {i: f for i, f in enumerate(arguments['fields'])}
+        return {v[0]: k for k, v in pd.read_parquet(arguments['fields_file']).to_dict().items()}
+
+    def parse_document(self, raw_data):
+        if self.jsonl is None:  # Detected once on the first document
+            self.jsonl = raw_data.lstrip().startswith('{')
+        if self.jsonl:
+            return codec.loads(raw_data)
+        identifier, body = raw_data.rstrip('\r\n').split('\t', 1)
+        return {
+            self.arguments['identifier']: identifier,
+            'body': body
+        }
+
+    def stream_units(self):
+        # Merge join of the source file in its natural order with the mention groups, which are sorted on the same
+        # document ordinal. Only the current document is kept in memory, documents without mentions are not parsed.
+        # Yields (ordinal, field_key, identifier, field, spans, text, tags, scores) for every field of a document.
+        group = next(self.stream_parquet_md_file, None)
+        ordinal = self.start_doc
+        for raw_data in self.stream_raw_source_file:
+            if group is None:
+                return
+            if not raw_data.strip():
+                continue
+            if group[0] == ordinal:
+                json_content = self.parse_document(raw_data)
+                identifier = json_content[self.arguments['identifier']]
+                for field_key in range(len(self.fields)):
+                    field = self.fields[field_key]
+                    spans, tags, scores = [], [], []
+                    if group is not None and group[0] == ordinal and group[1] == field_key:
+                        _, _, spans, tags, scores = group
+                        group = next(self.stream_parquet_md_file, None)
+                    yield ordinal, field_key, identifier, field, spans, json_content.get(field, ''), tags, scores
+                if group is not None and group[0] == ordinal:
+                    raise IOError(f'Document {identifier} has mentions for field {group[1]}, '
+                                  f'which is not in the fields')
+            ordinal += 1
+            self.docs_done = ordinal - self.start_doc
 
     def stream_doc_with_spans(self):
-        data = next(self.stream_parquet_md_file)
-        docs = sorted([d for d in self.stream_raw_source_file], key=lambda a: int(a.strip().split('\t')[0]))
-        for i, raw_data in enumerate(docs):
-            try:
-                json_content = json.loads(raw_data)
-            except json.decoder.JSONDecodeError:
-                identifier, body = raw_data.strip().split('\t')
-                json_content = {
-                    'identifier': identifier,
-                    'body': body
-                }
-            for field_key in range(len(self.fields)):
-                field = self.fields[field_key]
-                current_text = json_content[field]
-                spans, tags, scores = [], [], []
-
-                while data[1]['field'] == field_key or data[1]['field'] == field and \
-                        data[1]['identifier'] == json_content[self.arguments['identifier']]:
-                    spans.append((data[1]['start_pos'], data[1]['end_pos'] - data[1]['start_pos']))
-                    tags.append(data[1]['tag'])
-                    scores.append(data[1]['score'])
-                    try:
-                        data = next(self.stream_parquet_md_file)
-                    except StopIteration:
-                        yield json_content[self.arguments['identifier']], field, spans, current_text, tags, scores
-                        return
-                yield json_content[self.arguments['identifier']], field, spans, current_text, tags, scores
-            self.docs_done = i + 1
+        for _, __, identifier, field, spans, text, tags, scores in self.stream_units():
+            yield identifier, field, spans, text, tags, scores
 
     def disambiguate(self, identifier, field, spans, text, tags, scores):
         unique_id = f'{identifier}+{field}'
-        processed = {unique_id: [text, spans]}
+        return self.disambiguate_units([(unique_id, text, spans, tags, scores)])
+
+    def disambiguate_units(self, units):
+        # One format_spans and predict call for many (unique_id, text, spans, tags, scores) units. REL predicts every
+        # document as its own minibatch, so the predictions do not depend on which units are batched together. The
+        # unique_id is only used as a dictionary key, so any hashable key works.
+        processed = {unique_id: [text, spans] for unique_id, text, spans, _, __ in units}
         mentions_dataset, total_ment = self.mention_detection.format_spans(
             processed
         )
         predictions, timing = self.model.predict(mentions_dataset)
-        ts = [(tag, score) for tag, score, pred in
-              zip(tags, scores, predictions[unique_id]) if pred['prediction'] != 'NIL']
         results = process_results(
             mentions_dataset,
             predictions,
             processed,
             True
         )
-        for i, (tag, score) in enumerate(ts):
-            results[unique_id][i] = list(results[unique_id][i])
-            results[unique_id][i][5] = tag
-            results[unique_id][i][6] = score
-            results[unique_id][i] = tuple(results[unique_id][i])
+        for unique_id, _, __, tags, scores in units:
+            ts = [(tag, score) for tag, score, pred in
+                  zip(tags, scores, predictions.get(unique_id, [])) if pred['prediction'] != 'NIL']
+            results.setdefault(unique_id, [])
+            for i, (tag, score) in enumerate(ts):
+                results[unique_id][i] = list(results[unique_id][i])
+                results[unique_id][i][5] = tag
+                results[unique_id][i][6] = score
+                results[unique_id][i] = tuple(results[unique_id][i])
         return results
 
     def stream_disambiguate_file(self):
-        for identifier, field, spans, text, tags, scores in self.stream_doc_with_spans():
+        # REL predicts every document as its own minibatch, so every field is disambiguated on its own. Units are
+        # keyed on (document ordinal, field key), yields (key, identifier, results) in document order.
+        for ordinal, field_key, identifier, _, spans, text, tags, scores in self.stream_units():
             if len(spans) == 0:
                 continue
-            yield f'{identifier}+{field}', self.disambiguate(identifier, field, spans, text, tags, scores)
-
-    def create_disambiguate_batches(self):
-        batch = []
-        for identifier, result in self.stream_disambiguate_file():
-            if len(batch) >= self.arguments['write_batch_size']:
-                yield batch
-                batch = []
-            for start_pos, span, text, entity, ed_score, tag, md_score in result[identifier]:
-                doc_id, field = identifier.split('+')
-                field = self.fields_inverted[field]
-                batch.append([doc_id, field, start_pos, start_pos + span, entity, ed_score, tag, md_score])
-        yield batch
+            yield from self.split_results([((ordinal, field_key), text, spans, tags, scores)], [identifier])
+
+    def split_results(self, units, identifiers):
+        results = self.disambiguate_units(units)
+        for (key, _, __, ___, ____), identifier in zip(units, identifiers):
+            yield key, identifier, results[key]
+
+    def check_checkpoint(self, checkpoint):
+        # A checkpoint, finished or not, only belongs to an output of the same md file, source file and documents
+        for key in ['md_file', 'source_file']:
+            if checkpoint[key] != self.arguments[key]:
+                raise IOError(f'Checkpoint {self.checkpoint_file} belongs to {key} {checkpoint[key]}')
+        if checkpoint['document_range'] != list(self.document_range):
+            raise IOError(f'Checkpoint {self.checkpoint_file} belongs to documents {checkpoint["document_range"]}')
+
+    def resume_from_checkpoint(self, checkpoint):
+        # Continues after the committed part files, returns False when they are missing and the run starts over. The
+        # documents up to and including the last committed one are skipped through the docid index.
+        if not committed_parts(self.part_dir, checkpoint['row_groups']):
+            print(f'{self.out_file} can not be resumed, starting from the beginning', flush=True)
+            return False
+        self.rows = checkpoint['rows']
+        self.row_groups = checkpoint['row_groups']
+        if checkpoint['last_document'] is not None:
+            self.set_document_range(checkpoint['last_document'] + 1, self.stop_doc)
+        return True
+
+    def commit(self, writer, last_document, finished=False):
+        # Writes a row group as a part file and records the ordinal of the last document that is completely in it
+        self.rows += len(writer)
+        if len(writer) > 0:
+            writer.flush()
+            self.row_groups += 1
+        write_checkpoint(self.checkpoint_file, md_file=self.arguments['md_file'],
+                         source_file=self.arguments['source_file'], document_range=list(self.document_range),
+                         last_document=last_document, rows=self.rows, row_groups=self.row_groups, finished=finished)
+
+    def assemble(self, last_document):
+        # The part files are copied to the output once, when all documents are disambiguated
+        with EntityParquetWriter(self.out_file) as writer:
+            for table in read_parts(self.part_dir, self.row_groups):
+                writer.write_table(table)
+        self.commit(writer, last_document, finished=True)
+        remove_parts(self.part_dir)
 
     def process(self):
-        gen = self.create_disambiguate_batches()
-        df = pd.DataFrame(next(gen),
-                          columns=['doc_id', 'field', 'start_pos', 'end_pos', 'entity', 'ed_score', 'tag', 'md_score'])
-        table = pa.Table.from_pandas(df=df, preserve_index=False)
+        self.document_range = (self.start_doc, self.stop_doc)
+        resumed = False
+        checkpoint = read_checkpoint(self.checkpoint_file) if self.arguments['cont'] else None
+        if checkpoint is not None:
+            self.check_checkpoint(checkpoint)
+            if checkpoint['finished'] and os.path.isfile(self.out_file):
+                print(f'{self.out_file} is already finished', flush=True)
+                return
+            resumed = not checkpoint['finished'] and self.resume_from_checkpoint(checkpoint)
+        if not resumed:
+            remove_parts(self.part_dir)
+
+        # Rows go straight into the column buffers of the writer, a row group is committed once write_batch_size rows
+        # are buffered, at the start of the next document so a resumed run can start at a document
+        write_batch_size = int(self.arguments['write_batch_size'])
         t = time.time()
-        with pq.ParquetWriter(self.out_file, schema=table.schema) as writer:
-            writer.write_table(table)
-            for batch in gen:
-                df = pd.DataFrame(batch,
-                                  columns=['doc_id', 'field', 'start_pos', 'end_pos', 'entity', 'ed_score', 'tag',
-                                           'md_score'])
-                table = pa.Table.from_pandas(df=df, preserve_index=False)
-                writer.write_table(table)
-                batch_time = time.time() - t
-                print(f'Documents finished: {self.docs_done}; Batch time: {batch_time:.2f} seconds', flush=True)
-                t = time.time()
-        pq.write_table(pq.read_table(self.out_file).combine_chunks(), self.out_file)
+        last_document = checkpoint['last_document'] if resumed else None
+        with EntityParquetWriter(self.out_file, part_dir=self.part_dir, parts=self.row_groups) as writer:
+            for (ordinal, field_key), identifier, result in self.stream_disambiguate_file():
+                if ordinal != last_document and len(writer) >= write_batch_size:
+                    self.commit(writer, last_document)
+                    batch_time = time.time() - t
+                    print(f'Documents finished: {self.docs_done}; Batch time: {batch_time:.2f} seconds', flush=True)
+                    t = time.time()
+                last_document = ordinal
+                doc_id = str(identifier)
+                for start_pos, span, text, entity, ed_score, tag, md_score in result:
+                    writer.append(doc_id, field_key, start_pos, start_pos + span, entity, ed_score, tag, md_score)
+            self.commit(writer, last_document)
+        self.assemble(last_document)
+        if self.candidate_cache is not None:
+            print(f'Candidate cache: {self.candidate_cache.report()}', flush=True)
+            if self.arguments['candidate_cache_file'] is not None:
+                self.candidate_cache.save(self.arguments['candidate_cache_file'])
 
     @staticmethod
     def get_arguments(kwargs):
@@ -171,7 +258,18 @@ class EntityDisambiguation:
             'base_url': None,
             'wiki_version': None,
             'identifier': 'docid',
-            'write_batch_size': 10000
+            'write_batch_size': 10000,
+            'cont': True,
+            'sort_buffer_size': '2000000',
+            'spill_dir': None,
+            'docid_index': None,
+            'candidate_cache_size': '100000',
+            'candidate_cache_file': None,
+            'mapped_embeddings': False,
+            'start_doc': 0,
+            'stop_doc': None,
+            'workers': '1',
+            'threads_per_worker': None
         }
         for key, item in arguments.items():
             if kwargs.get(key) is not None:
@@ -238,8 +336,66 @@ if __name__ == '__main__':
     parser.add_argument(
         '-wb',
         '--write_batch_size',
-        help='Write batch size',
+        help='Number of rows per row group of the output file',
         default=10000
     )
-    ed = EntityDisambiguation(**vars(parser.parse_args()))
+    parser.add_argument(
+        '-c',
+        '--cont',
+        help='Resume the output file from its checkpoint if it exists',
+        type=str_to_bool,
+        default=True
+    )
+    parser.add_argument(
+        '-sb',
+        '--sort_buffer_size',
+        help='Number of mentions that are sorted in memory, more mentions are sorted in runs that are spilled to disk',
+        default='2000000'
+    )
+    parser.add_argument(
+        '-sd',
+        '--spill_dir',
+        help='Directory for the sorted runs, defaults to the system temporary directory'
+    )
+    parser.add_argument(
+        '-di',
+        '--docid_index',
+        help='Directory of the docid index of the source file, defaults to the source file name + _docid_index'
+    )
+    parser.add_argument(
+        '-cs',
+        '--candidate_cache_size',
+        help='Number of mentions whose normalized form and candidates are kept in an LRU cache, 0 disables the cache',
+        default='100000'
+    )
+    parser.add_argument(
+        '-cf',
+        '--candidate_cache_file',
+        help='File the candidate cache is loaded from at startup and saved to at the end, to warm up later shards'
+    )
+    parser.add_argument(
+        '-me',
+        '--mapped_embeddings',
+        action='store_true',
+        help='Look up embeddings in the memory mapped export of python -m rebl.ed.embedding_store instead of sqlite'
+    )
+    parser.add_argument(
+        '-nw',
+        '--workers',
+        help='Number of processes that each load the model and disambiguate a contiguous range of documents, the '
+             'parts are merged in document order',
+        default='1'
+    )
+    parser.add_argument(
+        '-tw',
+        '--threads_per_worker',
+        help='Number of torch threads per worker, default is cores / workers'
+    )
+    args = parser.parse_args()
+    exit_on_sigterm()
+    if int(args.workers) > 1:
+        from .parallel_entity_disambiguation import ParallelEntityDisambiguation
+        ed = ParallelEntityDisambiguation(**vars(args))
+    else:
+        ed = EntityDisambiguation(**vars(args))
     ed.process()
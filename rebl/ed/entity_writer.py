@@ -0,0 +1,80 @@
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from ..utils.checkpoint import write_part
+
+_DICTIONARY_COLUMNS = {'entity', 'tag'}
+
+
+def entity_schema():
+    # field is the index of the field in the fields (file)
+    return pa.schema([
+        ('doc_id', pa.string()),
+        ('field', pa.int64()),
+        ('start_pos', pa.int64()),
+        ('end_pos', pa.int64()),
+        ('entity', pa.dictionary(pa.int32(), pa.string())),
+        ('ed_score', pa.float64()),
+        ('tag', pa.dictionary(pa.int32(), pa.string())),
+        ('md_score', pa.float64())
+    ])
+
+
+class EntityParquetWriter:
+    # With a part_dir every row group is written as its own part file (numbered from parts) instead of to out_file
+
+    def __init__(self, out_file, part_dir=None, parts=0):
+        self.schema = entity_schema()
+        self.part_dir = part_dir
+        self.parts = parts
+        self.writer = pq.ParquetWriter(out_file, schema=self.schema) if part_dir is None else None
+        self.columns = {name: [] for name in self.schema.names}
+        self.row_groups = 0
+
+    def __len__(self):
+        return len(self.columns['doc_id'])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def append(self, doc_id, field, start_pos, end_pos, entity, ed_score, tag, md_score):
+        self.columns['doc_id'].append(doc_id)
+        self.columns['field'].append(field)
+        self.columns['start_pos'].append(start_pos)
+        self.columns['end_pos'].append(end_pos)
+        self.columns['entity'].append(entity)
+        self.columns['ed_score'].append(ed_score)
+        self.columns['tag'].append(tag)
+        self.columns['md_score'].append(md_score)
+
+    def flush(self):
+        # Every flush is written as a single row group, the output is never read back and rewritten
+        if len(self) == 0:
+            return
+        arrays = []
+        for schema_field in self.schema:
+            values = self.columns[schema_field.name]
+            if schema_field.name in _DICTIONARY_COLUMNS:
+                arrays.append(pa.array(values, type=pa.string()).dictionary_encode())
+            else:
+                arrays.append(pa.array(values, type=schema_field.type))
+        self.write_table(pa.Table.from_arrays(arrays, schema=self.schema))
+        self.columns = {name: [] for name in self.schema.names}
+
+    def write_table(self, table):
+        if table.num_rows == 0:
+            return
+        if self.part_dir is not None:
+            write_part(self.part_dir, self.parts, table.cast(self.schema))
+            self.parts += 1
+        else:
+            self.writer.write_table(table.cast(self.schema), row_group_size=table.num_rows)
+        self.row_groups += 1
+
+    def close(self):
+        self.flush()
+        if self.writer is not None:
+            self.writer.close()
@@ -0,0 +1,153 @@
+import heapq
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+_COLUMNS = ['identifier', 'field', 'start_pos', 'end_pos', 'score', 'tag']
+_SORT_KEYS = [('ordinal', 'ascending'), ('field', 'ascending'), ('start_pos', 'ascending')]
+_RUN_SCHEMA = pa.schema([
+    ('ordinal', pa.int64()),
+    ('field', pa.int64()),
+    ('start_pos', pa.int64()),
+    ('end_pos', pa.int64()),
+    ('score', pa.float64()),
+    ('tag', pa.string())
+])
+
+
+def sort_table(table, sort_keys):
+    # Table.sort_by needs pyarrow 7, sort_indices and take work with the pinned pyarrow 6
+    return table.take(pc.sort_indices(table, sort_keys=sort_keys))
+
+
+class SortedMentionReader:
+
+    def __init__(self, md_file, ids, fields, sort_buffer_size=2000000, spill_dir=None, read_batch_size=65536,
+                 start_doc=0, stop_doc=None):
+        self.md_file = md_file
+        self.ids = ids  # DocidIndex of the source file
+        self.field_names = pa.array([fields[key] for key in sorted(fields)], type=pa.string())
+        self.field_keys = np.array(sorted(fields), dtype=np.int64)
+        self.sort_buffer_size = sort_buffer_size
+        self.spill_dir = spill_dir
+        self.read_batch_size = read_batch_size
+        self.start_doc = start_doc  # Only mentions of documents with an ordinal in [start_doc, stop_doc) are read
+        self.stop_doc = stop_doc
+
+    def ordinals(self, identifiers):
+        if pa.types.is_dictionary(identifiers.type):  # Only look up every distinct identifier once
+            ordinals = self.ids.ordinals(identifiers.dictionary)[identifiers.indices.to_numpy(zero_copy_only=False)]
+        else:
+            ordinals = self.ids.ordinals(identifiers)
+        if (ordinals < 0).any():
+            missing = identifiers[int(np.flatnonzero(ordinals < 0)[0])]
+            raise KeyError(f'Identifier {missing} from the md file is not in the source file')
+        return ordinals
+
+    def field_indices(self, fields):
+        if pa.types.is_integer(fields.type):
+            return fields.to_numpy(zero_copy_only=False).astype(np.int64)
+        # Tab separated md output stores the field name instead of its index
+        positions = pc.index_in(fields.cast(pa.string()), value_set=self.field_names)
+        if positions.null_count > 0:
+            missing = pc.filter(fields, pc.is_null(positions))[0]
+            raise KeyError(f'Field {missing} from the md file is not in the fields')
+        return self.field_keys[positions.to_numpy(zero_copy_only=False)]
+
+    def to_run_table(self, batch):
+        ordinals = self.ordinals(batch.column('identifier'))
+        table = pa.Table.from_arrays([
+            pa.array(ordinals, type=pa.int64()),
+            pa.array(self.field_indices(batch.column('field')), type=pa.int64()),
+            batch.column('start_pos').cast(pa.int64()),
+            batch.column('end_pos').cast(pa.int64()),
+            batch.column('score').cast(pa.float64()),
+            batch.column('tag').cast(pa.string())
+        ], schema=_RUN_SCHEMA)
+        if self.start_doc > 0 or self.stop_doc is not None:
+            in_range = ordinals >= self.start_doc
+            if self.stop_doc is not None:
+                in_range &= ordinals < self.stop_doc
+            table = table.filter(pa.array(in_range))
+        return table
+
+    def mention_counts(self):
+        # Number of mentions per document ordinal, without sorting anything
+        counts = np.zeros(len(self.ids), dtype=np.int64)
+        for batch in pq.ParquetFile(self.md_file).iter_batches(batch_size=self.read_batch_size,
+                                                               columns=['identifier']):
+            counts += np.bincount(self.ordinals(batch.column('identifier')), minlength=len(self.ids))
+        return counts
+
+    def sorted_runs(self, directory):
+        # Sorts chunks of at most sort_buffer_size mentions, everything but the last chunk is spilled to disk
+        run_files, tables, rows = [], [], 0
+        for batch in pq.ParquetFile(self.md_file).iter_batches(batch_size=self.read_batch_size, columns=_COLUMNS):
+            tables.append(self.to_run_table(batch))
+            rows += tables[-1].num_rows
+            if rows >= self.sort_buffer_size:
+                run_files.append(os.path.join(directory, f'run{len(run_files)}.parquet'))
+                pq.write_table(sort_table(pa.concat_tables(tables), _SORT_KEYS), run_files[-1],
+                               row_group_size=self.read_batch_size)
+                tables, rows = [], 0
+        table = sort_table(pa.concat_tables(tables), _SORT_KEYS) if tables else _RUN_SCHEMA.empty_table()
+        return run_files, table
+
+    @staticmethod
+    def table_groups(table):
+        # (ordinal, field, slice) for every run of equal keys in a sorted table
+        if table.num_rows == 0:
+            return
+        ordinals = table.column('ordinal').to_numpy()
+        fields = table.column('field').to_numpy()
+        boundaries = np.flatnonzero((ordinals[1:] != ordinals[:-1]) | (fields[1:] != fields[:-1])) + 1
+        starts = np.concatenate(([0], boundaries))
+        ends = np.concatenate((boundaries, [table.num_rows]))
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            yield int(ordinals[start]), int(fields[start]), table.slice(start, end - start)
+
+    def run_groups(self, run_file):
+        for batch in pq.ParquetFile(run_file).iter_batches(batch_size=self.read_batch_size):
+            yield from self.table_groups(pa.Table.from_batches([batch]))
+
+    @staticmethod
+    def to_group(ordinal, field, table):
+        start_pos = table.column('start_pos').to_numpy()
+        end_pos = table.column('end_pos').to_numpy()
+        spans = list(zip(start_pos.tolist(), (end_pos - start_pos).tolist()))
+        return ordinal, field, spans, table.column('tag').to_pylist(), table.column('score').to_pylist()
+
+    def groups(self):
+        # Yields (document ordinal, field index, spans, tags, scores) in source order, spans as (start, length)
+        directory = tempfile.mkdtemp(prefix='rebl_md_runs_', dir=self.spill_dir)
+        try:
+            run_files, table = self.sorted_runs(directory)
+            if not run_files:
+                for ordinal, field, group in self.table_groups(table):
+                    yield self.to_group(ordinal, field, group)
+                return
+            # A document can be split over runs and over batches of a run, so equal keys are combined after merging
+            sources = [self.run_groups(run_file) for run_file in run_files] + [self.table_groups(table)]
+            merged = heapq.merge(*sources, key=lambda group: (group[0], group[1]))
+            key, parts = None, []
+            for ordinal, field, group in merged:
+                if (ordinal, field) != key and parts:
+                    yield self.to_group(*key, self.combine(parts))
+                    parts = []
+                key = (ordinal, field)
+                parts.append(group)
+            if parts:
+                yield self.to_group(*key, self.combine(parts))
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    @staticmethod
+    def combine(parts):
+        if len(parts) == 1:
+            return parts[0]
+        return sort_table(pa.concat_tables(parts), [('start_pos', 'ascending')])
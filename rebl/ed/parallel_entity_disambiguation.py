@@ -0,0 +1,130 @@
+import multiprocessing
+import os
+import sqlite3
+
+import numpy as np
+import pyarrow.parquet as pq
+import torch
+from REL.db.generic import GenericLookup
+
+from ..utils.checkpoint import part_dir, read_checkpoint, remove_parts, write_checkpoint
+from .entity_disambiguation import EntityDisambiguation
+from .entity_writer import EntityParquetWriter
+
+_inherited_connections = []
+
+
+def _sqlite_lookups(ed):
+    # (lookup, database file) of every REL lookup of the model that reads from sqlite, the embedding lookups are
+    # memory mapped instead with --mapped_embeddings
+    lookups = [ed.model.emb, ed.model.g_emb, ed.mention_detection.wiki_db]
+    return [(lookup, lookup.db.execute('PRAGMA database_list').fetchone()[2]) for lookup in lookups
+            if isinstance(lookup, GenericLookup)]
+
+
+def _init_worker(lookups, threads):
+    # Runs first in a forked worker. A sqlite connection must not be used across a fork, so every lookup gets a
+    # connection of its own; the inherited ones are kept referenced, closing them could disturb the parent. Torch
+    # resizes its thread pools for this worker.
+    for lookup, db_file in lookups:
+        _inherited_connections.append(lookup.db)
+        lookup.db = sqlite3.connect(db_file, isolation_level=None)
+        lookup.cursor = lookup.db.cursor()
+    torch.set_num_threads(threads)
+
+
+def _disambiguate_range(ed, lookups, threads, part_file, start_doc, stop_doc, save_cache):
+    # Runs in a forked worker, the model, embeddings, docid index and candidate cache of the parent are shared
+    # copy-on-write
+    _init_worker(lookups, threads)
+    ed.set_out_file(part_file)  # A preempted worker resumes its own part from its own checkpoint
+    if not save_cache:  # Every worker starts with the warm candidate cache, only one writes it back
+        ed.arguments['candidate_cache_file'] = None
+    ed.set_document_range(start_doc, stop_doc)
+    ed.process()
+
+
+class ParallelEntityDisambiguation:
+
+    def __init__(self, **kwargs):
+        self.arguments = EntityDisambiguation.get_arguments(kwargs)
+        self.out_file = self.arguments['out_file']
+        self.checkpoint_file = self.out_file[:-8] + '_checkpoint.json'
+        self.ed = EntityDisambiguation(**kwargs)  # The model is loaded once, before the workers are forked
+
+    def part_file(self, i):
+        return self.out_file[:-8] + f'_part{i}.parquet'
+
+    def document_ranges(self, workers):
+        # Contiguous ranges of document ordinals with about the same number of mentions, (start, stop) with stop None
+        # for the last range
+        cumulative = np.cumsum(self.ed.mention_reader(self.arguments['md_file']).mention_counts())
+        total = int(cumulative[-1]) if len(cumulative) else 0
+        boundaries = [int(np.searchsorted(cumulative, total * i // workers, side='right')) for i in range(1, workers)]
+        boundaries = sorted(set(b for b in boundaries if 0 < b < len(cumulative)))
+        return list(zip([0] + boundaries, boundaries + [None]))
+
+    def check_checkpoint(self, checkpoint):
+        # The merged output covers all documents, as does that of a serial run
+        for key in ['md_file', 'source_file']:
+            if checkpoint[key] != self.arguments[key]:
+                raise IOError(f'Checkpoint {self.checkpoint_file} belongs to {key} {checkpoint[key]}')
+        if checkpoint['document_range'] != [0, None]:
+            raise IOError(f'Checkpoint {self.checkpoint_file} belongs to documents {checkpoint["document_range"]}')
+
+    def discard_other_part(self, i, start_doc, stop_doc):
+        # A part of a run with another number of workers (or of another input) covers other documents, it starts over
+        part_checkpoint = read_checkpoint(self.part_file(i)[:-8] + '_checkpoint.json')
+        if part_checkpoint is None or (part_checkpoint['md_file'], part_checkpoint['source_file'],
+                                       part_checkpoint['document_range']) == \
+                (self.arguments['md_file'], self.arguments['source_file'], [start_doc, stop_doc]):
+            return
+        print(f'{self.part_file(i)} covers other documents, starting it over', flush=True)
+        for suffix in ['.parquet', '_checkpoint.json']:
+            if os.path.isfile(self.part_file(i)[:-8] + suffix):
+                os.remove(self.part_file(i)[:-8] + suffix)
+        remove_parts(part_dir(self.part_file(i)))
+
+    def process(self):
+        if self.arguments['cont'] and os.path.isfile(self.out_file):
+            checkpoint = read_checkpoint(self.checkpoint_file)
+            if checkpoint is not None and checkpoint['finished']:
+                self.check_checkpoint(checkpoint)
+                print(f'{self.out_file} is already finished', flush=True)
+                return
+        ranges = self.document_ranges(int(self.arguments['workers']))
+        for i, (start_doc, stop_doc) in enumerate(ranges):
+            self.discard_other_part(i, start_doc, stop_doc)
+        threads = self.arguments['threads_per_worker']
+        threads = int(threads) if threads is not None else max(1, os.cpu_count() // len(ranges))
+        lookups = _sqlite_lookups(self.ed)
+        # Forked workers share the loaded model, every worker opens its own sqlite connections first
+        context = multiprocessing.get_context('fork')
+        processes = []
+        for i, (start_doc, stop_doc) in enumerate(ranges):
+            process = context.Process(target=_disambiguate_range, args=(self.ed, lookups, threads, self.part_file(i),
+                                                                        start_doc, stop_doc, i == 0))
+            process.start()
+            processes.append(process)
+        for process in processes:
+            process.join()
+        failed = [i for i, process in enumerate(processes) if process.exitcode != 0]
+        if failed:
+            raise RuntimeError(f'ED workers {failed} failed, their part files are kept to resume from')
+        self.merge(len(ranges))
+
+    def merge(self, parts):
+        # Parts cover consecutive document ranges and share one schema, so copying their row groups in order gives
+        # the serial output
+        with EntityParquetWriter(self.out_file) as writer:
+            for i in range(parts):
+                parquet_file = pq.ParquetFile(self.part_file(i))
+                for j in range(parquet_file.metadata.num_row_groups):
+                    writer.write_table(parquet_file.read_row_group(j))
+        write_checkpoint(self.checkpoint_file, md_file=self.arguments['md_file'],
+                         source_file=self.arguments['source_file'], document_range=[0, None], last_document=None,
+                         rows=pq.ParquetFile(self.out_file).metadata.num_rows, row_groups=writer.row_groups,
+                         finished=True)
+        for i in range(parts):
+            os.remove(self.part_file(i))
+            os.remove(self.part_file(i)[:-8] + '_checkpoint.json')
@@ -1,3 +1,4 @@
 from .mention_detection import MentionDetection
+from .sharded_mention_detection import ShardedMentionDetection
 
-__all__ = ['MentionDetection']
+__all__ = ['MentionDetection', 'ShardedMentionDetection']
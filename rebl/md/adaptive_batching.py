@@ -0,0 +1,75 @@
+import torch
+
+_OOM_MESSAGES = ['out of memory', "can't allocate memory"]
+
+
+def is_out_of_memory(error):
+    # torch.cuda.OutOfMemoryError only exists in newer torch versions, cpu allocation failures are plain RuntimeErrors
+    oom_error = getattr(torch.cuda, 'OutOfMemoryError', None)
+    if oom_error is not None and isinstance(error, oom_error):
+        return True
+    message = str(error).lower()
+    return any(oom in message for oom in _OOM_MESSAGES)
+
+
+class AdaptiveBatchController:
+
+    def __init__(self, tagger, probe_interval=1000):
+        self.tagger = tagger
+        self.probe_interval = probe_interval
+        self.token_limit = None  # Batches of this many (padded) tokens or more are split before predicting
+        self.max_tokens_ok = 0
+        self.successes_since_backoff = 0
+        self.counters = {'batches': 0, 'backoffs': 0, 'pre_splits': 0, 'probes': 0, 'impossible': 0}
+
+    @staticmethod
+    def padded_tokens(batch):
+        return len(batch) * max(len(sentence) for sentence in batch)
+
+    def predict(self, batch, mini_batch_size=32):
+        # Returns the indices of the sentences that were tagged and of the ones that do not fit in memory on their own
+        fine, failed = [], []
+        if batch:
+            self._predict(batch, list(range(len(batch))), mini_batch_size, fine, failed)
+        return fine, failed
+
+    def _predict(self, batch, indices, mini_batch_size, fine, failed):
+        tokens = self.padded_tokens(batch)
+        if len(batch) > 1 and self.token_limit is not None and tokens >= self.token_limit:
+            self.counters['pre_splits'] += 1
+            self._predict_halves(batch, indices, mini_batch_size, fine, failed)
+            return
+        try:
+            self.tagger.predict(batch, mini_batch_size=mini_batch_size)
+        except RuntimeError as error:
+            if not is_out_of_memory(error):  # e.g. shape errors and CUDA asserts are not solved by smaller batches
+                raise
+            self.counters['backoffs'] += 1
+            self.successes_since_backoff = 0
+            self.token_limit = tokens if self.token_limit is None else min(self.token_limit, tokens)
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+            if len(batch) == 1:  # Single sentence is too big for the available memory
+                self.counters['impossible'] += 1
+                failed += indices
+            else:
+                self._predict_halves(batch, indices, mini_batch_size, fine, failed)
+            return
+        self.counters['batches'] += 1
+        self.max_tokens_ok = max(self.max_tokens_ok, tokens)
+        self.successes_since_backoff += 1
+        if self.token_limit is not None and self.successes_since_backoff >= self.probe_interval:
+            # Memory pressure can be temporary, so carefully try larger batches again
+            self.counters['probes'] += 1
+            self.successes_since_backoff = 0
+            self.token_limit = int(self.token_limit * 1.25) + 1
+        fine += indices
+
+    def _predict_halves(self, batch, indices, mini_batch_size, fine, failed):
+        half = len(batch) // 2
+        self._predict(batch[:half], indices[:half], mini_batch_size, fine, failed)
+        self._predict(batch[half:], indices[half:], mini_batch_size, fine, failed)
+
+    def report(self):
+        counters = '; '.join(f'{key}: {value}' for key, value in self.counters.items())
+        return f'{counters}; largest batch that fit (tokens): {self.max_tokens_ok}; token limit: {self.token_limit}'
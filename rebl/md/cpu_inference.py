@@ -0,0 +1,50 @@
+from contextlib import contextmanager
+
+import flair
+import torch
+from flair.models import SequenceTagger
+
+
+def inference_mode():
+    # torch.inference_mode is only available from torch 1.9 onwards
+    if hasattr(torch, 'inference_mode'):
+        return torch.inference_mode()
+    return torch.no_grad()
+
+
+@contextmanager
+def flair_device(device):
+    # flair reads the global flair.device when a model is loaded and while it predicts, so it is only set for the
+    # duration of these calls, other models in the process keep their device
+    previous = flair.device
+    flair.device = device
+    try:
+        yield
+    finally:
+        flair.device = previous
+
+
+@contextmanager
+def cpu_inference():
+    with flair_device(torch.device('cpu')), inference_mode():
+        yield
+
+
+def set_threads(intra_op_threads=None, inter_op_threads=None):
+    if intra_op_threads is not None:
+        torch.set_num_threads(int(intra_op_threads))
+    if inter_op_threads is not None and torch.get_num_interop_threads() != int(inter_op_threads):
+        try:
+            torch.set_num_interop_threads(int(inter_op_threads))
+        except RuntimeError:  # Can only be set once, before any inter-op parallel work has started
+            print(f'Inter-op threads already set to {torch.get_num_interop_threads()}', flush=True)
+
+
+def load_cpu_optimized_tagger(tagger, intra_op_threads=None, inter_op_threads=1):
+    # Loads the tagger on cpu and applies dynamic int8 quantization to all LSTM and linear layers,
+    # including the ones of the language models in the flair embeddings. Predict within cpu_inference().
+    set_threads(intra_op_threads, inter_op_threads)
+    with flair_device(torch.device('cpu')):
+        model = SequenceTagger.load(tagger)
+    model.eval()
+    return torch.quantization.quantize_dynamic(model, {torch.nn.LSTM, torch.nn.Linear}, dtype=torch.qint8)
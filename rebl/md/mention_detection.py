@@ -1,17 +1,20 @@
 import argparse
 import json
-import re
 import os
-from itertools import chain
-from ..utils import input_stream_gen_lines
+from contextlib import nullcontext
+from ..utils import input_stream_gen_offsets
+from ..utils.checkpoint import committed_parts, exit_on_sigterm, part_dir, read_checkpoint, read_parts, \
+    remove_parts, str_to_bool, write_checkpoint
+from .adaptive_batching import AdaptiveBatchController
+from .cpu_inference import cpu_inference, load_cpu_optimized_tagger
+from .mention_writer import MentionParquetWriter
+from .sentence_creation import SentenceCreator, pooled_sentences_with_id_gen
+from .tagger_cache import TaggerCache
 
-import pandas as pd
 import pyarrow as pa
+import pyarrow.compute as pc
 import pyarrow.parquet as pq
-import torch
-from flair.data import Sentence, Token
 from flair.models import SequenceTagger
-from syntok.segmenter import analyze
 
 
 class MentionDetection:
@@ -19,174 +22,258 @@ class MentionDetection:
     def __init__(self, **kwargs):
         self.arguments = self.get_arguments(kwargs)
         self.out_file = self.arguments['out_file']
-        self.tagger = SequenceTagger.load(self.arguments['tagger'])
-        self.field_mapping = {f: i for i, f in enumerate(self.arguments['fields'])}
-        self.chars_removed_by_flair = re.compile("([\u200c\ufe0f\ufeff])")
-        self.skip_to = 0
+        if self.arguments['cpu_optimized']:
+            self.tagger = load_cpu_optimized_tagger(self.arguments['tagger'], self.arguments['intra_op_threads'],
+                                                    self.arguments['inter_op_threads'])
+            self.inference_context = cpu_inference
+        else:
+            self.tagger = SequenceTagger.load(self.arguments['tagger'])
+            self.inference_context = nullcontext
+        self.batch_controller = AdaptiveBatchController(self.tagger)
+        self.tagger_cache = None
+        if int(self.arguments['tagger_cache_size']) > 0:
+            self.tagger_cache = TaggerCache(int(self.arguments['tagger_cache_size']),
+                                            self.arguments['tagger_cache_file'])
+        self.sentence_creator = SentenceCreator(self.arguments)
+        self.field_mapping = self.sentence_creator.field_mapping
+        self.checkpoint_file = self.out_file[:-8] + '_checkpoint.json'
+        self.part_dir = part_dir(self.out_file)
+        self.skip_to = int(self.arguments['start_at'])
+        self.rows = 0
+        self.row_groups = 0
+        self.last_document = None
 
     def create_sentences(self, text, identifier):
-        sentence_list = []
-        for syntok_sentence in chain.from_iterable(analyze(text)):
-            remove_char_counts = []
-            manual_sent = Sentence()
-            for token in syntok_sentence:
-                # Find how much we need to increase the offset by the characters that are removed by flair
-                if len(self.chars_removed_by_flair.sub('', token.value)) > 0:  # Zero length tokens are not added
-                    remove_char_counts.append(len(self.chars_removed_by_flair.findall(token.value)))
-                manual_sent.add_token(Token(token.value, start_position=token.offset))
-            try:
-                assert len(remove_char_counts) == len(manual_sent)  # Ensure offset list is of equal length
-            except AssertionError as e:
-                print("Length offset list: " + str(len(remove_char_counts)))
-                print("Length token list: " + str(len(manual_sent)))
-                print("AssertionError: " + str(e))
-                with open(self.arguments['out_file'][:-8] + '_errors.txt', 'a') as f:
-                    f.write(identifier)
-                    f.write('\n')
+        return self.sentence_creator.create_sentences(text, identifier)
 
-            for i, token in enumerate(manual_sent):
-                start = token.start_pos
-                end = start + len(token.text) + remove_char_counts[i]
-                raw_token_cleaned = self.chars_removed_by_flair.sub('', text[start:end])
-                token.end_pos = end
-                try:  # Especially important that the offset is still correct, the rest can be reconstructed
-                    assert raw_token_cleaned == token.text
-                except AssertionError as e:
-                    print("Token text" + token.text)
-                    print("Raw text" + raw_token_cleaned)
-                    print("Context: " + text[start - 10:end + 10])
-                    print("Remove char count: " + str(remove_char_counts[i]))
-                    print("AssertionError: " + str(e))
-                    # For now ignore this document and store identifier in error file
-                    with open(self.arguments['out_file'][:-8] + '_errors.txt', 'a') as f:
-                        f.write(identifier)
-                        f.write('\n')
-                    return []
-            sentence_list.append(manual_sent)
-        return sentence_list
+    def offset_line_gen(self):
+        for _, offset, line in input_stream_gen_offsets(self.arguments['in_file'], skip_to=self.skip_to,
+                                                        stop_at=self.arguments['stop_at'],
+                                                        index_dir=self.arguments['gzip_index']):
+            yield offset, line
 
     def jsonl_to_sentences_with_id_gen(self):
-        for line in input_stream_gen_lines(self.arguments['in_file'], skip_to=self.skip_to):
-            json_line = json.loads(line)
-            identifier = json_line[self.arguments['identifier']]
-            for field in self.arguments['fields']:
-                raw_text = json_line[field]
-                for sentence_object in self.create_sentences(raw_text, identifier):
-                    yield sentence_object, identifier, self.field_mapping[field]
+        for offset, line in self.offset_line_gen():
+            for sentence_object, identifier, field in self.sentence_creator.jsonl_line_to_sentences(line):
+                yield sentence_object, identifier, field, offset
 
     def tab_sep_to_sentences_with_id_gen(self):
-        for line in input_stream_gen_lines(self.arguments['in_file']):
-            identifier, text = line.strip().split('\t')
-            for sentence_object in self.create_sentences(text, identifier):
-                yield sentence_object, identifier, 'body'
+        for offset, line in self.offset_line_gen():
+            for sentence_object, identifier, field in self.sentence_creator.tab_sep_line_to_sentences(line):
+                yield sentence_object, identifier, field, offset
+
+    def pooled_sentences_with_id_gen(self):
+        return pooled_sentences_with_id_gen(self.offset_line_gen(), self.arguments,
+                                            int(self.arguments['preprocess_workers']))
 
-    def batch_sentence_gen(self):
-        batch, ids, fields = list(), list(), list()
-        if self.arguments['file_type'] == 'jsonl':
+    def batch_sentence_gen(self, batch_size=None):
+        # Next to the identifier and field, the byte offset of the document in the input is kept for every sentence
+        if batch_size is None:
+            batch_size = int(self.arguments['predict_batch_size'])
+        batch, ids, fields, offsets = list(), list(), list(), list()
+        if int(self.arguments['preprocess_workers']) > 0:
+            doc_gen = self.pooled_sentences_with_id_gen()
+        elif self.arguments['file_type'] == 'jsonl':
             doc_gen = self.jsonl_to_sentences_with_id_gen()
         else:
             doc_gen = self.tab_sep_to_sentences_with_id_gen()
-        for sentence, identifier, field in doc_gen:
+        for sentence, identifier, field, offset in doc_gen:
             batch.append(sentence)
             ids.append(identifier)
             fields.append(field)
-            if len(batch) == int(self.arguments['predict_batch_size']):
-                yield batch, ids, fields
-                batch, ids, fields = list(), list(), list()
-        yield batch, ids, fields
+            offsets.append(offset)
+            if len(batch) == batch_size:
+                yield batch, ids, fields, offsets
+                batch, ids, fields, offsets = list(), list(), list(), list()
+        yield batch, ids, fields, offsets
+
+    @staticmethod
+    def token_budget_batches(sentences, token_budget):
+        # Sorts by length, so sentences of similar length end up in the same batch, and cuts a batch when the
+        # padded size (number of sentences times the longest sentence) would exceed the token budget
+        order = sorted(range(len(sentences)), key=lambda k: len(sentences[k]), reverse=True)
+        batch, longest = [], 0
+        for i in order:
+            longest = max(longest, len(sentences[i]))
+            if batch and (len(batch) + 1) * longest > token_budget:
+                yield batch
+                batch, longest = [], len(sentences[i])
+            batch.append(i)
+        if batch:
+            yield batch
+
+    def predict_batch(self, batch, ids, fields, mini_batch_size=32):
+        # Returns the indices of the sentences in the batch that were tagged
+        if self.tagger_cache is None:
+            return self.predict_uncached_batch(batch, ids, fields, mini_batch_size=mini_batch_size)
+        fine, to_predict, keys = [], [], []
+        for i, sentence in enumerate(batch):
+            key = self.tagger_cache.key(sentence)
+            spans = self.tagger_cache.get(key)
+            if spans is None:
+                to_predict.append(i)
+                keys.append(key)
+            else:
+                sentence.cached_spans = spans
+                fine.append(i)
+        tagged = self.predict_uncached_batch([batch[i] for i in to_predict], [ids[i] for i in to_predict],
+                                             [fields[i] for i in to_predict], mini_batch_size=mini_batch_size)
+        for j in tagged:
+            self.tagger_cache.put(keys[j], self.tagger_cache.relative_spans(batch[to_predict[j]]))
+            fine.append(to_predict[j])
+        self.tagger_cache.commit()
+        return sorted(fine)
+
+    def predict_uncached_batch(self, batch, ids, fields, mini_batch_size=32):
+        # Returns the indices of the sentences in the batch that were tagged
+        with self.inference_context():
+            fine, failed = self.batch_controller.predict(batch, mini_batch_size=mini_batch_size)
+        for i in failed:
+            with open(self.arguments['out_file'][:-8] + '_memory_problem.txt', 'a') as f:
+                json.dump({"id": ids[i],
+                           "field": fields[i],
+                           "start_pos": batch[i][0].start_pos,
+                           "end_pos": batch[i][-1].end_pos},
+                          f)
+                f.write('\n')
+        return fine
 
     def mention_detect_sentence_batch_gen(self):
-        for batch, ids, fields in self.batch_sentence_gen():
-            try:
-                self.tagger.predict(batch)
-                yield batch, ids, fields
-            except RuntimeError:
-                try:
-                    torch.cuda.empty_cache()
-                    self.tagger.predict(batch)
-                    yield batch, ids, fields
-                except RuntimeError:
-                    torch.cuda.empty_cache()
-                    fine = []
-                    for i, b in enumerate(batch):
-                        try:
-                            torch.cuda.empty_cache()
-                            self.tagger.predict(b)
-                            fine.append(i)
-                        except RuntimeError:  # Single sentence is too big for gpu...
-                            with open(self.arguments['out_file'][:-8] + '_memory_problem.txt', 'a') as f:
-                                json.dump({"id": ids[i],
-                                           "field": fields[i],
-                                           "start_pos": b[0].start_pos,
-                                           "end_pos": b[-1].end_pos},
-                                          f)
-                                f.write('\n')
-                        yield [batch[i] for i in fine], [ids[i] for i in fine], [fields[i] for i in fine]
-                    torch.cuda.empty_cache()
+        if self.arguments['batching'] == 'tokens':
+            return self.token_budget_mention_detect_sentence_batch_gen()
+        return self.count_mention_detect_sentence_batch_gen()
+
+    def count_mention_detect_sentence_batch_gen(self):
+        for batch, ids, fields, offsets in self.batch_sentence_gen():
+            fine = self.predict_batch(batch, ids, fields)
+            yield [batch[i] for i in fine], [ids[i] for i in fine], [fields[i] for i in fine], \
+                [offsets[i] for i in fine]
+
+    def token_budget_mention_detect_sentence_batch_gen(self):
+        # Buckets a window of sentences by length for tagging, the window is yielded in document order afterwards
+        token_budget = int(self.arguments['token_budget'])
+        for window, ids, fields, offsets in self.batch_sentence_gen(batch_size=int(self.arguments['bucket_window'])):
+            fine = []
+            for indices in self.token_budget_batches(window, token_budget):
+                batch = [window[i] for i in indices]
+                tagged = self.predict_batch(batch, [ids[i] for i in indices], [fields[i] for i in indices],
+                                            mini_batch_size=len(batch))
+                fine += [indices[i] for i in tagged]
+            fine = sorted(fine)
+            yield [window[i] for i in fine], [ids[i] for i in fine], [fields[i] for i in fine], \
+                [offsets[i] for i in fine]
 
     def sentence_md_batches_to_sentences_gen(self):
-        for sentence_batch, id_batch, field_batch in self.mention_detect_sentence_batch_gen():
-            for sentence, identifier, field in zip(sentence_batch, id_batch, field_batch):
-                yield sentence, identifier, field
+        for sentence_batch, id_batch, field_batch, offset_batch in self.mention_detect_sentence_batch_gen():
+            for sentence, identifier, field, offset in zip(sentence_batch, id_batch, field_batch, offset_batch):
+                yield sentence, identifier, field, offset
+
+    @staticmethod
+    def sentence_spans(sentence):
+        cached_spans = getattr(sentence, 'cached_spans', None)
+        if cached_spans is not None:
+            return TaggerCache.absolute_spans(sentence, cached_spans)
+        return sentence.get_spans('ner')
 
     def sentence_to_mentions_gen(self):
-        for sentence, identifier, field in self.sentence_md_batches_to_sentences_gen():
-            for entity in sentence.get_spans('ner'):
-                yield entity, identifier, field
+        for sentence, identifier, field, offset in self.sentence_md_batches_to_sentences_gen():
+            for entity in self.sentence_spans(sentence):
+                yield entity, identifier, field, offset
 
-    def batch_mentions_gen(self):
-        batch = []
-        for entity, identifier, field in self.sentence_to_mentions_gen():
-            batch.append(
-                [
-                    identifier,
-                    field,
-                    entity.text,
-                    entity.start_pos,
-                    entity.end_pos,
-                    entity.score,
-                    entity.tag
-                ]
-            )
-            if len(batch) == int(self.arguments['write_batch_size']):
-                yield batch
-                batch = []
-        yield batch
+    def write_field_mapping(self):
+        table = pa.table({k: [v] for k, v in self.field_mapping.items()})
+        pq.write_table(table, self.out_file[:-8] + '_field_mapping.parquet')
 
-    def write_batches_to_parquet(self):
-        fields = pd.DataFrame.from_dict({k: [v] for k, v in self.field_mapping.items()})
-        table = pa.Table.from_pandas(df=fields, preserve_index=False)
+    def check_checkpoint(self, checkpoint):
+        # A checkpoint of another input (or input range) can not be resumed, and does not make the output finished
+        for key in ['in_file', 'start_at', 'stop_at']:
+            if checkpoint.get(key, self.arguments[key]) != self.arguments[key]:
+                raise IOError(f'Checkpoint {self.checkpoint_file} belongs to {key} {checkpoint[key]}, not '
+                              f'{self.arguments[key]}; use another out_file or --cont False')
 
-        if not self.arguments['cont'] or not os.path.isfile(self.out_file[:-8] + '_field_mapping.parquet'):
-            with pq.ParquetWriter(self.out_file[:-8] + '_field_mapping.parquet', schema=table.schema) as writer:
-                writer.write_table(table)
+    def resume_from_checkpoint(self, checkpoint):
+        # Continues after the committed part files, returns False when they are missing and the run starts over
+        if not committed_parts(self.part_dir, checkpoint['row_groups']):
+            print(f'{self.out_file} can not be resumed, starting from the beginning', flush=True)
+            return False
+        self.skip_to = checkpoint['offset']
+        self.last_document = checkpoint['last_document']
+        self.rows = checkpoint['rows']
+        self.row_groups = checkpoint['row_groups']
+        return True
 
-        if self.arguments['cont'] and os.path.isfile(self.out_file):
-            already_tagged = pq.read_table(self.out_file)
-            last_identifier = max({int(str(e).split('_')[-1]) for e in already_tagged['identifier']})
-            file_identifier = str(already_tagged['identifier'][0]).split('_')[-2]
-            last_file_identifier = f'msmarco_doc_{file_identifier}_{last_identifier}'
-            self.skip_to = last_identifier
-            df = already_tagged.to_pandas()
-            df = df[df['identifier'] != last_file_identifier]
-            gen = self.batch_mentions_gen()
-        else:
-            gen = self.batch_mentions_gen()
-            df = pd.DataFrame(next(gen),
-                              columns=['identifier', 'field', 'text', 'start_pos', 'end_pos', 'score', 'tag'])
-        table = pa.Table.from_pandas(df=df, preserve_index=False)
-        with pq.ParquetWriter(self.out_file, schema=table.schema) as writer:
-            writer.write_table(table)
-            while True:
-                try:
-                    batch = next(gen)
-                except StopIteration:
-                    break
-                df = pd.DataFrame(batch,
-                                  columns=['identifier', 'field', 'text', 'start_pos', 'end_pos', 'score', 'tag'])
-                table = pa.Table.from_pandas(df=df, preserve_index=False)
+    def resume_from_identifiers(self):
+        # Resume output written before checkpoints existed, this only works for MS MARCO identifiers
+        already_tagged = pq.read_table(self.out_file)
+        last_identifier = max({int(str(e).split('_')[-1]) for e in already_tagged['identifier']})
+        file_identifier = str(already_tagged['identifier'][0]).split('_')[-2]
+        last_file_identifier = f'msmarco_doc_{file_identifier}_{last_identifier}'
+        self.skip_to = last_identifier
+        return [already_tagged.filter(pc.not_equal(already_tagged['identifier'], last_file_identifier))]
+
+    def commit(self, writer, offset, finished=False):
+        # Writes a row group as a part file and records where the input has to be resumed to continue after it. An
+        # offset of None means that the whole input is tagged.
+        self.rows += len(writer)
+        if len(writer) > 0:
+            writer.flush()
+            self.row_groups += 1
+        write_checkpoint(self.checkpoint_file, in_file=self.arguments['in_file'],
+                         start_at=self.arguments['start_at'], stop_at=self.arguments['stop_at'], offset=offset,
+                         last_document=self.last_document, rows=self.rows, row_groups=self.row_groups,
+                         finished=finished)
+
+    def assemble(self, field_type):
+        # The part files are copied to the output once, when all input is tagged
+        with MentionParquetWriter(self.out_file, field_type=field_type) as writer:
+            for table in read_parts(self.part_dir, self.row_groups):
                 writer.write_table(table)
-        pq.write_table(pq.read_table(self.out_file).combine_chunks(), self.out_file)
+        self.commit(writer, None, finished=True)
+        remove_parts(self.part_dir)
+
+    def write_batches_to_parquet(self):
+        if not self.arguments['cont'] or not os.path.isfile(self.out_file[:-8] + '_field_mapping.parquet'):
+            self.write_field_mapping()
+
+        previous_output = None
+        resumed = False
+        checkpoint = read_checkpoint(self.checkpoint_file) if self.arguments['cont'] else None
+        if checkpoint is not None:
+            self.check_checkpoint(checkpoint)
+            if checkpoint['finished'] and os.path.isfile(self.out_file):
+                print(f'{self.out_file} is already finished', flush=True)
+                return
+            resumed = not checkpoint['finished'] and self.resume_from_checkpoint(checkpoint)
+        elif self.arguments['cont'] and os.path.isfile(self.out_file):
+            previous_output = self.resume_from_identifiers()
+        if not resumed:
+            remove_parts(self.part_dir)
+
+        write_batch_size = int(self.arguments['write_batch_size'])
+        field_type = pa.int64() if self.arguments['file_type'] == 'jsonl' else pa.string()
+        with MentionParquetWriter(self.out_file, field_type=field_type, part_dir=self.part_dir,
+                                  parts=self.row_groups) as writer:
+            for table in previous_output or []:
+                if table.num_rows > 0:
+                    writer.write_table(table)
+                    self.rows += table.num_rows
+                    self.row_groups += 1
+            if self.skip_to is not None:  # None when the input was tagged completely before the output was assembled
+                current_offset = self.skip_to
+                for entity, identifier, field, offset in self.sentence_to_mentions_gen():
+                    # Row groups are only cut at document boundaries, so a resumed run can start at a document
+                    if offset != current_offset and len(writer) >= write_batch_size:
+                        self.commit(writer, offset)
+                    current_offset = offset
+                    self.last_document = identifier
+                    writer.append(identifier, field, entity.text, entity.start_pos, entity.end_pos, entity.score,
+                                  entity.tag)
+            self.commit(writer, None)
+        self.assemble(field_type)
+        print(f'Adaptive batching: {self.batch_controller.report()}', flush=True)
+        if self.tagger_cache is not None:
+            self.tagger_cache.close()
+            print(f'Tagger cache: {self.tagger_cache.report()}', flush=True)
 
     @staticmethod
     def get_arguments(kwargs):
@@ -199,7 +286,19 @@ class MentionDetection:
             'predict_batch_size': '100',
             'write_batch_size': '10000',
             'file_type': 'jsonl',
-            'cont': True
+            'cont': True,
+            'preprocess_workers': '0',
+            'batching': 'count',
+            'token_budget': '5000',
+            'bucket_window': '2000',
+            'start_at': 0,
+            'stop_at': None,
+            'cpu_optimized': False,
+            'intra_op_threads': None,
+            'inter_op_threads': 1,
+            'tagger_cache_size': '0',
+            'tagger_cache_file': None,
+            'gzip_index': None
         }
         for key, item in arguments.items():
             if kwargs.get(key) is not None:
@@ -251,7 +350,7 @@ if __name__ == '__main__':
     parser.add_argument(
         '-wb',
         '--write_batch_size',
-        help='How many Sentences to tag at once',
+        help='Number of mentions per row group in the output file',
         default='10000'
     )
     parser.add_argument(
@@ -265,7 +364,86 @@ if __name__ == '__main__':
         '-c',
         '--cont',
         help='Append output file if it already exists',
+        type=str_to_bool,
         default=True
     )
-    md = MentionDetection(**vars(parser.parse_args()))
+    parser.add_argument(
+        '-pw',
+        '--preprocess_workers',
+        help='Number of processes that parse and segment documents for the tagger, 0 does this in process',
+        default='0'
+    )
+    parser.add_argument(
+        '-bm',
+        '--batching',
+        choices=['count', 'tokens'],
+        help='Cut tagger batches by sentence count, or by token budget on sentences bucketed by length',
+        default='count'
+    )
+    parser.add_argument(
+        '-tb',
+        '--token_budget',
+        help='Maximum number of (padded) tokens in a batch when batching on tokens',
+        default='5000'
+    )
+    parser.add_argument(
+        '-bw',
+        '--bucket_window',
+        help='Number of consecutive sentences that are bucketed by length when batching on tokens',
+        default='2000'
+    )
+    parser.add_argument(
+        '-nw',
+        '--workers',
+        help='Number of processes that each tag a part of the input, parts are merged in input order',
+        default='1'
+    )
+    parser.add_argument(
+        '-tw',
+        '--threads_per_worker',
+        help='Number of torch threads per worker, default is the number of cores divided by the workers',
+        default=None
+    )
+    parser.add_argument(
+        '-co',
+        '--cpu_optimized',
+        action='store_true',
+        help='Tag on cpu with a dynamically int8 quantized tagger in inference mode'
+    )
+    parser.add_argument(
+        '-it',
+        '--intra_op_threads',
+        help='Number of intra-op torch threads in cpu optimized mode, default is the torch default',
+        default=None
+    )
+    parser.add_argument(
+        '-io',
+        '--inter_op_threads',
+        help='Number of inter-op torch threads in cpu optimized mode',
+        default=1
+    )
+    parser.add_argument(
+        '-cs',
+        '--tagger_cache_size',
+        help='Number of sentences whose tagger results are cached in memory (LRU), 0 disables the cache',
+        default='0'
+    )
+    parser.add_argument(
+        '-cf',
+        '--tagger_cache_file',
+        help='Sqlite file that keeps the cached tagger results across runs and shards',
+        default=None
+    )
+    parser.add_argument(
+        '-gi',
+        '--gzip_index',
+        help='Directory of the random access index of a gzipped in_file, defaults to the in_file name + _gzip_index'
+    )
+    args = parser.parse_args()
+    exit_on_sigterm()
+    if int(args.workers) > 1:
+        from .sharded_mention_detection import ShardedMentionDetection
+        md = ShardedMentionDetection(**vars(args))
+    else:
+        md = MentionDetection(**vars(args))
     md.write_batches_to_parquet()
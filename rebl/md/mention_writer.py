@@ -0,0 +1,83 @@
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from ..utils.checkpoint import write_part
+
+_DICTIONARY_COLUMNS = {'identifier', 'tag'}
+
+
+def mention_schema(field_type=pa.int64()):
+    # field is the index in the field mapping, for tab separated input it is the field name
+    return pa.schema([
+        ('identifier', pa.dictionary(pa.int32(), pa.string())),
+        ('field', field_type),
+        ('text', pa.string()),
+        ('start_pos', pa.int64()),
+        ('end_pos', pa.int64()),
+        ('score', pa.float64()),
+        ('tag', pa.dictionary(pa.int32(), pa.string()))
+    ])
+
+
+class MentionParquetWriter:
+    # With a part_dir every row group is written as its own part file (numbered from parts) instead of to out_file
+
+    def __init__(self, out_file, field_type=pa.int64(), part_dir=None, parts=0):
+        self.schema = mention_schema(field_type)
+        self.part_dir = part_dir
+        self.parts = parts
+        self.writer = pq.ParquetWriter(out_file, schema=self.schema) if part_dir is None else None
+        self.columns = {name: [] for name in self.schema.names}
+
+    def __len__(self):
+        return len(self.columns['identifier'])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def append(self, identifier, field, text, start_pos, end_pos, score, tag):
+        self.columns['identifier'].append(str(identifier))  # e.g. integer pids of passage files
+        self.columns['field'].append(field)
+        self.columns['text'].append(text)
+        self.columns['start_pos'].append(start_pos)
+        self.columns['end_pos'].append(end_pos)
+        self.columns['score'].append(score)
+        self.columns['tag'].append(tag)
+
+    def flush(self):
+        # Every flush is written as a single row group, nothing is read back
+        if len(self) == 0:
+            return
+        arrays = []
+        for schema_field in self.schema:
+            values = self.columns[schema_field.name]
+            if schema_field.name in _DICTIONARY_COLUMNS:
+                arrays.append(pa.array(values, type=pa.string()).dictionary_encode())
+            else:
+                arrays.append(pa.array(values, type=schema_field.type))
+        self.write_table(pa.Table.from_arrays(arrays, schema=self.schema))
+        self.columns = {name: [] for name in self.schema.names}
+
+    def write_table(self, table):
+        if table.num_rows == 0:
+            return
+        columns = []
+        for schema_field in self.schema:
+            column = table[schema_field.name]
+            if schema_field.name in _DICTIONARY_COLUMNS and not pa.types.is_dictionary(column.type):
+                column = column.cast(pa.string()).dictionary_encode()
+            columns.append(column)
+        table = pa.Table.from_arrays(columns, names=self.schema.names).cast(self.schema)
+        if self.part_dir is not None:
+            write_part(self.part_dir, self.parts, table)
+            self.parts += 1
+        else:
+            self.writer.write_table(table, row_group_size=table.num_rows)
+
+    def close(self):
+        self.flush()
+        if self.writer is not None:
+            self.writer.close()
@@ -0,0 +1,142 @@
+import multiprocessing
+import re
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain, islice
+
+from flair.data import Sentence, Token
+from syntok.segmenter import analyze
+
+from ..utils.json_codec import codec
+
+
+class SentenceCreator:
+
+    def __init__(self, arguments):
+        self.arguments = arguments
+        self.field_mapping = {f: i for i, f in enumerate(self.arguments['fields'])}
+        self.chars_removed_by_flair = re.compile("([\u200c\ufe0f\ufeff])")
+        self.chars_changed_by_flair = re.compile("[\u200b\u200c\ufe0f\ufeff]")  # Sentence.add_token removes these
+        self.error_file = None
+
+    def create_sentences(self, text, identifier):
+        # Without characters that flair removes, tokens can be added as they are and offsets need no correction
+        if self.chars_changed_by_flair.search(text) is None:
+            return self.create_sentences_without_removed_chars(text, identifier)
+        return self.create_sentences_with_removed_chars(text, identifier)
+
+    def create_sentences_without_removed_chars(self, text, identifier):
+        sentence_list = []
+        for syntok_sentence in chain.from_iterable(analyze(text)):
+            manual_sent = Sentence()
+            for token in syntok_sentence:
+                start = token.offset
+                end = start + len(token.value)
+                if text[start:end] != token.value:  # Same check, and report, as when characters are removed
+                    print("Token text" + token.value)
+                    print("Raw text" + text[start:end])
+                    print("Context: " + text[start - 10:end + 10])
+                    print("Remove char count: 0")
+                    print("AssertionError: ")
+                    self.write_error(identifier)
+                    return []
+                manual_sent.add_token(Token(token.value, start_position=start))
+            sentence_list.append(manual_sent)
+        return sentence_list
+
+    def create_sentences_with_removed_chars(self, text, identifier):
+        sentence_list = []
+        for syntok_sentence in chain.from_iterable(analyze(text)):
+            remove_char_counts = []
+            manual_sent = Sentence()
+            for token in syntok_sentence:
+                # Find how much we need to increase the offset by the characters that are removed by flair
+                if len(self.chars_removed_by_flair.sub('', token.value)) > 0:  # Zero length tokens are not added
+                    remove_char_counts.append(len(self.chars_removed_by_flair.findall(token.value)))
+                manual_sent.add_token(Token(token.value, start_position=token.offset))
+            try:
+                assert len(remove_char_counts) == len(manual_sent)  # Ensure offset list is of equal length
+            except AssertionError as e:
+                print("Length offset list: " + str(len(remove_char_counts)))
+                print("Length token list: " + str(len(manual_sent)))
+                print("AssertionError: " + str(e))
+                self.write_error(identifier)
+
+            for i, token in enumerate(manual_sent):
+                start = token.start_pos
+                end = start + len(token.text) + remove_char_counts[i]
+                raw_token_cleaned = self.chars_removed_by_flair.sub('', text[start:end])
+                token.end_pos = end
+                try:  # Especially important that the offset is still correct, the rest can be reconstructed
+                    assert raw_token_cleaned == token.text
+                except AssertionError as e:
+                    print("Token text" + token.text)
+                    print("Raw text" + raw_token_cleaned)
+                    print("Context: " + text[start - 10:end + 10])
+                    print("Remove char count: " + str(remove_char_counts[i]))
+                    print("AssertionError: " + str(e))
+                    # For now ignore this document and store identifier in error file
+                    self.write_error(identifier)
+                    return []
+            sentence_list.append(manual_sent)
+        return sentence_list
+
+    def write_error(self, identifier):
+        if self.error_file is None:
+            self.error_file = open(self.arguments['out_file'][:-8] + '_errors.txt', 'a')
+        self.error_file.write(identifier)
+        self.error_file.write('\n')
+        self.error_file.flush()
+
+    def jsonl_line_to_sentences(self, line):
+        return self.document_to_sentences(codec.loads(line))
+
+    def document_to_sentences(self, json_line):
+        identifier = json_line[self.arguments['identifier']]
+        for field in self.arguments['fields']:
+            raw_text = json_line[field]
+            for sentence_object in self.create_sentences(raw_text, identifier):
+                yield sentence_object, identifier, self.field_mapping[field]
+
+    def tab_sep_line_to_sentences(self, line):
+        identifier, text = line.strip().split('\t')
+        for sentence_object in self.create_sentences(text, identifier):
+            yield sentence_object, identifier, 'body'
+
+    def line_to_sentences(self, line):
+        if self.arguments['file_type'] == 'jsonl':
+            return self.jsonl_line_to_sentences(line)
+        return self.tab_sep_line_to_sentences(line)
+
+
+_worker_sentence_creator = None
+
+
+def _init_worker(arguments):
+    global _worker_sentence_creator
+    _worker_sentence_creator = SentenceCreator(arguments)
+
+
+def _lines_to_sentences(lines):
+    return [(sentence, identifier, field, offset) for offset, line in lines
+            for sentence, identifier, field in _worker_sentence_creator.line_to_sentences(line)]
+
+
+def pooled_sentences_with_id_gen(lines, arguments, workers, chunk_size=16):
+    # Worker processes parse and segment chunks of (offset, line) pairs, at most 2 * workers chunks are in flight so the
+    # reader can not run ahead of the tagger. Results are yielded in input order.
+    context = multiprocessing.get_context('spawn')  # Never fork a process that may hold a CUDA context
+    lines = iter(lines)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker,
+                             initargs=(arguments,)) as executor:
+        in_flight = deque()
+        while True:
+            while len(in_flight) < 2 * workers:
+                chunk = list(islice(lines, chunk_size))
+                if not chunk:
+                    break
+                in_flight.append(executor.submit(_lines_to_sentences, chunk))
+            if not in_flight:
+                return
+            for sentence_with_id in in_flight.popleft().result():
+                yield sentence_with_id
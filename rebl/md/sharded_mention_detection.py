@@ -0,0 +1,115 @@
+import multiprocessing
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import torch
+
+from ..utils import line_aligned_shards
+from ..utils.checkpoint import part_dir, read_checkpoint, remove_parts, write_checkpoint
+from .mention_detection import MentionDetection
+from .mention_writer import MentionParquetWriter
+
+
+def _detect_shard(kwargs, threads):
+    torch.set_num_threads(threads)
+    torch.set_num_interop_threads(1)
+    MentionDetection(**kwargs).write_batches_to_parquet()
+
+
+class ShardedMentionDetection:
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self.arguments = self.get_arguments(kwargs)
+        self.out_file = self.arguments['out_file']
+        self.checkpoint_file = self.out_file[:-8] + '_checkpoint.json'
+
+    def part_file(self, i):
+        return self.out_file[:-8] + f'_part{i}.parquet'
+
+    def write_batches_to_parquet(self):
+        checkpoint = read_checkpoint(self.checkpoint_file) if self.arguments['cont'] else None
+        if checkpoint is not None and checkpoint['in_file'] != self.arguments['in_file']:
+            raise IOError(f'Checkpoint {self.checkpoint_file} belongs to in_file {checkpoint["in_file"]}, not '
+                          f'{self.arguments["in_file"]}; use another out_file or --cont False')
+        if checkpoint is not None and checkpoint['finished'] and os.path.isfile(self.out_file):
+            print(f'{self.out_file} is already finished', flush=True)
+            return
+        shards = line_aligned_shards(self.arguments['in_file'], int(self.arguments['workers']),
+                                     self.arguments['gzip_index'])
+        for i, (start, end) in enumerate(shards):
+            self.discard_other_part(i, start, end)
+        threads = self.arguments['threads_per_worker']
+        threads = int(threads) if threads is not None else max(1, os.cpu_count() // len(shards))
+        # Every worker loads its own model, spawn makes sure no torch or CUDA state is shared with the parent
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=len(shards), mp_context=context) as executor:
+            futures = []
+            for i, (start, end) in enumerate(shards):
+                kwargs = dict(self.kwargs, out_file=self.part_file(i), start_at=start, stop_at=end)
+                futures.append(executor.submit(_detect_shard, kwargs, threads))
+            for future in futures:
+                future.result()
+        self.merge(len(shards))
+
+    def discard_other_part(self, i, start, end):
+        # A part of a run with another number of workers covers another range of the input, it starts over
+        part_checkpoint = read_checkpoint(self.part_file(i)[:-8] + '_checkpoint.json')
+        if part_checkpoint is None or (part_checkpoint['in_file'], part_checkpoint.get('start_at'),
+                                       part_checkpoint.get('stop_at')) == (self.arguments['in_file'], start, end):
+            return
+        print(f'{self.part_file(i)} covers another part of the input, starting it over', flush=True)
+        for suffix in ['.parquet', '_checkpoint.json']:
+            if os.path.isfile(self.part_file(i)[:-8] + suffix):
+                os.remove(self.part_file(i)[:-8] + suffix)
+        remove_parts(part_dir(self.part_file(i)))
+
+    def merge(self, parts):
+        # Parts are copied row group by row group in input order, the parts cover consecutive ranges of the input
+        field_type = pa.int64() if self.arguments['file_type'] == 'jsonl' else pa.string()
+        rows, row_groups = 0, 0
+        with MentionParquetWriter(self.out_file, field_type=field_type) as writer:
+            for i in range(parts):
+                parquet_file = pq.ParquetFile(self.part_file(i))
+                for j in range(parquet_file.metadata.num_row_groups):
+                    table = parquet_file.read_row_group(j)
+                    writer.write_table(table)
+                    rows += table.num_rows
+                    row_groups += 1
+        for suffix in ['_errors.txt', '_memory_problem.txt']:
+            for i in range(parts):
+                part = self.part_file(i)[:-8] + suffix
+                if os.path.isfile(part):
+                    with open(part, 'rb') as source, open(self.out_file[:-8] + suffix, 'ab') as target:
+                        shutil.copyfileobj(source, target)
+                    os.remove(part)
+        os.replace(self.part_file(0)[:-8] + '_field_mapping.parquet', self.out_file[:-8] + '_field_mapping.parquet')
+        for i in range(parts):
+            for suffix in ['.parquet', '_field_mapping.parquet', '_checkpoint.json']:
+                if os.path.isfile(self.part_file(i)[:-8] + suffix):
+                    os.remove(self.part_file(i)[:-8] + suffix)
+        write_checkpoint(self.checkpoint_file, in_file=self.arguments['in_file'], offset=None, last_document=None,
+                         rows=rows, row_groups=row_groups, finished=True)
+
+    @staticmethod
+    def get_arguments(kwargs):
+        arguments = {
+            'in_file': None,
+            'out_file': None,
+            'file_type': 'jsonl',
+            'cont': True,
+            'workers': '1',
+            'threads_per_worker': None,
+            'gzip_index': None
+        }
+        for key, item in arguments.items():
+            if kwargs.get(key) is not None:
+                arguments[key] = kwargs.get(key)
+        if arguments['in_file'] is None:
+            raise IOError('in_file needs to be provided')
+        if arguments['out_file'] is None:
+            raise IOError('out_file path needs to be provided')
+        return arguments
@@ -0,0 +1,79 @@
+import hashlib
+import json
+import sqlite3
+from collections import OrderedDict, namedtuple
+
+CachedSpan = namedtuple('CachedSpan', ['text', 'start_pos', 'end_pos', 'score', 'tag'])
+
+
+class TaggerCache:
+
+    def __init__(self, max_size, cache_file=None):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.counters = {'hits': 0, 'disk_hits': 0, 'misses': 0}
+        self.db = None
+        if cache_file is not None:  # Shared between runs (and shards), so repeated text is tagged once overall
+            self.db = sqlite3.connect(cache_file, timeout=60)
+            # With a write ahead log readers never wait for a writer, and every writer only holds the lock for the
+            # commit of one batch, see commit
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS spans (key BLOB PRIMARY KEY, spans TEXT)')
+            self.db.commit()
+
+    @staticmethod
+    def key(sentence):
+        # The tagger only sees the token texts, so sentences with the same tokens get the same predictions
+        return hashlib.blake2b('\x1f'.join(token.text for token in sentence).encode('utf-8'), digest_size=16).digest()
+
+    @staticmethod
+    def relative_spans(sentence):
+        # Spans as token indices, so they can be moved to any sentence with the same tokens
+        return [(span.tokens[0].idx - 1, span.tokens[-1].idx - 1, span.tag, span.score)
+                for span in sentence.get_spans('ner')]
+
+    @staticmethod
+    def absolute_spans(sentence, spans):
+        return [CachedSpan(' '.join(token.text for token in sentence.tokens[first:last + 1]),
+                           sentence.tokens[first].start_pos, sentence.tokens[last].end_pos, score, tag)
+                for first, last, tag, score in spans]
+
+    def get(self, key):
+        if key in self.entries:
+            self.counters['hits'] += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        if self.db is not None:
+            row = self.db.execute('SELECT spans FROM spans WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                self.counters['disk_hits'] += 1
+                spans = [tuple(span) for span in json.loads(row[0])]
+                self.put(key, spans, store=False)
+                return spans
+        self.counters['misses'] += 1
+        return None
+
+    def put(self, key, spans, store=True):
+        self.entries[key] = spans
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        if store and self.db is not None:
+            self.db.execute('INSERT OR IGNORE INTO spans VALUES (?, ?)', (key, json.dumps(spans)))
+
+    def commit(self):
+        # Called after every predicted batch, an open write transaction would lock out the other shards
+        if self.db is not None:
+            self.db.commit()
+
+    def close(self):
+        if self.db is not None:
+            self.db.commit()
+            self.db.close()
+            self.db = None
+
+    def report(self):
+        lookups = sum(self.counters.values())
+        hit_rate = (self.counters['hits'] + self.counters['disk_hits']) / lookups if lookups else 0.
+        counters = '; '.join(f'{key}: {value}' for key, value in self.counters.items())
+        return f'{counters}; hit rate: {hit_rate:.4f}'
@@ -0,0 +1,3 @@
+from .fused_pipeline import FusedPipeline
+
+__all__ = ['FusedPipeline']
@@ -0,0 +1,419 @@
+import argparse
+import os
+import queue
+import threading
+import time
+from collections import deque
+
+import pyarrow as pa
+
+from ..ed.entity_disambiguation import EntityDisambiguation
+from ..ed.entity_writer import EntityParquetWriter
+from ..md.mention_detection import MentionDetection
+from ..md.mention_writer import MentionParquetWriter
+from ..utils.checkpoint import exit_on_sigterm
+from ..utils.json_codec import codec
+
+_DONE = object()
+
+
+class _Failure:
+
+    def __init__(self, exception):
+        self.exception = exception
+
+
+def _run_stage(gen, out_queue, cancelled):
+    # Puts everything the generator yields on the bounded queue, a full queue blocks the stage until the next stage
+    # catches up. An exception is passed on to the consuming stage. Once cancelled the generator is closed, so its
+    # cleanup runs in this thread.
+    try:
+        for item in gen:
+            if cancelled.is_set():
+                break
+            out_queue.put(item)
+    except BaseException as e:
+        out_queue.put(_Failure(e))
+    finally:
+        gen.close()
+        out_queue.put(_DONE)
+
+
+def _cancel_stage(in_queue, cancelled):
+    # Stops a producing stage that may be blocked on its full queue
+    cancelled.set()
+    while in_queue.get() is not _DONE:
+        pass
+
+
+def _run_sink(consume, in_queue, errors):
+    # Consumes the queue until the end, after an exception the rest is discarded so the producing stage never blocks
+    try:
+        consume(_drain(in_queue))
+    except BaseException as e:
+        errors.append(e)
+        while in_queue.get() is not _DONE:
+            pass
+
+
+def _drain(in_queue):
+    while True:
+        item = in_queue.get()
+        if item is _DONE:
+            return
+        if isinstance(item, _Failure):
+            raise item.exception
+        yield item
+
+
+class _DocumentMentionDetection(MentionDetection):
+    # Keeps the documents it reads in input order, so the ed stage gets them without reading the input again. JSONL
+    # documents parsed in this process are kept parsed, the others as their line.
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.documents = deque()
+
+    def offset_line_gen(self):
+        for offset, line in super().offset_line_gen():
+            self.documents.append((offset, line))
+            yield offset, line
+
+    def jsonl_to_sentences_with_id_gen(self):
+        for offset, line in self.offset_line_gen():
+            document = codec.loads(line)
+            self.documents[-1] = (offset, document)
+            for sentence_object, identifier, field in self.sentence_creator.document_to_sentences(document):
+                yield sentence_object, identifier, field, offset
+
+
+class _StreamingEntityDisambiguation(EntityDisambiguation):
+    # The mentions come straight from mention detection in document order, so there is no md file to sort and no
+    # docid index to build
+
+    def get_ids(self):
+        return None
+
+    def set_document_range(self, start_doc=0, stop_doc=None):
+        self.start_doc = start_doc
+        self.stop_doc = stop_doc
+
+
+class FusedPipeline:
+
+    def __init__(self, **kwargs):
+        self.arguments = self.get_arguments(kwargs)
+        self.out_file = self.arguments['out_file']
+        self.md_out_file = self.arguments['md_out_file']
+        md_file = self.md_out_file or self.out_file[:-8] + '_md.parquet'  # Also names the md error files
+        # The tagger is loaded in the md stage, sqlite connections can only be used in the thread that opened them
+        self.md_arguments = MentionDetection.get_arguments(dict(kwargs, out_file=md_file, cont=False))
+        self.md = None
+        self.fields = self.md_arguments['fields'] if self.md_arguments['file_type'] == 'jsonl' else ['body']
+        self.ed = _StreamingEntityDisambiguation(**dict(kwargs, md_file=md_file, source_file=self.arguments['in_file'],
+                                                        fields=self.fields, fields_file=None, cont=False))
+        self.fields_inverted = {field: i for i, field in enumerate(self.fields)}
+        self.docs_done = 0
+
+    def mention_groups(self):
+        # MD stage: tags the input and yields (offset, identifier, document, mentions) per document with mentions, in
+        # input order. The md output is written on the side when asked for.
+        # The tagger cache is opened and closed in this thread.
+        self.md = _DocumentMentionDetection(**self.md_arguments)
+        writer = None
+        try:
+            if self.md_out_file is not None:
+                self.md.write_field_mapping()
+                field_type = pa.int64() if self.md_arguments['file_type'] == 'jsonl' else pa.string()
+                writer = MentionParquetWriter(self.md_out_file, field_type=field_type)
+            write_batch_size = int(self.md_arguments['write_batch_size'])
+            current_offset, current_identifier, mentions = None, None, []
+            for entity, identifier, field, offset in self.md.sentence_to_mentions_gen():
+                if offset != current_offset:
+                    if mentions:
+                        yield current_offset, current_identifier, self.document(current_offset), mentions
+                    if writer is not None and len(writer) >= write_batch_size:
+                        writer.flush()
+                    current_offset, current_identifier, mentions = offset, identifier, []
+                mentions.append((field, entity.start_pos, entity.end_pos, entity.score, entity.tag))
+                if writer is not None:
+                    writer.append(identifier, field, entity.text, entity.start_pos, entity.end_pos, entity.score,
+                                  entity.tag)
+            if mentions:
+                yield current_offset, current_identifier, self.document(current_offset), mentions
+            self.docs_done += len(self.md.documents)  # The documents after the last one with mentions
+            self.md.documents.clear()
+            if writer is not None:
+                writer.close()
+                writer = None
+        finally:
+            if writer is not None:  # Failed or cancelled, a partial md output is of no use without checkpoints
+                writer.writer.close()
+                os.remove(self.md_out_file)
+            if self.md.tagger_cache is not None:
+                self.md.tagger_cache.close()
+
+    def document(self, offset):
+        # The document at offset, the documents before it have no mentions and are done as well
+        while True:
+            document_offset, document = self.md.documents.popleft()
+            self.docs_done += 1
+            if document_offset == offset:
+                return document
+
+    def units(self, groups):
+        # Same units as EntityDisambiguation.stream_units, keyed on (offset, field_key), spans sorted per field
+        for offset, identifier, json_content, mentions in groups:
+            if isinstance(json_content, str):  # Read by the preprocess workers of the md stage
+                json_content = self.ed.parse_document(json_content)
+            per_field = {}
+            for field, start_pos, end_pos, score, tag in sorted(mentions, key=lambda m: m[:2]):
+                field_key = field if isinstance(field, int) else self.fields_inverted[field]
+                per_field.setdefault(field_key, []).append((start_pos, end_pos, score, tag))
+            for field_key in sorted(per_field):
+                spans = [(start_pos, end_pos - start_pos) for start_pos, end_pos, _, __ in per_field[field_key]]
+                tags = [tag for _, __, ___, tag in per_field[field_key]]
+                scores = [score for _, __, score, ___ in per_field[field_key]]
+                text = json_content.get(self.fields[field_key], '')
+                yield (offset, field_key), identifier, text, spans, tags, scores
+
+    def disambiguated(self, groups):
+        # ED stage: REL predicts every document as its own minibatch, so every field is disambiguated on its own
+        for key, identifier, text, spans, tags, scores in self.units(groups):
+            yield list(self.ed.split_results([(key, text, spans, tags, scores)], [identifier]))
+
+    def write_results(self, results_gen):
+        # Writer stage, row groups are cut at the start of the next document as in EntityDisambiguation.process
+        # A failure of an earlier stage arrives through results_gen, the partial output is then removed
+        write_batch_size = int(self.ed.arguments['write_batch_size'])
+        t = time.time()
+        writer = EntityParquetWriter(self.out_file)
+        try:
+            last_document = None
+            for results in results_gen:
+                for (offset, field_key), identifier, result in results:
+                    if offset != last_document and len(writer) >= write_batch_size:
+                        writer.flush()
+                        batch_time = time.time() - t
+                        print(f'Documents finished: {self.docs_done}; Batch time: {batch_time:.2f} seconds',
+                              flush=True)
+                        t = time.time()
+                    last_document = offset
+                    doc_id = str(identifier)
+                    for start_pos, span, text, entity, ed_score, tag, md_score in result:
+                        writer.append(doc_id, field_key, start_pos, start_pos + span, entity, ed_score, tag, md_score)
+        except BaseException:
+            writer.writer.close()
+            os.remove(self.out_file)
+            raise
+        writer.close()
+
+    def process(self):
+        # The md stage and the writer run in their own threads, connected to the ed stage by bounded queues. ed runs
+        # in this thread, which opened the sqlite databases of REL.
+        queue_size = int(self.arguments['queue_size'])
+        group_queue, result_queue = queue.Queue(queue_size), queue.Queue(queue_size)
+        writer_errors = []
+        md_cancelled = threading.Event()
+        md_stage = threading.Thread(target=_run_stage, args=(self.mention_groups(), group_queue, md_cancelled),
+                                    daemon=True)
+        writer_stage = threading.Thread(target=_run_sink, args=(self.write_results, result_queue, writer_errors),
+                                        daemon=True)
+        md_stage.start()
+        writer_stage.start()
+        md_done = False
+        try:
+            for results in self.disambiguated(_drain(group_queue)):
+                if writer_errors:  # The writer discards everything after its failure, stop disambiguating
+                    break
+                result_queue.put(results)
+            else:
+                md_done = True
+        except BaseException as e:
+            result_queue.put(_Failure(e))
+            raise
+        finally:
+            result_queue.put(_DONE)
+            writer_stage.join()
+            if not md_done:
+                _cancel_stage(group_queue, md_cancelled)
+            md_stage.join()
+        if writer_errors:
+            raise writer_errors[0]
+        print(f'Adaptive batching: {self.md.batch_controller.report()}', flush=True)
+        if self.md.tagger_cache is not None:
+            print(f'Tagger cache: {self.md.tagger_cache.report()}', flush=True)
+        if self.ed.candidate_cache is not None:
+            print(f'Candidate cache: {self.ed.candidate_cache.report()}', flush=True)
+            if self.ed.arguments['candidate_cache_file'] is not None:
+                self.ed.candidate_cache.save(self.ed.arguments['candidate_cache_file'])
+
+    @staticmethod
+    def get_arguments(kwargs):
+        arguments = {
+            'in_file': None,
+            'out_file': None,
+            'md_out_file': None,
+            'base_url': None,
+            'wiki_version': None,
+            'queue_size': '64'
+        }
+        for key, item in arguments.items():
+            if kwargs.get(key) is not None:
+                arguments[key] = kwargs.get(key)
+        for key in ['in_file', 'out_file', 'base_url', 'wiki_version']:
+            if arguments[key] is None:
+                raise IOError(f'Argument {key} needs to be provided')
+        return arguments
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-i',
+        '--in_file',
+        required=True,
+        help='Name of the JSONL file to tag'
+    )
+    parser.add_argument(
+        '-o',
+        '--out_file',
+        required=True,
+        help='Name of the ed parquet file to write to'
+    )
+    parser.add_argument(
+        '-mo',
+        '--md_out_file',
+        help='Also write the md parquet file, with its field mapping, under this name'
+    )
+    parser.add_argument(
+        '-b',
+        '--base_url',
+        required=True,
+        help='Location of base_url for REL ED model'
+    )
+    parser.add_argument(
+        '-w',
+        '--wiki_version',
+        required=True,
+        help='Wikipedia version to use'
+    )
+    parser.add_argument(
+        '-t',
+        '--tagger',
+        help='Tagger that is used, default is ner-fast',
+        default='ner-fast'
+    )
+    parser.add_argument(
+        '-f',
+        '--fields',
+        nargs='*',
+        help='Fields to tag and disambiguate',
+        default=['title', 'headings', 'body']
+    )
+    parser.add_argument(
+        '-id',
+        '--identifier',
+        help='field key to identify document',
+        default='docid'
+    )
+    parser.add_argument(
+        '-ft',
+        '--file_type',
+        choices=['jsonl', 'tsv'],
+        help='What is the input file format',
+        default='jsonl'
+    )
+    parser.add_argument(
+        '-pb',
+        '--predict_batch_size',
+        help='How many Sentences to tag at once',
+        default='100'
+    )
+    parser.add_argument(
+        '-wb',
+        '--write_batch_size',
+        help='Number of rows per row group in the output files',
+        default='10000'
+    )
+    parser.add_argument(
+        '-pw',
+        '--preprocess_workers',
+        help='Number of processes that parse and segment documents for the tagger, 0 does this in process',
+        default='0'
+    )
+    parser.add_argument(
+        '-bm',
+        '--batching',
+        choices=['count', 'tokens'],
+        help='Cut tagger batches by sentence count, or by token budget on sentences bucketed by length',
+        default='count'
+    )
+    parser.add_argument(
+        '-tb',
+        '--token_budget',
+        help='Maximum number of (padded) tokens in a batch when batching on tokens',
+        default='5000'
+    )
+    parser.add_argument(
+        '-bw',
+        '--bucket_window',
+        help='Number of consecutive sentences that are bucketed by length when batching on tokens',
+        default='2000'
+    )
+    parser.add_argument(
+        '-co',
+        '--cpu_optimized',
+        action='store_true',
+        help='Tag on cpu with a dynamically int8 quantized tagger in inference mode'
+    )
+    parser.add_argument(
+        '-it',
+        '--intra_op_threads',
+        help='Number of intra-op torch threads in cpu optimized mode, default is the torch default',
+        default=None
+    )
+    parser.add_argument(
+        '-io',
+        '--inter_op_threads',
+        help='Number of inter-op torch threads in cpu optimized mode',
+        default=1
+    )
+    parser.add_argument(
+        '-ts',
+        '--tagger_cache_size',
+        help='Number of sentences whose tagger results are cached in memory (LRU), 0 disables the cache',
+        default='0'
+    )
+    parser.add_argument(
+        '-tf',
+        '--tagger_cache_file',
+        help='Sqlite file that keeps the cached tagger results across runs and shards',
+        default=None
+    )
+    parser.add_argument(
+        '-cs',
+        '--candidate_cache_size',
+        help='Number of mentions whose normalized form and candidates are kept in an LRU cache, 0 disables the cache',
+        default='100000'
+    )
+    parser.add_argument(
+        '-cf',
+        '--candidate_cache_file',
+        help='File the candidate cache is loaded from at startup and saved to at the end, to warm up later shards'
+    )
+    parser.add_argument(
+        '-me',
+        '--mapped_embeddings',
+        action='store_true',
+        help='Look up embeddings in the memory mapped export of python -m rebl.ed.embedding_store instead of sqlite'
+    )
+    parser.add_argument(
+        '-qs',
+        '--queue_size',
+        help='Maximum number of documents (md to ed) and disambiguated batches (ed to writer) waiting between stages',
+        default='64'
+    )
+    args = parser.parse_args()
+    exit_on_sigterm()
+    FusedPipeline(**vars(args)).process()
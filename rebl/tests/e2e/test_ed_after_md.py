@@ -27,6 +27,7 @@ def test_md_and_ed(tmp_path):
     out_file_ed = str(tmp_path) + '/ed_output.parquet'
     in_file_ed = out_file_md
     ed_f = EntityDisambiguation(md_file=in_file_ed, fields=_fields, source_file=in_file_md, out_file=out_file_ed,
-                                base_url=_base_url, wiki_version=_wiki_version)
+                                base_url=_base_url, wiki_version=_wiki_version,
+                                docid_index=str(tmp_path) + '/docid_index')
     ed_f.process()
     assert list(pq.read_table(out_file_ed).to_pandas()['entity']) == ['Fox', 'Fox', 'Fox']
@@ -0,0 +1,98 @@
+from os import path
+
+import pyarrow.parquet as pq
+
+from ...ed import EntityDisambiguation
+from ...md import MentionDetection
+from ...pipeline import FusedPipeline
+
+_in_file = path.dirname(path.dirname(__file__)) + \
+           '/resources/md/hard_examples_with_expected_output/example_docs_20.txt.gz'
+_fields = ['title', 'headings', 'body']
+_base_url = path.dirname(path.dirname(__file__)) + f'/resources/ed/'
+_wiki_version = 'wiki_test'
+
+
+def test_fused_equals_two_stages(tmp_path):
+    md_file = str(tmp_path) + '/md.parquet'
+    MentionDetection(in_file=_in_file, out_file=md_file, fields=_fields).write_batches_to_parquet()
+    ed_file = str(tmp_path) + '/ed.parquet'
+    EntityDisambiguation(md_file=md_file, fields=_fields, source_file=_in_file, out_file=ed_file, base_url=_base_url,
+                         wiki_version=_wiki_version, docid_index=str(tmp_path) + '/index').process()
+
+    fused_file = str(tmp_path) + '/fused.parquet'
+    fused_md_file = str(tmp_path) + '/fused_md.parquet'
+    pipeline = FusedPipeline(in_file=_in_file, out_file=fused_file, md_out_file=fused_md_file, fields=_fields,
+                             base_url=_base_url, wiki_version=_wiki_version, queue_size='2')
+    pipeline.process()
+    assert pipeline.docs_done == 20  # Also the documents without mentions
+    assert pq.read_table(ed_file).num_rows > 0
+    assert pq.read_table(fused_file).to_pydict() == pq.read_table(ed_file).to_pydict()
+    assert pq.read_table(fused_md_file).equals(pq.read_table(md_file))
+    assert path.isfile(str(tmp_path) + '/fused_md_field_mapping.parquet')
+    # Without md_out_file only the ed output is written, documents parsed by preprocess workers arrive as their line
+    FusedPipeline(in_file=_in_file, out_file=str(tmp_path) + '/only_ed.parquet', fields=_fields, base_url=_base_url,
+                  wiki_version=_wiki_version, preprocess_workers='2').process()
+    assert pq.read_table(str(tmp_path) + '/only_ed.parquet').to_pydict() == pq.read_table(ed_file).to_pydict()
+    assert not path.isfile(str(tmp_path) + '/only_ed_md.parquet')
+
+
+def test_stage_failure_is_raised(tmp_path):
+    pipeline = FusedPipeline(in_file=_in_file, out_file=str(tmp_path) + '/fused.parquet', fields=['no_such_field'],
+                             base_url=_base_url, wiki_version=_wiki_version)
+    try:
+        pipeline.process()
+        raise AssertionError('Should raise the KeyError of the md stage')
+    except KeyError:
+        pass
+
+
+def test_ed_failure_removes_partial_output(tmp_path):
+    out_file, md_out_file = str(tmp_path) + '/fused.parquet', str(tmp_path) + '/fused_md.parquet'
+    pipeline = FusedPipeline(in_file=_in_file, out_file=out_file, md_out_file=md_out_file, fields=_fields,
+                             base_url=_base_url, wiki_version=_wiki_version, queue_size='1',
+                             write_batch_size='1', tagger_cache_size='1000',
+                             tagger_cache_file=str(tmp_path) + '/tagger_cache.db')
+    split_results = pipeline.ed.split_results
+    calls = []
+
+    def failing_split_results(units, identifiers):
+        calls.append(len(units))
+        if len(calls) == 3:
+            raise ValueError('ed failed')
+        return split_results(units, identifiers)
+
+    pipeline.ed.split_results = failing_split_results
+    try:
+        pipeline.process()
+        raise AssertionError('Should raise the ValueError of the ed stage')
+    except ValueError:
+        pass
+    # The md stage was cancelled and closed its tagger cache, the writer removed the partial outputs
+    assert pipeline.md.tagger_cache.db is None
+    assert not path.isfile(out_file) and not path.isfile(md_out_file)
+
+
+def test_writer_failure_stops_ed(tmp_path):
+    pipeline = FusedPipeline(in_file=_in_file, out_file=str(tmp_path) + '/fused.parquet', fields=_fields,
+                             base_url=_base_url, wiki_version=_wiki_version, queue_size='1')
+    split_results = pipeline.ed.split_results
+    calls = []
+
+    def counted_split_results(units, identifiers):
+        calls.append(len(units))
+        return split_results(units, identifiers)
+
+    def failing_write_results(results_gen):
+        next(results_gen)
+        raise OSError('disk full')
+
+    pipeline.ed.split_results = counted_split_results
+    pipeline.write_results = failing_write_results
+    try:
+        pipeline.process()
+        raise AssertionError('Should raise the OSError of the writer')
+    except OSError:
+        pass
+    # Only the batches that were under way when the writer failed are disambiguated
+    assert len(calls) <= 4
@@ -0,0 +1,45 @@
+from os import path
+
+from REL.mention_detection import MentionDetection
+
+from ...ed.candidate_cache import CachedMentionDetection, CandidateCache
+
+_base_url = path.dirname(path.dirname(__file__)) + f'/resources/ed/'
+_wiki_version = 'wiki_test'
+
+
+def test_lru_eviction():
+    cache = CandidateCache(2)
+    cache.put(('mention', 'a'), 'A')
+    cache.put(('mention', 'b'), 'B')
+    assert cache.get(('mention', 'a')) == 'A'  # b is now the least recently used
+    cache.put(('mention', 'c'), 'C')
+    assert cache.get(('mention', 'b')) is None
+    assert cache.get(('mention', 'c')) == 'C'
+    assert cache.counters == {'hits': 2, 'misses': 1}
+
+
+def test_warm_cache_file(tmp_path):
+    cache_file = str(tmp_path) + '/candidates.jsonl'
+    cache = CandidateCache(10)
+    cache.put(('mention', 'fox'), 'Fox')
+    cache.put(('candidates', 'Fox'), [['Fox', 0.9], ['Fox_News', 0.1]])
+    cache.save(cache_file)
+    warm = CandidateCache(10, cache_file)
+    assert warm.entries == cache.entries
+    assert warm.get(('candidates', 'Fox')) == [['Fox', 0.9], ['Fox_News', 0.1]]
+    # Only the most recently used entries are kept when the cache is smaller
+    assert list(CandidateCache(1, cache_file).entries) == [('candidates', 'Fox')]
+
+
+def test_same_candidates_as_rel():
+    cache = CandidateCache(100)
+    cached = CachedMentionDetection(_base_url, _wiki_version, cache)
+    plain = MentionDetection(_base_url, _wiki_version)
+    processed = {'a': ['the brown fox jumped over the lazy dog', [(10, 3), (30, 4)]],
+                 'b': ['a fox and a dog', [(2, 3), (12, 3)]]}
+    assert cached.format_spans(processed) == plain.format_spans(processed)
+    misses = cache.counters['misses']
+    assert cached.format_spans(processed) == plain.format_spans(processed)
+    assert cache.counters['misses'] == misses
+    assert cache.counters['hits'] > 0
@@ -0,0 +1,61 @@
+import shutil
+import sqlite3
+from os import path
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from REL.db.generic import GenericLookup
+
+from ...ed import EntityDisambiguation, embedding_store
+from ...ed.embedding_store import MappedEmbeddings, embedding_db_files, export_embeddings
+
+_base_url = path.dirname(path.dirname(__file__)) + f'/resources/ed/'
+_wiki_version = 'wiki_test'
+
+
+def test_same_embeddings_as_sqlite(tmp_path):
+    for i, db_file in enumerate(embedding_db_files(_base_url, _wiki_version)):
+        out_dir = export_embeddings(db_file, out_dir=str(tmp_path) + f'/store{i}')
+        store = MappedEmbeddings.load(db_file, out_dir)
+        words = [word for word, in sqlite3.connect(db_file).execute('SELECT word FROM embeddings')]
+        assert len(store) == len(words)
+        lookup = GenericLookup(path.basename(db_file)[:-3], path.dirname(db_file))
+        queries = words + ['not a word', words[0].upper() + 'x']
+        for mapped, stored in zip(store.emb(set(queries), 'embeddings'), lookup.emb(set(queries), 'embeddings')):
+            assert (mapped is None and stored is None) or (mapped == stored).all()
+        assert store.emb(['not a word']) == [None]
+
+
+def test_hash_collisions(tmp_path, monkeypatch):
+    # A hash of one byte makes most words collide, rows are then found by comparing the words
+    monkeypatch.setattr(embedding_store, 'key_hash', lambda word: len(word.encode('utf-8')) % 4)
+    db_file = embedding_db_files(_base_url, _wiki_version)[1]
+    store = MappedEmbeddings.load(db_file, export_embeddings(db_file, out_dir=str(tmp_path) + '/store'))
+    words = [word for word, in sqlite3.connect(db_file).execute('SELECT word FROM embeddings')]
+    queries = words + ['not a word', 'x' * 5]
+    rows = store.lookup_rows(queries)
+    assert [store.key(row) for row in rows[:len(words)]] == words
+    assert rows[len(words):].tolist() == [-1, -1]
+
+
+def test_disambiguation_with_mapped_embeddings(tmp_path):
+    base_url = str(tmp_path) + '/base/'
+    shutil.copytree(_base_url, base_url)
+    for db_file in embedding_db_files(base_url, _wiki_version):
+        export_embeddings(db_file)
+    source_file = str(tmp_path) + '/docs.jsonl'
+    with open(source_file, 'w') as f:
+        f.write('{"docid": "a", "body": "the brown fox jumped over the lazy dog"}\n')
+    md_file = str(tmp_path) + '/md.parquet'
+    pq.write_table(pa.table({'identifier': ['a', 'a'], 'field': [0, 0], 'text': ['fox', 'lazy dog'],
+                             'start_pos': [10, 30], 'end_pos': [13, 38], 'score': [.9, .8], 'tag': ['PER', 'LOC']}),
+                   md_file)
+    tables = []
+    for mapped_embeddings in [False, True]:
+        out_file = str(tmp_path) + f'/ed_{mapped_embeddings}.parquet'
+        ed_f = EntityDisambiguation(md_file=md_file, fields=['body'], source_file=source_file, out_file=out_file,
+                                    base_url=base_url, wiki_version=_wiki_version, mapped_embeddings=mapped_embeddings)
+        ed_f.process()
+        tables.append(pq.read_table(out_file))
+    assert tables[1].column('entity').to_pylist() == ['Fox']
+    assert tables[0].equals(tables[1])
@@ -1,8 +1,13 @@
+import json
+import shutil
 from os import path
 
+import pyarrow as pa
 import pyarrow.parquet as pq
 
-from ...ed import EntityDisambiguation
+from ...ed import EntityDisambiguation, ParallelEntityDisambiguation
+from ...ed.embedding_store import embedding_db_files, export_embeddings
+from ...ed.entity_writer import entity_schema
 
 _md = path.dirname(path.dirname(__file__)) + \
       f'/resources/md/hard_examples_with_expected_output/example_docs_20_md.parquet'
@@ -15,40 +20,277 @@ _base_url = path.dirname(path.dirname(__file__)) + f'/resources/ed/'
 _wiki_version = 'wiki_test'
 
 
-def test_one_type_of_file_parameter():
+def _source(tmp_path):
+    # The docid index of the bundled source file is built under tmp_path instead of next to it
+    return dict(source_file=_source_file, docid_index=str(tmp_path) + '/docid_index')
+
+
+def test_one_type_of_file_parameter(tmp_path):
     # Both fields_file and fields
     try:
-        EntityDisambiguation(md_file=_md, fields_file=_fields_file, fields=_fields, source_file=_source_file,
+        EntityDisambiguation(md_file=_md, fields_file=_fields_file, fields=_fields, **_source(tmp_path),
                              out_file=_out_file, base_url=_base_url, wiki_version=_wiki_version)
         raise AssertionError("Should raise error as both fields_file and fields are provided")
     except IOError:
         pass
     # Only fields should not raise error
-    EntityDisambiguation(md_file=_md, fields=_fields, source_file=_source_file, out_file=_out_file, base_url=_base_url,
+    EntityDisambiguation(md_file=_md, fields=_fields, **_source(tmp_path), out_file=_out_file, base_url=_base_url,
                          wiki_version=_wiki_version)
     # Only fields_file should not raise error
-    EntityDisambiguation(md_file=_md, fields_file=_fields_file, source_file=_source_file, out_file=_out_file,
+    EntityDisambiguation(md_file=_md, fields_file=_fields_file, **_source(tmp_path), out_file=_out_file,
                          base_url=_base_url, wiki_version=_wiki_version)
     # Neither
     try:
-        EntityDisambiguation(md_file=_md, source_file=_source_file, out_file=_out_file, base_url=_base_url,
+        EntityDisambiguation(md_file=_md, **_source(tmp_path), out_file=_out_file, base_url=_base_url,
                              wiki_version=_wiki_version)
         raise AssertionError("Should raise error as neither fields_file or fields are provided")
     except IOError:
         pass
 
 
-def test_create_fields():
-    ed_ff = EntityDisambiguation(md_file=_md, fields_file=_fields_file, source_file=_source_file, out_file=_out_file,
+def test_create_fields(tmp_path):
+    ed_ff = EntityDisambiguation(md_file=_md, fields_file=_fields_file, **_source(tmp_path), out_file=_out_file,
                                  base_url=_base_url, wiki_version=_wiki_version)
-    ed_f = EntityDisambiguation(md_file=_md, fields=_fields, source_file=_source_file, out_file=_out_file,
+    ed_f = EntityDisambiguation(md_file=_md, fields=_fields, **_source(tmp_path), out_file=_out_file,
                                 base_url=_base_url, wiki_version=_wiki_version)
     assert ed_ff.fields == ed_f.fields == {0: 'title', 1: 'headings', 2: 'body'}
 
 
 def test_disambiguate(tmp_path):
-    ed_f = EntityDisambiguation(md_file=_md, fields=_fields, source_file=_source_file, out_file=str(tmp_path)+_out_file,
+    ed_f = EntityDisambiguation(md_file=_md, fields=_fields, **_source(tmp_path), out_file=str(tmp_path)+_out_file,
                                 base_url=_base_url, wiki_version=_wiki_version)
     link = ed_f.disambiguate("test", "body", [(10, 3), (17, 11)], "the brown fox jumped over the lazy dog",
                              ["PER", "PER"], [0.9, 0.8],)
     assert link == {"test+body": [(10, 3, "fox", "Fox", 0.0, "PER", 0.9)]}
+
+
+def test_stream_doc_with_spans(tmp_path):
+    # Identifiers that are not sorted, tab separated as well as JSON with integer identifiers
+    sources = {
+        'docs.tsv': ['b12\tthe brown fox\n', 'a7\tthe lazy dog\n', 'c3\tno mentions\n'],
+        'docs.jsonl': [json.dumps({'docid': docid, 'body': body}) + '\n'
+                       for docid, body in [(12, 'the brown fox'), (7, 'the lazy dog'), (3, 'no mentions')]]
+    }
+    for file_name, lines in sources.items():
+        source_file = str(tmp_path) + '/' + file_name
+        with open(source_file, 'w') as f:
+            f.writelines(lines)
+        identifiers = [line.split('\t')[0] if '\t' in line else str(json.loads(line)['docid']) for line in lines]
+        md_file = str(tmp_path) + '/md.parquet'
+        pq.write_table(pa.table({
+            'identifier': [identifiers[1], identifiers[0], identifiers[1]],
+            'field': ['body'] * 3,
+            'text': ['dog', 'fox', 'lazy'],
+            'start_pos': [9, 10, 4],
+            'end_pos': [12, 13, 8],
+            'score': [.5, .9, .1],
+            'tag': ['PER', 'PER', 'LOC']
+        }), md_file)
+        ed_f = EntityDisambiguation(md_file=md_file, fields=['body'], source_file=source_file,
+                                    out_file=str(tmp_path) + _out_file, base_url=_base_url, wiki_version=_wiki_version)
+        docids = [12, 7] if file_name == 'docs.jsonl' else ['b12', 'a7']
+        assert list(ed_f.stream_doc_with_spans()) == [
+            (docids[0], 'body', [(10, 3)], 'the brown fox', ['PER'], [.9]),
+            (docids[1], 'body', [(4, 4), (9, 3)], 'the lazy dog', ['LOC', 'PER'], [.1, .5])
+        ]
+
+
+def test_batched_units_equal_single_units(tmp_path):
+    ed_f = EntityDisambiguation(md_file=_md, fields=_fields, **_source(tmp_path), out_file=str(tmp_path)+_out_file,
+                                base_url=_base_url, wiki_version=_wiki_version)
+    units = [
+        ('a+body', 'the brown fox jumped over the lazy dog', [(10, 3), (17, 11)], ['PER', 'PER'], [0.9, 0.8]),
+        ('b+title', 'a fox', [(2, 3)], ['LOC'], [0.5]),
+        ('c+body', 'nothing to see', [(0, 7)], ['ORG'], [0.1])
+    ]
+    batched = ed_f.disambiguate_units(units)
+    for unit in units:
+        assert ed_f.disambiguate_units([unit])[unit[0]] == batched[unit[0]]
+    assert batched['b+title'] == [(2, 3, 'fox', 'Fox', 0.0, 'LOC', 0.5)]
+
+
+def _write_fox_documents(tmp_path):
+    # 20 documents, every other one without mentions, with the mentions in the md file in reverse document order
+    source_file = str(tmp_path) + '/docs.jsonl'
+    texts = ['the brown fox jumped over the lazy dog', 'no mentions', 'a fox', 'the dog and the fox']
+    with open(source_file, 'w') as f:
+        for i in range(20):
+            f.write(json.dumps({'docid': f'doc{i}', 'body': texts[i % 4]}) + '\n')
+    rows = [(f'doc{i}', texts[i % 4].index('fox'), .05 * i) for i in range(20) if 'fox' in texts[i % 4]]
+    md_file = str(tmp_path) + '/md.parquet'
+    pq.write_table(pa.table({
+        'identifier': [row[0] for row in reversed(rows)],
+        'field': [0] * len(rows),
+        'text': ['fox'] * len(rows),
+        'start_pos': [row[1] for row in reversed(rows)],
+        'end_pos': [row[1] + 3 for row in reversed(rows)],
+        'score': [row[2] for row in reversed(rows)],
+        'tag': ['PER'] * len(rows)
+    }), md_file)
+    return source_file, md_file, rows
+
+
+def test_parallel_equals_serial(tmp_path):
+    source_file, md_file, rows = _write_fox_documents(tmp_path)
+    tables = []
+    for workers in ['1', '3']:
+        out_file = str(tmp_path) + f'/ed_{workers}.parquet'
+        kwargs = dict(md_file=md_file, fields=['body'], source_file=source_file, out_file=out_file,
+                      base_url=_base_url, wiki_version=_wiki_version, workers=workers, threads_per_worker='1')
+        ed_f = ParallelEntityDisambiguation(**kwargs) if workers != '1' else EntityDisambiguation(**kwargs)
+        if workers != '1':
+            assert len(ed_f.document_ranges(3)) == 3
+        ed_f.process()
+        tables.append(pq.read_table(out_file))
+    assert tables[0].column('doc_id').to_pylist() == [row[0] for row in rows]
+    assert tables[0].equals(tables[1])
+    assert not path.isfile(str(tmp_path) + '/ed_3_part0.parquet')
+
+
+def test_parallel_discards_parts_of_other_ranges(tmp_path):
+    # A rerun with another number of workers starts the parts that cover other documents over
+    source_file, md_file, rows = _write_fox_documents(tmp_path)
+    out_file = str(tmp_path) + '/ed.parquet'
+    kwargs = dict(md_file=md_file, fields=['body'], source_file=source_file, out_file=out_file, base_url=_base_url,
+                  wiki_version=_wiki_version, threads_per_worker='1')
+    ed_f = ParallelEntityDisambiguation(workers='2', **kwargs)
+    start_doc, stop_doc = ed_f.document_ranges(2)[0]
+    EntityDisambiguation(**dict(kwargs, out_file=ed_f.part_file(0), start_doc=start_doc, stop_doc=stop_doc)).process()
+    ParallelEntityDisambiguation(workers='3', **kwargs).process()
+    serial_out_file = str(tmp_path) + '/ed_serial.parquet'
+    EntityDisambiguation(**dict(kwargs, out_file=serial_out_file)).process()
+    assert pq.read_table(out_file).equals(pq.read_table(serial_out_file))
+    assert not path.isfile(ed_f.part_file(0))
+
+
+def test_parallel_with_mapped_embeddings(tmp_path):
+    # The forked workers share the model of the parent, with the embeddings looked up in the memory mapped export
+    base_url = str(tmp_path) + '/base/'
+    shutil.copytree(_base_url, base_url)
+    for db_file in embedding_db_files(base_url, _wiki_version):
+        export_embeddings(db_file)
+    source_file, md_file, rows = _write_fox_documents(tmp_path)
+    tables = []
+    for workers in ['1', '2']:
+        out_file = str(tmp_path) + f'/ed_{workers}.parquet'
+        kwargs = dict(md_file=md_file, fields=['body'], source_file=source_file, out_file=out_file,
+                      base_url=base_url, wiki_version=_wiki_version, mapped_embeddings=True, workers=workers,
+                      threads_per_worker='1')
+        ed_f = ParallelEntityDisambiguation(**kwargs) if workers != '1' else EntityDisambiguation(**kwargs)
+        ed_f.process()
+        tables.append(pq.read_table(out_file))
+    assert tables[0].column('doc_id').to_pylist() == [row[0] for row in rows]
+    assert tables[0].equals(tables[1])
+    assert not path.isfile(str(tmp_path) + '/ed_2_part1.parquet')
+
+
+def test_output_schema_and_row_groups(tmp_path):
+    source_file = str(tmp_path) + '/docs.jsonl'
+    with open(source_file, 'w') as f:
+        for i in range(5):
+            f.write(json.dumps({'docid': i, 'title': 'a fox', 'body': 'the brown fox jumped over the lazy dog'}) + '\n')
+    md_file = str(tmp_path) + '/md.parquet'
+    pq.write_table(pa.table({
+        'identifier': [str(i) for i in range(5) for _ in range(2)],
+        'field': [0, 1] * 5,
+        'text': ['fox'] * 10,
+        'start_pos': [2, 10] * 5,
+        'end_pos': [5, 13] * 5,
+        'score': [.5] * 10,
+        'tag': ['PER', 'LOC'] * 5
+    }), md_file)
+    out_file = str(tmp_path) + _out_file
+    EntityDisambiguation(md_file=md_file, fields=['title', 'body'], source_file=source_file, out_file=out_file,
+                         base_url=_base_url, wiki_version=_wiki_version,
+                         write_batch_size='3').process()
+    parquet_file = pq.ParquetFile(out_file)
+    assert parquet_file.schema_arrow.equals(entity_schema())
+    # Row groups are cut at the start of the next document once 3 rows are buffered
+    assert [parquet_file.metadata.row_group(i).num_rows for i in range(parquet_file.metadata.num_row_groups)] == \
+           [4, 4, 2]
+    table = parquet_file.read()
+    assert table.column('doc_id').to_pylist() == [str(i) for i in range(5) for _ in range(2)]
+    assert table.column('field').to_pylist() == [0, 1] * 5
+    assert table.column('tag').to_pylist() == ['PER', 'LOC'] * 5
+    # Without any mentions the output still has the full schema
+    pq.write_table(pq.read_table(md_file).slice(0, 0), md_file)
+    EntityDisambiguation(md_file=md_file, fields=['title', 'body'], source_file=source_file, out_file=out_file,
+                         base_url=_base_url, wiki_version=_wiki_version, cont=False).process()
+    assert pq.read_table(out_file).schema.equals(entity_schema())
+
+
+class _InterruptedEntityDisambiguation(EntityDisambiguation):
+
+    def __init__(self, interrupt_after, **kwargs):
+        super().__init__(**kwargs)
+        self.interrupt_after = interrupt_after
+
+    def stream_disambiguate_file(self):
+        for i, result in enumerate(super().stream_disambiguate_file()):
+            if i == self.interrupt_after:
+                raise KeyboardInterrupt
+            yield result
+
+
+def test_resume_from_checkpoint(tmp_path):
+    source_file = str(tmp_path) + '/docs.jsonl'
+    with open(source_file, 'w') as f:
+        for i in range(10):
+            f.write(json.dumps({'docid': f'doc{i}', 'body': 'the brown fox jumped over the lazy dog'}) + '\n')
+    md_file = str(tmp_path) + '/md.parquet'
+    pq.write_table(pa.table({
+        'identifier': [f'doc{i}' for i in range(10)],
+        'field': [0] * 10,
+        'text': ['fox'] * 10,
+        'start_pos': [10] * 10,
+        'end_pos': [13] * 10,
+        'score': [.1 * i for i in range(10)],
+        'tag': ['PER'] * 10
+    }), md_file)
+    kwargs = dict(md_file=md_file, fields=['body'], source_file=source_file, base_url=_base_url,
+                  wiki_version=_wiki_version, write_batch_size='2')
+    expected_out_file = str(tmp_path) + '/expected.parquet'
+    EntityDisambiguation(out_file=expected_out_file, **kwargs).process()
+    out_file = str(tmp_path) + _out_file
+    try:
+        _InterruptedEntityDisambiguation(interrupt_after=7, out_file=out_file, **kwargs).process()
+        raise AssertionError("Should have been interrupted")
+    except KeyboardInterrupt:
+        pass
+    # Documents 0 to 5 are committed in three row groups, document 6 was buffered and is not. Only the committed part
+    # files are needed to resume, as after a kill that leaves no parquet footer behind.
+    assert json.load(open(str(tmp_path) + '/outfile_checkpoint.json'))['last_document'] == 5
+    assert not path.isfile(out_file)
+    assert path.isfile(str(tmp_path) + '/outfile_row_groups/000002.parquet')
+    ed_f = EntityDisambiguation(out_file=out_file, **kwargs)
+    ed_f.process()
+    assert ed_f.document_range == (0, None) and ed_f.start_doc == 6
+    assert pq.read_table(out_file).equals(pq.read_table(expected_out_file))
+    assert pq.ParquetFile(out_file).metadata.num_row_groups == 5
+    assert json.load(open(str(tmp_path) + '/outfile_checkpoint.json'))['finished']
+    assert not path.isdir(str(tmp_path) + '/outfile_row_groups')
+
+
+def test_finished_checkpoint_of_other_input(tmp_path):
+    # A finished output is only skipped for the same md file, source file and documents
+    source_file, md_file, rows = _write_fox_documents(tmp_path)
+    other_md_file = str(tmp_path) + '/other_md.parquet'
+    pq.write_table(pq.read_table(md_file).slice(0, 2), other_md_file)
+    kwargs = dict(fields=['body'], source_file=source_file, base_url=_base_url, wiki_version=_wiki_version)
+    for workers in ['1', '2']:
+        out_file = str(tmp_path) + f'/ed_{workers}.parquet'
+        ed_class = ParallelEntityDisambiguation if workers != '1' else EntityDisambiguation
+        ed_class(md_file=md_file, out_file=out_file, workers=workers, threads_per_worker='1', **kwargs).process()
+        try:
+            ed_class(md_file=other_md_file, out_file=out_file, workers=workers, **kwargs).process()
+            raise AssertionError("Should raise error as the output belongs to another md file")
+        except IOError:
+            pass
+        ed_class(md_file=other_md_file, out_file=out_file, workers=workers, cont=False, **kwargs).process()
+        assert pq.read_table(out_file).num_rows == 2
+    try:
+        EntityDisambiguation(md_file=other_md_file, out_file=str(tmp_path) + '/ed_1.parquet', start_doc=4,
+                             **kwargs).process()
+        raise AssertionError("Should raise error as the output belongs to other documents")
+    except IOError:
+        pass
@@ -0,0 +1,84 @@
+import random
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from ...ed.mention_reader import SortedMentionReader
+from ...utils.docid_index import DocidIndex
+
+_fields = {0: 'title', 1: 'headings', 2: 'body'}
+
+
+def _write_md_file(filename, rows, field_type=pa.int64()):
+    table = pa.table({
+        'identifier': pa.array([row[0] for row in rows], type=pa.string()).dictionary_encode(),
+        'field': pa.array([row[1] for row in rows], type=field_type),
+        'text': pa.array(['text'] * len(rows), type=pa.string()),
+        'start_pos': pa.array([row[2] for row in rows], type=pa.int64()),
+        'end_pos': pa.array([row[2] + 3 for row in rows], type=pa.int64()),
+        'score': pa.array([row[3] for row in rows], type=pa.float64()),
+        'tag': pa.array([row[4] for row in rows], type=pa.string()).dictionary_encode()
+    })
+    # Small row groups, so a document is spread over several batches
+    pq.write_table(table, filename, row_group_size=7)
+
+
+def _expected_groups(rows, ids):
+    groups = {}
+    for identifier, field, start_pos, score, tag in sorted(rows, key=lambda row: (ids[row[0]], row[1], row[2])):
+        key = (ids[identifier], field)
+        if key not in groups:
+            groups[key] = (ids[identifier], field, [], [], [])
+        groups[key][2].append((start_pos, 3))
+        groups[key][3].append(tag)
+        groups[key][4].append(score)
+    return list(groups.values())
+
+
+def _random_rows():
+    rng = random.Random(42)
+    ids = {f'doc_{i}': i for i in range(50)}
+    rows = []
+    for identifier in rng.sample(list(ids), len(ids)):
+        for field in range(3):
+            for start_pos in rng.sample(range(1000), rng.randint(0, 4)):
+                rows.append((identifier, field, start_pos, rng.random(), rng.choice(['PER', 'LOC', 'ORG'])))
+    rng.shuffle(rows)
+    return ids, rows
+
+
+def test_sorted_in_memory(tmp_path):
+    ids, rows = _random_rows()
+    _write_md_file(str(tmp_path) + '/md.parquet', rows)
+    index = DocidIndex.from_docids(list(ids))
+    reader = SortedMentionReader(str(tmp_path) + '/md.parquet', index, _fields, read_batch_size=5)
+    assert list(reader.groups()) == _expected_groups(rows, ids)
+
+
+def test_sorted_with_spilled_runs(tmp_path):
+    ids, rows = _random_rows()
+    _write_md_file(str(tmp_path) + '/md.parquet', rows)
+    index = DocidIndex.from_docids(list(ids))
+    reader = SortedMentionReader(str(tmp_path) + '/md.parquet', index, _fields, sort_buffer_size=20,
+                                 spill_dir=str(tmp_path), read_batch_size=5)
+    assert list(reader.groups()) == _expected_groups(rows, ids)
+    # Runs are removed after the last group
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['md.parquet']
+
+
+def test_field_names(tmp_path):
+    rows = [('b', 'body', 5, .5, 'PER'), ('a', 'body', 9, .9, 'LOC'), ('a', 'title', 1, .1, 'ORG')]
+    _write_md_file(str(tmp_path) + '/md.parquet', rows, field_type=pa.string())
+    reader = SortedMentionReader(str(tmp_path) + '/md.parquet', DocidIndex.from_docids(['a', 'b']), _fields)
+    assert list(reader.groups()) == [(0, 0, [(1, 3)], ['ORG'], [.1]), (0, 2, [(9, 3)], ['LOC'], [.9]),
+                                     (1, 2, [(5, 3)], ['PER'], [.5])]
+
+
+def test_unknown_identifier(tmp_path):
+    _write_md_file(str(tmp_path) + '/md.parquet', [('c', 0, 1, .1, 'PER')])
+    reader = SortedMentionReader(str(tmp_path) + '/md.parquet', DocidIndex.from_docids(['a']), _fields)
+    try:
+        list(reader.groups())
+        raise AssertionError('Should raise error as the identifier is not in the source file')
+    except KeyError:
+        pass
@@ -0,0 +1,68 @@
+import torch
+
+from ...md.adaptive_batching import AdaptiveBatchController
+
+
+class _MemoryLimitedTagger:
+
+    def __init__(self, max_tokens, error=RuntimeError('CUDA out of memory. Tried to allocate 2.00 GiB')):
+        self.max_tokens = max_tokens
+        self.error = error
+        self.calls = 0
+
+    def predict(self, batch, mini_batch_size=32):
+        self.calls += 1
+        if len(batch) * max(len(s) for s in batch) > self.max_tokens:
+            raise self.error
+
+
+def test_split_until_batches_fit():
+    controller = AdaptiveBatchController(_MemoryLimitedTagger(max_tokens=20))
+    batch = [[0] * n for n in [5, 5, 5, 5, 5, 5, 5, 5]]
+    fine, failed = controller.predict(batch)
+    assert sorted(fine) == list(range(8)) and failed == []
+    assert controller.counters['backoffs'] == 1
+    assert controller.max_tokens_ok == 20
+    assert controller.token_limit == 40
+
+
+def test_later_batches_are_split_before_predicting():
+    tagger = _MemoryLimitedTagger(max_tokens=20)
+    controller = AdaptiveBatchController(tagger)
+    batch = [[0] * 5 for _ in range(8)]
+    controller.predict(batch)
+    calls, backoffs = tagger.calls, controller.counters['backoffs']
+    controller.predict(batch)
+    assert controller.counters['backoffs'] == backoffs
+    assert controller.counters['pre_splits'] > 0
+    assert tagger.calls - calls == 2
+
+
+def test_impossible_sentence():
+    controller = AdaptiveBatchController(_MemoryLimitedTagger(max_tokens=20))
+    batch = [[0] * 5, [0] * 30, [0] * 5]
+    fine, failed = controller.predict(batch)
+    assert sorted(fine) == [0, 2]
+    assert failed == [1]
+    assert controller.counters['impossible'] == 1
+
+
+def test_cpu_out_of_memory():
+    error = RuntimeError('[enforce fail at alloc_cpu.cpp:114] DefaultCPUAllocator: can\'t allocate memory')
+    controller = AdaptiveBatchController(_MemoryLimitedTagger(max_tokens=20, error=error))
+    fine, failed = controller.predict([[0] * 5 for _ in range(8)])
+    assert sorted(fine) == list(range(8)) and failed == []
+    if hasattr(torch.cuda, 'OutOfMemoryError'):
+        controller = AdaptiveBatchController(_MemoryLimitedTagger(max_tokens=20, error=torch.cuda.OutOfMemoryError()))
+        assert sorted(controller.predict([[0] * 5 for _ in range(8)])[0]) == list(range(8))
+
+
+def test_other_errors_are_raised():
+    error = RuntimeError('The size of tensor a (5) must match the size of tensor b (6) at non-singleton dimension 1')
+    controller = AdaptiveBatchController(_MemoryLimitedTagger(max_tokens=20, error=error))
+    try:
+        controller.predict([[0] * 5 for _ in range(8)])
+        raise AssertionError('Should raise a RuntimeError')
+    except RuntimeError as raised:
+        assert raised is error
+    assert controller.token_limit is None and controller.counters['backoffs'] == 0
@@ -0,0 +1,46 @@
+from os import path
+
+import flair
+import pyarrow.parquet as pq
+import torch
+
+from ...md import MentionDetection
+from ...md.cpu_inference import cpu_inference
+
+_in_file = path.dirname(path.dirname(__file__)) + \
+    '/resources/md/hard_examples_with_expected_output/example_docs_20.txt.gz'
+
+
+def mentions(out_file):
+    table = pq.read_table(out_file).to_pydict()
+    return {(identifier, field, start_pos, end_pos, tag): score for identifier, field, start_pos, end_pos, tag, score
+            in zip(table['identifier'], table['field'], table['start_pos'], table['end_pos'], table['tag'],
+                   table['score'])}
+
+
+def test_quantized_mentions_match(tmp_path):
+    expected = mentions(_detect(str(tmp_path) + '/float.parquet'))
+    quantized = mentions(_detect(str(tmp_path) + '/quantized.parquet', cpu_optimized=True))
+    # Int8 weights may move a few borderline mentions, nearly all mentions and scores stay the same
+    same = [key for key in expected if key in quantized]
+    assert len(same) >= 0.9 * len(expected)
+    assert len(quantized) <= 1.1 * len(expected)
+    assert all(abs(expected[key] - quantized[key]) < .1 for key in same)
+
+
+def test_global_device_is_kept(tmp_path):
+    device = flair.device
+    flair.device = torch.device('meta')  # Any device other than cpu
+    try:
+        _detect(str(tmp_path) + '/quantized.parquet', cpu_optimized=True)
+        assert flair.device == torch.device('meta')
+        with cpu_inference():
+            assert flair.device == torch.device('cpu')
+        assert flair.device == torch.device('meta')
+    finally:
+        flair.device = device
+
+
+def _detect(out_file, **kwargs):
+    MentionDetection(in_file=_in_file, out_file=out_file, cont=False, **kwargs).write_batches_to_parquet()
+    return out_file
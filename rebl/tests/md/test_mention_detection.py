@@ -1,9 +1,10 @@
+import json
 from shutil import copy
 from pathlib import Path
 from os import path
 import pyarrow.parquet as pq
 
-from ...md import MentionDetection
+from ...md import MentionDetection, ShardedMentionDetection
 
 
 def mention_detect_jsonl(file_path, file_id):
@@ -77,5 +78,184 @@ def test_mention_detect_tab_sep(tmp_path):
     mention_detect_tab(file_path=tmp_path)
 
 
+def test_mention_detect_integer_identifiers(tmp_path):
+    in_file = str(tmp_path) + '/passages.jsonl'
+    with open(in_file, 'w') as f:
+        for pid in range(3):
+            f.write(json.dumps({'pid': pid, 'passage': 'Barack Obama visited Amsterdam'}) + '\n')
+    out_file = str(tmp_path) + '/outfile.parquet'
+    MentionDetection(in_file=in_file, out_file=out_file, identifier='pid', fields=['passage'],
+                     write_batch_size='1').write_batches_to_parquet()
+    identifiers = pq.read_table(out_file).column('identifier').to_pylist()
+    assert identifiers and set(identifiers) == {'0', '1', '2'}
+
+
 def test_mention_detect_continue(tmp_path):
     mention_detect_jsonl_continue(file_path=tmp_path)
+
+
+def test_mention_detect_preprocess_workers(tmp_path):
+    in_file = path.dirname(path.dirname(__file__)) + \
+              '/resources/md/hard_examples_with_expected_output/example_docs_2.txt.gz'
+    out_files = []
+    for workers in ['0', '2']:
+        out_file = str(tmp_path) + f'/outfile_{workers}.parquet'
+        md = MentionDetection(
+            in_file=in_file,
+            out_file=out_file,
+            preprocess_workers=workers
+        )
+        md.write_batches_to_parquet()
+        out_files.append(out_file)
+    in_process, pooled = [pq.read_table(out_file).to_pandas() for out_file in out_files]
+    assert in_process.equals(pooled)
+
+
+def test_token_budget_batches():
+    sentences = [[0] * n for n in [3, 10, 2, 9, 1]]
+    batches = list(MentionDetection.token_budget_batches(sentences, 20))
+    assert batches == [[1, 3], [0, 2, 4]]
+    # A sentence larger than the budget is tagged on its own
+    assert list(MentionDetection.token_budget_batches(sentences, 5)) == [[1], [3], [0], [2, 4]]
+
+
+def test_mention_detect_token_batching(tmp_path):
+    in_file = path.dirname(path.dirname(__file__)) + \
+              '/resources/md/hard_examples_with_expected_output/example_docs_2.txt.gz'
+    out_tables = []
+    for batching in ['count', 'tokens']:
+        out_file = str(tmp_path) + f'/outfile_{batching}.parquet'
+        md = MentionDetection(
+            in_file=in_file,
+            out_file=out_file,
+            batching=batching,
+            token_budget='500'
+        )
+        md.write_batches_to_parquet()
+        out_tables.append(pq.read_table(out_file).to_pandas())
+    count_table, token_table = out_tables
+    for c in ['identifier', 'field', 'text', 'start_pos', 'end_pos', 'score', 'tag']:
+        for a, b in zip(count_table[c], token_table[c]):
+            if type(a) == float:
+                assert -.001 < a - b < .001
+            else:
+                assert a == b
+
+
+class _InterruptedMentionDetection(MentionDetection):
+
+    def __init__(self, interrupt_after, **kwargs):
+        super().__init__(**kwargs)
+        self.interrupt_after = interrupt_after
+
+    def sentence_to_mentions_gen(self):
+        for i, mention in enumerate(super().sentence_to_mentions_gen()):
+            if i == self.interrupt_after:
+                raise KeyboardInterrupt
+            yield mention
+
+
+def test_mention_detect_resume_from_checkpoint(tmp_path):
+    in_file = path.dirname(path.dirname(__file__)) + f'/resources/md/sample_docs_first_three/msmarco_doc_00.txt'
+    expected_out_file = str(tmp_path) + '/expected.parquet'
+    MentionDetection(in_file=in_file, out_file=expected_out_file, write_batch_size='1').write_batches_to_parquet()
+    expected_out_table = pq.read_table(expected_out_file)
+
+    out_file = str(tmp_path) + '/outfile.parquet'
+    try:
+        _InterruptedMentionDetection(interrupt_after=expected_out_table.num_rows - 1, in_file=in_file,
+                                     out_file=out_file, write_batch_size='1').write_batches_to_parquet()
+        raise AssertionError("Should have been interrupted")
+    except KeyboardInterrupt:
+        pass
+    # Only the committed part files are needed to resume, as after a kill that leaves no parquet footer behind
+    assert not path.isfile(out_file)
+    assert path.isfile(str(tmp_path) + '/outfile_row_groups/000000.parquet')
+    md = MentionDetection(in_file=in_file, out_file=out_file, write_batch_size='1', cont=True)
+    md.write_batches_to_parquet()
+    assert md.skip_to > 0
+    out_table = pq.read_table(out_file).to_pydict()
+    assert len(out_table['identifier']) == expected_out_table.num_rows
+    for c, expected_values in expected_out_table.to_pydict().items():
+        for a, b in zip(out_table[c], expected_values):
+            if type(a) == float:
+                assert -.001 < a - b < .001
+            else:
+                assert a == b
+    assert pq.ParquetFile(out_file).metadata.num_row_groups == pq.ParquetFile(expected_out_file).metadata.num_row_groups
+    assert not path.isdir(str(tmp_path) + '/outfile_row_groups')
+
+
+def test_finished_checkpoint_of_other_input(tmp_path):
+    in_file = path.dirname(path.dirname(__file__)) + f'/resources/md/sample_docs_first_three/msmarco_doc_00.txt'
+    out_file = str(tmp_path) + '/outfile.parquet'
+    MentionDetection(in_file=in_file, out_file=out_file).write_batches_to_parquet()
+    other_in_file = str(tmp_path) + '/other.txt'
+    copy(in_file, other_in_file)
+    try:
+        MentionDetection(in_file=other_in_file, out_file=out_file).write_batches_to_parquet()
+        raise AssertionError('Should raise an IOError')
+    except IOError:
+        pass
+    MentionDetection(in_file=other_in_file, out_file=out_file, cont=False).write_batches_to_parquet()
+    assert json.load(open(str(tmp_path) + '/outfile_checkpoint.json'))['in_file'] == other_in_file
+
+
+def test_sharded_mention_detection(tmp_path):
+    in_file = path.dirname(path.dirname(__file__)) + \
+              '/resources/md/hard_examples_with_expected_output/example_docs_20.txt.gz'
+    expected_out_file = str(tmp_path) + '/expected.parquet'
+    MentionDetection(in_file=in_file, out_file=expected_out_file).write_batches_to_parquet()
+    out_file = str(tmp_path) + '/outfile.parquet'
+    ShardedMentionDetection(in_file=in_file, out_file=out_file, workers='3', threads_per_worker='1',
+                            gzip_index=str(tmp_path) + '/gzip_index').write_batches_to_parquet()
+    out_table = pq.read_table(out_file).to_pydict()
+    expected_out_table = pq.read_table(expected_out_file).to_pydict()
+    assert len(out_table['identifier']) == len(expected_out_table['identifier'])
+    for c, expected_values in expected_out_table.items():
+        for a, b in zip(out_table[c], expected_values):
+            if type(a) == float:
+                assert -.001 < a - b < .001
+            else:
+                assert a == b
+    assert not path.isfile(str(tmp_path) + '/outfile_part0.parquet')
+    assert path.isfile(str(tmp_path) + '/outfile_field_mapping.parquet')
+
+
+def test_create_sentences_fast_path(tmp_path):
+    from ...md.sentence_creation import SentenceCreator
+    from ...utils import input_stream_gen_lines
+    in_file = path.dirname(path.dirname(__file__)) + \
+              '/resources/md/hard_examples_with_expected_output/example_docs_20.txt.gz'
+    sentence_creator = SentenceCreator({'fields': ['title', 'headings', 'body'],
+                                        'out_file': str(tmp_path) + '/outfile.parquet'})
+    for line in input_stream_gen_lines(in_file):
+        document = json.loads(line)
+        for field in ['title', 'headings', 'body']:
+            fast = sentence_creator.create_sentences(document[field], document['docid'])
+            reference = sentence_creator.create_sentences_with_removed_chars(document[field], document['docid'])
+            assert [[(t.text, t.start_pos, t.end_pos) for t in s] for s in fast] == \
+                   [[(t.text, t.start_pos, t.end_pos) for t in s] for s in reference]
+
+
+def test_mention_detect_tagger_cache(tmp_path):
+    in_file = path.dirname(path.dirname(__file__)) + \
+              '/resources/md/hard_examples_with_expected_output/example_docs_20.txt.gz'
+    out_tables = []
+    for cache_size in ['0', '1000']:
+        out_file = str(tmp_path) + f'/outfile_{cache_size}.parquet'
+        md = MentionDetection(
+            in_file=in_file,
+            out_file=out_file,
+            tagger_cache_size=cache_size
+        )
+        md.write_batches_to_parquet()
+        out_tables.append(pq.read_table(out_file).to_pydict())
+    uncached, cached = out_tables
+    assert md.tagger_cache.counters['hits'] > 0  # Titles are repeated as headings
+    for c, expected_values in uncached.items():
+        for a, b in zip(cached[c], expected_values):
+            if type(a) == float:
+                assert -.001 < a - b < .001
+            else:
+                assert a == b
@@ -0,0 +1,60 @@
+from ...md import MentionDetection
+from ...md.tagger_cache import TaggerCache
+
+
+def test_lru_eviction():
+    cache = TaggerCache(max_size=2)
+    cache.put(b'a', [(0, 1, 'PER', .9)])
+    cache.put(b'b', [])
+    assert cache.get(b'a') == [(0, 1, 'PER', .9)]
+    cache.put(b'c', [(2, 2, 'LOC', .8)])  # b is least recently used
+    assert cache.get(b'b') is None
+    assert cache.get(b'c') == [(2, 2, 'LOC', .8)]
+    assert cache.counters == {'hits': 2, 'disk_hits': 0, 'misses': 1}
+
+
+def test_cache_file_survives(tmp_path):
+    cache_file = str(tmp_path) + '/cache.db'
+    cache = TaggerCache(max_size=10, cache_file=cache_file)
+    cache.put(b'a', [(0, 1, 'PER', .9)])
+    cache.close()
+    cache = TaggerCache(max_size=10, cache_file=cache_file)
+    assert cache.get(b'a') == [(0, 1, 'PER', .9)]
+    assert cache.counters['disk_hits'] == 1
+    cache.close()
+
+
+def test_two_connections(tmp_path):
+    # As two shards of one run, each with their own connection to the cache file
+    cache_file = str(tmp_path) + '/cache.db'
+    first = TaggerCache(max_size=10, cache_file=cache_file)
+    second = TaggerCache(max_size=10, cache_file=cache_file)
+    first.put(b'a', [(0, 1, 'PER', .9)])
+    first.commit()
+    second.put(b'b', [(2, 2, 'LOC', .8)])  # A batch of the second shard is being stored
+    reader = TaggerCache(max_size=10, cache_file=cache_file)
+    assert reader.get(b'a') == [(0, 1, 'PER', .9)]
+    assert reader.get(b'b') is None
+    second.commit()
+    first.put(b'c', [])
+    first.commit()
+    assert reader.get(b'b') == [(2, 2, 'LOC', .8)]
+    assert reader.get(b'c') == []
+    assert reader.counters['disk_hits'] == 3
+    for cache in [first, second, reader]:
+        cache.close()
+
+
+def test_shards_share_cache_file(tmp_path):
+    # Batches of two shards alternate, every batch has to be committed before the other shard can store its own
+    cache_file = str(tmp_path) + '/cache.db'
+    shards = [MentionDetection(in_file=cache_file, out_file=str(tmp_path) + f'/part{i}.parquet', tagger_cache_size='10',
+                               tagger_cache_file=cache_file) for i in range(2)]
+    texts = ['Alice met Robert in Amsterdam.', 'Maria lives in Berlin.', 'Maria lives in Berlin.']
+    for i, text in enumerate(texts):
+        md = shards[i % 2]
+        batch = md.create_sentences(text, str(i))
+        assert md.predict_batch(batch, [str(i)] * len(batch), [0] * len(batch)) == list(range(len(batch)))
+    assert shards[0].tagger_cache.counters['disk_hits'] == 1  # The third text was tagged by the second shard
+    for md in shards:
+        md.tagger_cache.close()
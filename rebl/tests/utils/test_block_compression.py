@@ -0,0 +1,56 @@
+import gzip
+import json
+
+import numpy as np
+
+from ...utils.block_compression import BlockCompressedReader, BlockCompressedWriter, block_index_file
+
+
+def _lines(n):
+    return [json.dumps({'docid': f'doc{i}', 'body': 'the brown fox ' * (i % 7)}) + '\n' for i in range(n)]
+
+
+def test_ordinary_gzip_with_block_index(tmp_path):
+    out_file = str(tmp_path) + '/out.jsonl.gz'
+    lines = _lines(1000)
+    with BlockCompressedWriter(out_file, threads=3, block_size=2000) as writer:
+        for line in lines:
+            writer.write(line)
+    with gzip.open(out_file, 'rt') as f:
+        assert f.readlines() == lines
+    blocks = np.load(block_index_file(out_file))
+    assert len(blocks) > 10
+    assert blocks[0].tolist()[::2] == [0, 0] and (np.diff(blocks[:, 2]) > 0).all()
+    reader = BlockCompressedReader(out_file)
+    assert len(reader) == len(lines)
+    for line_number in [999, 0, 500, 501, 17]:
+        assert reader.line(line_number) == lines[line_number]
+    try:
+        reader.line(1000)
+        raise AssertionError('Should raise an IndexError after the last line')
+    except IndexError:
+        pass
+    reader.close()
+
+
+def test_empty_output(tmp_path):
+    out_file = str(tmp_path) + '/out.jsonl.gz'
+    BlockCompressedWriter(out_file).close()
+    with gzip.open(out_file, 'rt') as f:
+        assert f.read() == ''
+    assert len(BlockCompressedReader(out_file)) == 0
+
+
+def test_zstd(tmp_path):
+    try:
+        import zstandard
+    except ImportError:
+        return  # Optional dependency
+    out_file = str(tmp_path) + '/out.jsonl.zst'
+    lines = _lines(100)
+    with BlockCompressedWriter(out_file, codec='zstd', block_size=500) as writer:
+        for line in lines:
+            writer.write(line)
+    with zstandard.open(out_file, 'rt') as f:
+        assert f.readlines() == lines
+    assert BlockCompressedReader(out_file).line(42) == lines[42]
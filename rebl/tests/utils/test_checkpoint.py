@@ -0,0 +1,16 @@
+import argparse
+
+from ...utils.checkpoint import str_to_bool
+
+
+def test_cont_option():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--cont', type=str_to_bool, default=True)
+    assert parser.parse_args([]).cont is True
+    assert parser.parse_args(['--cont', 'False']).cont is False
+    assert parser.parse_args(['-c', 'true']).cont is True
+    try:
+        str_to_bool('maybe')
+        raise AssertionError('Should raise an ArgumentTypeError')
+    except argparse.ArgumentTypeError:
+        pass
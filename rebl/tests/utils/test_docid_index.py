@@ -0,0 +1,73 @@
+import json
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from os import path
+
+from ...utils import DocidIndex, input_stream_gen_offsets
+
+_resources = path.dirname(path.dirname(__file__)) + '/resources/'
+_docs = _resources + 'md/hard_examples_with_expected_output/example_docs_20.txt'
+
+
+def test_index_matches_source(tmp_path):
+    for file_name in [_docs, _docs + '.gz']:
+        index = DocidIndex.load_or_build(file_name, index_dir=str(tmp_path) + '/' + path.basename(file_name))
+        lines = list(input_stream_gen_offsets(file_name))
+        assert len(index) == len(lines)
+        for line_number, offset, line in lines:
+            docid = json.loads(line)['docid']
+            assert index[docid] == line_number
+            assert index.docid(line_number) == docid
+            assert index.offset(line_number) == offset
+        # Random access in reverse order
+        for line_number, offset, line in reversed(lines):
+            assert index.document(line_number) == line
+        index.close()
+        assert 'not_a_docid' not in index
+
+
+def test_vectorized_lookup():
+    index = DocidIndex.from_docids(['b', 'a', 'c', 'a'])
+    # First occurrence wins for duplicates, unknown and longer docids are -1
+    assert index.ordinals(['a', 'c', 'b', 'd', 'aaaa']).tolist() == [1, 2, 0, -1, -1]
+    assert list(index.docids()) == ['b', 'a', 'c', 'a']
+
+
+def test_integer_and_tab_separated_ids():
+    index = DocidIndex.from_docids([7, 3, 11])
+    assert index['11'] == index[11] == 2
+    assert list(index.docids()) == [7, 3, 11]
+    index = DocidIndex.build(_resources + 'md/example_tab_sep.tsv')
+    assert index.docid(0) == '0'
+
+
+def test_rebuilt_when_source_changes(tmp_path):
+    source = str(tmp_path) + '/docs.txt'
+    shutil.copy(_docs, source)
+    index = DocidIndex.load_or_build(source)
+    assert path.isfile(DocidIndex.index_dir(source) + '/offsets.npy')
+    assert DocidIndex.load(source, 'docid', DocidIndex.index_dir(source)) is not None
+    with open(source, 'a') as f:
+        f.write(json.dumps({'docid': 'appended'}) + '\n')
+    assert DocidIndex.load(source, 'docid', DocidIndex.index_dir(source)) is None
+    assert DocidIndex.load_or_build(source)['appended'] == len(index)
+    # Built for another identifier
+    assert DocidIndex.load(source, 'url', DocidIndex.index_dir(source)) is None
+
+
+def test_concurrent_builders(tmp_path):
+    source = str(tmp_path) + '/docs.txt'
+    shutil.copy(_docs, source)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        indexes = list(executor.map(lambda _: DocidIndex.load_or_build(source), range(4)))
+    assert all(list(index.docids()) == list(indexes[0].docids()) for index in indexes)
+    assert sorted(os.listdir(str(tmp_path))) == ['docs.txt', 'docs.txt_docid_index']
+
+
+def test_index_that_can_not_be_saved(tmp_path):
+    source = str(tmp_path) + '/docs.txt'
+    shutil.copy(_docs, source)
+    index = DocidIndex.load_or_build(source, index_dir=str(tmp_path) + '/missing/folder/index')
+    assert index.docid(0) == DocidIndex.build(source).docid(0)
+    assert sorted(os.listdir(str(tmp_path))) == ['docs.txt']
@@ -0,0 +1,93 @@
+import gzip
+import json
+from os import path
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from ...utils import EntityParquetToJSON
+from ...utils import ed_parquet_to_json_passage
+
+
+def _write_ed_output(file_name, rows):
+    pq.write_table(pa.table({
+        'doc_id': [row[0] for row in rows],
+        'field': [row[1] for row in rows],
+        'start_pos': [row[2] for row in rows],
+        'end_pos': [row[2] + 3 for row in rows],
+        'entity': pa.array([row[3] for row in rows]).dictionary_encode(),
+        'ed_score': [0.0] * len(rows),
+        'tag': pa.array(['PER'] * len(rows)).dictionary_encode(),
+        'md_score': [.5] * len(rows)
+    }), file_name)
+
+
+def _mention(start_pos, entity, entity_id):
+    return {'entity_id': entity_id, 'start_pos': start_pos, 'end_pos': start_pos + 3, 'entity': entity,
+            'details': {'tag': 'PER', 'md_score': .5}}
+
+
+def _read_lines(file_name):
+    with gzip.open(file_name, 'rt') as f:
+        return [json.loads(line) for line in f]
+
+
+def test_streamed_documents(tmp_path):
+    source_file = str(tmp_path) + '/docs.jsonl'
+    with open(source_file, 'w') as f:
+        for docid in ['d3', 'd1', 'd2', 'd0']:
+            f.write(json.dumps({'docid': docid, 'title': '', 'headings': '', 'body': ''}) + '\n')
+    entity_maps = str(tmp_path) + '/entities.parquet'
+    pq.write_table(pa.table({'entity': ['Fox', 'Lazy dog'], 'id': [3, 4]}), entity_maps)
+    # d1 spans three read batches and its mentions are not sorted, d2 and d0 have no mentions
+    rows = [('d3', 2, 5, 'Fox'), ('d1', 2, 9, 'Lazy_dog'), ('d1', 0, 1, 'Fox'), ('d1', 2, 4, 'Cat'),
+            ('d1', 1, 0, 'Fox')]
+    expected = [
+        {'title': [], 'headings': [], 'body': [_mention(5, 'Fox', 3)], 'docid': 'd3'},
+        {'title': [_mention(1, 'Fox', 3)], 'headings': [_mention(0, 'Fox', 3)],
+         'body': [_mention(4, 'Cat', None), _mention(9, 'Lazy dog', 4)], 'docid': 'd1'},
+        {'title': [], 'headings': [], 'body': [], 'docid': 'd2'},
+        {'title': [], 'headings': [], 'body': [], 'docid': 'd0'}
+    ]
+    for name, ordered_rows in [('sorted', rows), ('unsorted', list(reversed(rows)))]:
+        in_file = str(tmp_path) + f'/{name}.parquet'
+        _write_ed_output(in_file, ordered_rows)
+        out_file = str(tmp_path) + f'/{name}.jsonl.gz'
+        converter = EntityParquetToJSON(in_file=in_file, out_file=out_file, source_file=source_file,
+                                        entity_maps=entity_maps, read_batch_size='2')
+        assert converter.in_source_order() == (name == 'sorted')
+        converter.run()
+        assert _read_lines(out_file) == expected
+    # The default output is that of json.dumps for every JSON backend, compact output has the same content
+    with gzip.open(out_file, 'rt') as f:
+        assert f.read() == ''.join(json.dumps(document) + '\n' for document in expected)
+    compact_file = str(tmp_path) + '/compact.jsonl.gz'
+    EntityParquetToJSON(in_file=in_file, out_file=compact_file, source_file=source_file, entity_maps=entity_maps,
+                        compact_json=True).run()
+    assert _read_lines(compact_file) == expected
+
+
+def test_layouts(tmp_path):
+    source_file = str(tmp_path) + '/passages.jsonl'
+    with open(source_file, 'w') as f:
+        for pid in [7, 3]:
+            f.write(json.dumps({'pid': pid, 'passage': 'a fox'}) + '\n')
+    entity_maps = str(tmp_path) + '/entities.parquet'
+    pq.write_table(pa.table({'entity': ['Fox'], 'id': [3]}), entity_maps)
+    in_file = str(tmp_path) + '/ed.parquet'
+    _write_ed_output(in_file, [('3', 0, 2, 'Fox')])
+    out_file = str(tmp_path) + '/out.jsonl.gz'
+    ed_parquet_to_json_passage.EntityParquetToJSON(in_file=in_file, out_file=out_file, source_file=source_file,
+                                                   entity_maps=entity_maps).run()
+    assert _read_lines(out_file) == [{'passage': [], 'pid': 7}, {'passage': [_mention(2, 'Fox', 3)], 'pid': 3}]
+    # A custom layout gives the same lines
+    EntityParquetToJSON(in_file=in_file, out_file=out_file, source_file=source_file, entity_maps=entity_maps,
+                        identifier='pid', fields=['passage'], docid_index=str(tmp_path) + '/pid_index').run()
+    assert _read_lines(out_file) == [{'passage': [], 'pid': 7}, {'passage': [_mention(2, 'Fox', 3)], 'pid': 3}]
+    assert path.isfile(str(tmp_path) + '/pid_index/meta.json')
+    try:
+        EntityParquetToJSON(in_file=in_file, out_file=out_file, source_file=source_file, entity_maps=entity_maps,
+                            layout='unknown')
+        raise AssertionError('Should raise an error for an unknown layout')
+    except IOError:
+        pass
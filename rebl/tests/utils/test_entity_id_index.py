@@ -0,0 +1,79 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from ...utils import entity_id_index
+from ...utils.entity_id_index import EntityIdIndex
+
+
+def _write_entity_maps(file_name, rows, redirect=True):
+    table = {'entity': [row[0] for row in rows], 'id': [row[1] for row in rows]}
+    if redirect:
+        table['redirect'] = [row[2] for row in rows]
+    pq.write_table(pa.table(table), file_name)
+
+
+def test_duplicates_are_deterministic(tmp_path):
+    rows = [('Fox', 30, False), ('Dog', 7, False), ('Fox', 11, True), ('Fox', 20, False), ('AT&T', 5, False),
+            ('Lazy dog', 40, True), ('Lazy dog', 9, True)]
+    ids = []
+    for i, ordered_rows in enumerate([rows, list(reversed(rows))]):
+        entity_maps = str(tmp_path) + f'/entities{i}.parquet'
+        _write_entity_maps(entity_maps, ordered_rows)
+        index = EntityIdIndex.load_or_build(entity_maps)
+        assert len(index) == 4
+        ids.append(index.lookup(['Fox', 'Dog', 'Lazy dog', 'AT&T', 'Cat']).tolist())
+    # The page that is not a redirect wins, then the lowest page id, independent of the order of the table
+    assert ids[0] == ids[1] == [20, 7, 9, 5, -1]
+
+
+def test_resolve_columns(tmp_path):
+    entity_maps = str(tmp_path) + '/entities.parquet'
+    _write_entity_maps(entity_maps, [('Fox', 3), ('Lazy dog', 4), ('AT&T', 5)], redirect=False)
+    index = EntityIdIndex.load_or_build(entity_maps)
+    assert index['Fox'] == 3
+    entities = pa.array(['Lazy_dog', 'Fox', 'AT&amp;T', 'Cat', 'Fox'])
+    for column in [entities, entities.dictionary_encode(), pa.chunked_array([entities[:2], entities[2:]])]:
+        texts, ids = index.resolve(column)
+        assert texts.to_pylist() == ['Lazy dog', 'Fox', 'AT&T', 'Cat', 'Fox']
+        assert ids.to_pylist() == [4, 3, 5, None, 3]
+
+
+def test_rebuilt_when_entity_maps_change(tmp_path):
+    entity_maps = str(tmp_path) + '/entities.parquet'
+    _write_entity_maps(entity_maps, [('Fox', 3)], redirect=False)
+    assert EntityIdIndex.load_or_build(entity_maps).lookup(['Fox', 'Dog']).tolist() == [3, -1]
+    _write_entity_maps(entity_maps, [('Fox', 3), ('Dog', 4), ('Dog and fox', 5)], redirect=False)
+    assert EntityIdIndex.load(entity_maps, EntityIdIndex.index_dir(entity_maps)) is None
+    assert EntityIdIndex.load_or_build(entity_maps).lookup(['Fox', 'Dog']).tolist() == [3, 4]
+
+
+def test_hash_collisions(tmp_path, monkeypatch):
+    # A hash of two bits makes most names collide, page ids are then found by comparing the names
+    monkeypatch.setattr(entity_id_index, 'name_hash', lambda name: len(name.encode('utf-8')) % 4)
+    entity_maps = str(tmp_path) + '/entities.parquet'
+    rows = [('Fox', 3, False), ('Dog', 4, False), ('Cat', 5, False), ('Lazy dog', 6, False), ('Dog', 2, True),
+            ('AT&T', 7, False)]
+    _write_entity_maps(entity_maps, rows)
+    index = EntityIdIndex.load_or_build(entity_maps)
+    assert index.lookup(['Dog', 'Cat', 'Fox', 'AT&T', 'Lazy dog', 'Cow', 'Lazy cat']).tolist() == \
+        [4, 5, 3, 7, 6, -1, -1]
+
+
+def test_concurrent_builders(tmp_path):
+    entity_maps = str(tmp_path) + '/entities.parquet'
+    _write_entity_maps(entity_maps, [('Fox', 3), ('Dog', 4)], redirect=False)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        indexes = list(executor.map(lambda _: EntityIdIndex.load_or_build(entity_maps), range(4)))
+    assert all(index.lookup(['Dog', 'Fox']).tolist() == [4, 3] for index in indexes)
+    assert sorted(os.listdir(str(tmp_path))) == ['entities.parquet', 'entities.parquet_entity_id_index']
+
+
+def test_index_that_can_not_be_saved(tmp_path):
+    entity_maps = str(tmp_path) + '/entities.parquet'
+    _write_entity_maps(entity_maps, [('Fox', 3), ('Dog', 4)], redirect=False)
+    index = EntityIdIndex.load_or_build(entity_maps, index_dir=str(tmp_path) + '/missing/folder/index')
+    assert index.lookup(['Dog', 'Fox', 'Cat']).tolist() == [4, 3, -1]
+    assert sorted(os.listdir(str(tmp_path))) == ['entities.parquet']
@@ -0,0 +1,98 @@
+import gzip
+import os
+import random
+from os import path
+
+from ...utils import ErrorFileToDocuments, input_stream_gen_lines, input_stream_gen_offsets, line_aligned_shards
+from ...utils.block_compression import BlockCompressedWriter
+from ...utils.gzip_index import GzipIndex, IndexedGzipReader
+
+_msmarco = path.dirname(path.dirname(__file__)) + '/resources/md/sample_docs_first_hunderd/msmarco_doc_00.gz'
+
+
+def line_offsets(data):
+    offsets, offset = [], 0
+    for line in data.splitlines(keepends=True):
+        offsets.append((offset, line))
+        offset += len(line)
+    return offsets
+
+
+def check_random_access(source_file, data, span):
+    lines = line_offsets(data)
+    with IndexedGzipReader(source_file, span) as reader:
+        assert len(reader.index) > 1
+        for offset, line in random.Random(0).sample(lines, len(lines)) + lines:
+            reader.seek(offset)
+            assert reader.readline() == line
+        reader.seek(len(data))
+        assert reader.readline() == b''
+
+
+def test_single_member(tmp_path):
+    with gzip.open(_msmarco, 'rb') as f:
+        data = f.read()
+    check_random_access(_copy(_msmarco, tmp_path), data, 1 << 16)
+
+
+def test_several_members(tmp_path):
+    data = b''.join(line.encode('utf-8') for line in input_stream_gen_lines(_msmarco))
+    source_file = str(tmp_path) + '/blocks.gz'
+    with BlockCompressedWriter(source_file, block_size=1 << 17) as writer:
+        for line in data.splitlines(keepends=True):
+            writer.write(line.decode('utf-8'))
+    check_random_access(source_file, data, 1 << 15)
+    source_file = str(tmp_path) + '/level_1.gz'
+    with open(source_file, 'wb') as f:  # Deflate blocks that start in the middle of a byte
+        f.write(gzip.compress(data[:len(data) // 2], compresslevel=1) + gzip.compress(data[len(data) // 2:]))
+    check_random_access(source_file, data, 1 << 15)
+
+
+def test_index_is_reused(tmp_path):
+    source_file = _copy(_msmarco, tmp_path)
+    GzipIndex.load_or_build(source_file, 1 << 16)
+    meta_file = GzipIndex.index_dir(source_file) + '/meta.json'
+    modified = os.stat(meta_file).st_mtime_ns
+    GzipIndex.load_or_build(source_file, 1 << 16)
+    assert os.stat(meta_file).st_mtime_ns == modified
+    os.utime(source_file, ns=(modified + 10 ** 9, modified + 10 ** 9))
+    assert GzipIndex.load(source_file, GzipIndex.index_dir(source_file)) is None
+
+
+def test_shards_of_gzip_file(tmp_path):
+    source_file = _copy(_msmarco, tmp_path)
+    with gzip.open(source_file, 'rb') as f:
+        data = f.read()
+    line_starts = {offset for offset, _ in line_offsets(data)}
+    shards = line_aligned_shards(source_file, 4)
+    assert 1 < len(shards) <= 4 and shards[0][0] == 0 and shards[-1][1] is None
+    assert all(start in line_starts for start, _ in shards)
+    assert GzipIndex.load(source_file, GzipIndex.index_dir(source_file)).uncompressed_size == len(data)
+    lines = []
+    for start, end in shards:  # Every shard reads from the checkpoint before its start
+        lines += [line for _, __, line in input_stream_gen_offsets(source_file, skip_to=start, stop_at=end)]
+    assert lines == list(input_stream_gen_lines(source_file))
+
+
+def test_error_file_from_gzip(tmp_path):
+    source_folder = str(tmp_path) + '/source'
+    os.makedirs(source_folder)
+    _copy(_msmarco, source_folder)
+    with gzip.open(_msmarco, 'rb') as f:
+        lines = line_offsets(f.read())
+    selected = [lines[i] for i in [70, 3, 3, 42, 99]]
+    in_file = str(tmp_path) + '/errors.txt'
+    with open(in_file, 'w') as f:
+        f.writelines(f'msmarco_doc_00_{offset}\n' for offset, _ in selected)
+    out_file = str(tmp_path) + '/outfile.txt'
+    ErrorFileToDocuments(in_file=in_file, out_file=out_file, source_files_folder=source_folder,
+                         checkpoint_span='65536').process()
+    with open(out_file, 'rb') as f:
+        assert f.read() == b''.join(line for _, line in selected)
+
+
+def _copy(source_file, folder):
+    copy = path.join(str(folder), path.basename(source_file))
+    with open(source_file, 'rb') as f, open(copy, 'wb') as out:
+        out.write(f.read())
+    return copy
@@ -0,0 +1,22 @@
+from os import path
+
+from ...utils import input_stream_gen_lines, input_stream_gen_offsets
+
+_resources = path.dirname(path.dirname(__file__)) + '/resources/md/hard_examples_with_expected_output/'
+
+
+def test_gzip_and_plain_are_equal():
+    plain = list(input_stream_gen_lines(_resources + 'example_docs_2.txt'))
+    gzipped = list(input_stream_gen_lines(_resources + 'example_docs_2.txt.gz'))
+    assert len(plain) == 2
+    assert plain == gzipped
+
+
+def test_offsets_resume(tmp_path):
+    for file_name in ['example_docs_20.txt', 'example_docs_20.txt.gz']:
+        lines = list(input_stream_gen_offsets(_resources + file_name))
+        assert [line_number for line_number, _, __ in lines] == list(range(len(lines)))
+        for line_number, offset, line in lines:
+            resumed = input_stream_gen_offsets(_resources + file_name, skip_to=offset, start_line=line_number,
+                                               index_dir=str(tmp_path) + '/gzip_index')
+            assert next(resumed) == (line_number, offset, line)
@@ -0,0 +1,49 @@
+import json
+from os import path
+
+from ...utils import input_stream_gen_lines
+from ...utils.json_codec import JsonCodec, available_backends
+
+_msmarco = path.dirname(path.dirname(__file__)) + '/resources/md/sample_docs_first_hunderd/msmarco_doc_00.gz'
+
+_lines = [
+    '{"url": "a", "body": "the docid is not here", "docid": "D1"}',
+    '{"docid":12,"body":"x"}',
+    '{"body": "a \\"docid\\": \\"fake\\" in the text", "docid" : "D2"}',
+    '{"body": "mentions \\"docid\\"", "meta": {"docid": "nested"}, "docid": "D3"}',
+    '{"title": "docid", "docid": "D4"}',
+    '{"body": "ends with a backslash \\\\", "docid": "D5"}',
+    '{"body": "caf\\u00e9 \\ud83e\\udd8a", "docid": "\\u00e9"}',
+    '{"links": [{"docid": "nested"}, "docid"], "meta": {"docid": {"docid": 1}}, "docid": "D6"}'
+]
+
+
+def test_same_as_standard_library():
+    lines = _lines + list(input_stream_gen_lines(_msmarco))[:20]
+    for backend in available_backends():
+        codec = JsonCodec(backend)
+        for line in lines:
+            expected = json.loads(line)
+            assert codec.loads(line) == expected
+            assert codec.identifier(line, 'docid') == expected['docid']
+            assert codec.dumps(expected) == json.dumps(expected)
+            assert json.loads(codec.dumps(expected, compact=True)) == expected
+
+
+def test_missing_identifier():
+    # Only a key of the outer object is the identifier
+    for backend in available_backends():
+        for line in ['{"body": "docid"}', '{"meta": {"docid": "nested"}, "body": "x"}', '{"ids": [{"docid": 1}]}']:
+            try:
+                JsonCodec(backend).identifier(line, 'docid')
+                raise AssertionError('Should raise a KeyError')
+            except KeyError:
+                pass
+
+
+def test_unknown_backend():
+    try:
+        JsonCodec('not_a_json_backend')
+        raise AssertionError('Should raise an IOError')
+    except IOError:
+        pass
@@ -1,5 +1,12 @@
-from .input_stream_generator import input_stream_gen_lines, stream_parquet_file_per_entry
+from .input_stream_generator import input_stream_gen_lines, input_stream_gen_offsets, open_input_stream, \
+    open_random_access, line_aligned_shards, stream_parquet_file_per_entry
+from .block_compression import BlockCompressedReader, BlockCompressedWriter
+from .docid_index import DocidIndex
 from .error_file_to_documents import ErrorFileToDocuments
-from .ed_parquet_to_json_doc import EntityParquetToJSON
+from .gzip_index import GzipIndex, IndexedGzipReader
+from .ed_parquet_to_json import EntityParquetToJSON
 
-__all__ = ['input_stream_gen_lines', 'stream_parquet_file_per_entry', 'ErrorFileToDocuments', 'EntityParquetToJSON']
+__all__ = ['input_stream_gen_lines', 'input_stream_gen_offsets', 'open_input_stream', 'open_random_access',
+           'line_aligned_shards',
+           'stream_parquet_file_per_entry', 'BlockCompressedReader', 'BlockCompressedWriter', 'DocidIndex',
+           'ErrorFileToDocuments', 'GzipIndex', 'IndexedGzipReader', 'EntityParquetToJSON']
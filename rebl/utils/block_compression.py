@@ -0,0 +1,132 @@
+import gzip
+import io
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+_CODECS = ['gzip', 'zstd']
+
+
+def _zstandard():
+    # Optional dependency, only needed for zstd output
+    try:
+        import zstandard
+    except ImportError:
+        raise IOError('zstd compression needs the zstandard package, pip install zstandard')
+    return zstandard
+
+
+def compress_block(data, codec, level):
+    # Every block is a complete gzip member (or zstd frame), concatenated they are an ordinary .gz (or .zst) file
+    if codec == 'gzip':
+        return gzip.compress(data, compresslevel=level, mtime=0)
+    return _zstandard().ZstdCompressor(level=level).compress(data)
+
+
+def decompress_block(data, codec):
+    if codec == 'gzip':
+        return gzip.decompress(data)
+    return _zstandard().ZstdDecompressor().decompress(data)
+
+
+def block_index_file(out_file):
+    return out_file + '_blocks.npy'
+
+
+class BlockCompressedWriter:
+    # Text is collected in blocks of about block_size bytes that are compressed independently in a thread pool (zlib
+    # and zstd release the GIL) and written in order. Blocks are only cut between writes, so when every write is a
+    # whole line, a block index of (compressed offset, compressed size, first line) allows to seek to any line.
+
+    def __init__(self, out_file, codec='gzip', threads=None, block_size=1 << 20, level=None):
+        if codec not in _CODECS:
+            raise IOError(f'Compression {codec} is not one of {", ".join(_CODECS)}')
+        if codec == 'zstd':
+            _zstandard()
+        self.out_file = out_file
+        self.codec = codec
+        self.level = level if level is not None else (6 if codec == 'gzip' else 3)
+        self.threads = int(threads) if threads else os.cpu_count()
+        self.block_size = int(block_size)
+        self.file = open(out_file, 'wb')
+        self.executor = ThreadPoolExecutor(max_workers=self.threads)
+        self.in_flight = deque()
+        self.buffer, self.buffered = [], 0
+        self.lines = 0
+        self.offset = 0
+        self.blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def write(self, text):
+        data = text.encode('utf-8')
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.block_size:
+            self.submit_block()
+
+    def submit_block(self):
+        if self.buffered == 0:
+            return
+        data = b''.join(self.buffer)
+        self.in_flight.append((self.executor.submit(compress_block, data, self.codec, self.level), self.lines))
+        self.lines += data.count(b'\n')
+        self.buffer, self.buffered = [], 0
+        # At most two blocks per thread are waiting, so memory does not grow when the disk is slower
+        while len(self.in_flight) > 2 * self.threads:
+            self.write_block()
+
+    def write_block(self):
+        future, first_line = self.in_flight.popleft()
+        block = future.result()
+        self.file.write(block)
+        self.blocks.append((self.offset, len(block), first_line))
+        self.offset += len(block)
+
+    def close(self):
+        self.submit_block()
+        while self.in_flight:
+            self.write_block()
+        self.executor.shutdown()
+        self.file.close()
+        np.save(block_index_file(self.out_file), np.array(self.blocks, dtype=np.int64).reshape(-1, 3))
+
+
+class BlockCompressedReader:
+    # Random access to the lines of a file written by BlockCompressedWriter, only the block of a line is decompressed
+
+    def __init__(self, out_file, codec=None):
+        self.codec = codec or ('zstd' if out_file.endswith('.zst') else 'gzip')
+        self.blocks = np.load(block_index_file(out_file), mmap_mode='r')
+        self.file = open(out_file, 'rb')
+        self.cached_block, self.cached_lines = None, None
+
+    def __len__(self):
+        if len(self.blocks) == 0:
+            return 0
+        return int(self.blocks[-1][2]) + len(self.block_lines(len(self.blocks) - 1))
+
+    def block_lines(self, block):
+        if block != self.cached_block:
+            offset, size, _ = self.blocks[block]
+            self.file.seek(int(offset))
+            self.cached_lines = io.BytesIO(decompress_block(self.file.read(int(size)), self.codec)).readlines()
+            self.cached_block = block
+        return self.cached_lines
+
+    def line(self, line_number):
+        block = int(np.searchsorted(self.blocks[:, 2], line_number, side='right')) - 1
+        lines = self.block_lines(block) if block >= 0 else []
+        position = line_number - (int(self.blocks[block][2]) if block >= 0 else 0)
+        if not 0 <= position < len(lines):
+            raise IndexError(line_number)
+        return lines[position].decode('utf-8')
+
+    def close(self):
+        self.file.close()
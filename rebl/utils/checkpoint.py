@@ -0,0 +1,67 @@
+import argparse
+import json
+import os
+import shutil
+import signal
+import sys
+
+import pyarrow.parquet as pq
+
+
+def exit_on_sigterm():
+    # Turn a SIGTERM (e.g. preemption) into an exception, so the outputs are closed properly and can be resumed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+
+
+def str_to_bool(value):
+    # Type of the --cont options, a plain string would make "--cont False" true
+    if value.lower() in ('true', 'yes', '1'):
+        return True
+    if value.lower() in ('false', 'no', '0'):
+        return False
+    raise argparse.ArgumentTypeError(f'Boolean value expected, not {value}')
+
+
+def read_checkpoint(filename):
+    if not os.path.isfile(filename):
+        return None
+    with open(filename, 'r') as f:
+        return json.load(f)
+
+
+def write_checkpoint(filename, **state):
+    # Write to a temporary file first, so a crash never leaves a half written checkpoint behind
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(filename + '.tmp', filename)
+
+
+def part_dir(out_file):
+    # Committed row groups are kept as separate parquet files until the output is finished, a part file is complete
+    # as soon as it exists, so a killed process (without a chance to write a parquet footer) loses nothing
+    return out_file[:-8] + '_row_groups'
+
+
+def part_file(directory, part):
+    return os.path.join(directory, f'{part:06d}.parquet')
+
+
+def write_part(directory, part, table):
+    os.makedirs(directory, exist_ok=True)
+    filename = part_file(directory, part)
+    pq.write_table(table, filename + '.tmp', row_group_size=max(table.num_rows, 1))
+    os.replace(filename + '.tmp', filename)
+
+
+def committed_parts(directory, parts):
+    # True when the first `parts` part files, the ones recorded by a checkpoint, all exist
+    return all(os.path.isfile(part_file(directory, part)) for part in range(parts))
+
+
+def read_parts(directory, parts):
+    for part in range(parts):
+        yield pq.read_table(part_file(directory, part))
+
+
+def remove_parts(directory):
+    shutil.rmtree(directory, ignore_errors=True)
@@ -0,0 +1,142 @@
+from array import array
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from .input_stream_generator import input_stream_gen_offsets, open_input_stream
+from .json_codec import codec
+from .sidecar_index import SidecarIndex, file_state
+
+
+def line_docid(line, identifier, jsonl):
+    if jsonl:
+        return codec.identifier(line, identifier)  # Only the identifier is decoded
+    return line.split('\t', 1)[0]
+
+
+class DocidIndex(SidecarIndex):
+    # Document ordinal -> (docid, byte offset) and docid -> ordinal for a source file, rebuilt when the source file or
+    # the identifier changes. Docids are kept sorted as fixed width bytes, lookups are a binary search with numpy. A
+    # docid that occurs more than once maps to its first ordinal.
+
+    arrays = ['offsets', 'sorted_docids', 'sorted_ordinals', 'ranks']
+    suffix = '_docid_index'
+    description = 'docid index'
+
+    def __init__(self, offsets, sorted_docids, sorted_ordinals, ranks, integer_ids=False, source_file=None):
+        self.offsets = offsets
+        self.sorted_docids = sorted_docids
+        self.sorted_ordinals = sorted_ordinals
+        self.ranks = ranks
+        self.integer_ids = integer_ids  # JSON identifiers that are numbers are given back as int
+        self.source_file = source_file
+        self.source = None
+
+    @classmethod
+    def from_docids(cls, docids, offsets=None, source_file=None):
+        integer_ids = len(docids) > 0 and all(isinstance(docid, int) for docid in docids)
+        encoded = np.array([str(docid).encode('utf-8') for docid in docids], dtype=bytes)
+        if len(encoded) == 0:
+            encoded = np.zeros(0, dtype='S1')
+        sorted_ordinals = np.argsort(encoded, kind='stable').astype(np.int64)
+        ranks = np.empty_like(sorted_ordinals)
+        ranks[sorted_ordinals] = np.arange(len(sorted_ordinals), dtype=np.int64)
+        if offsets is None:
+            offsets = np.full(len(encoded), -1, dtype=np.int64)
+        return cls(np.asarray(offsets, dtype=np.int64), encoded[sorted_ordinals], sorted_ordinals, ranks,
+                   integer_ids=integer_ids, source_file=source_file)
+
+    @classmethod
+    def build(cls, source_file, identifier='docid'):
+        docids, offsets, jsonl = [], array('q'), None
+        for _, offset, line in input_stream_gen_offsets(source_file):
+            if not line.strip():
+                continue
+            if jsonl is None:  # Detected once, instead of trying both parsers for every line
+                jsonl = line.lstrip().startswith('{')
+            docids.append(line_docid(line, identifier, jsonl))
+            offsets.append(offset)
+        return cls.from_docids(docids, np.frombuffer(offsets, dtype=np.int64), source_file=source_file)
+
+    @staticmethod
+    def source_state(source_file, identifier):
+        return dict(file_state(source_file), identifier=identifier)
+
+    @classmethod
+    def load_or_build(cls, source_file, identifier='docid', index_dir=None):
+        return cls.load_or_build_index(source_file, index_dir or cls.index_dir(source_file),
+                                       cls.source_state(source_file, identifier),
+                                       lambda: cls.build(source_file, identifier))
+
+    @classmethod
+    def load(cls, source_file, identifier, index_dir):
+        return cls.load_index(source_file, index_dir, cls.source_state(source_file, identifier))
+
+    @classmethod
+    def from_arrays(cls, arrays, meta, source_file):
+        return cls(*arrays, integer_ids=meta['integer_ids'], source_file=source_file)
+
+    def info(self):
+        return {'documents': len(self), 'integer_ids': self.integer_ids}
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __contains__(self, docid):
+        return self.ordinal(docid) >= 0
+
+    def __getitem__(self, docid):
+        ordinal = self.ordinal(docid)
+        if ordinal < 0:
+            raise KeyError(docid)
+        return ordinal
+
+    def ordinal(self, docid):
+        return int(self.ordinals([docid])[0])
+
+    def ordinals(self, docids):
+        # Vectorized lookup of a list or an arrow array of docids, -1 for docids that are not in the index
+        if isinstance(docids, (pa.Array, pa.ChunkedArray)):
+            docids = docids.cast(pa.string()).cast(pa.binary())
+            lengths = pc.binary_length(docids).to_numpy(zero_copy_only=False)
+            encoded = docids.to_numpy(zero_copy_only=False)
+        else:
+            encoded = [str(docid).encode('utf-8') for docid in docids]
+            lengths = np.array([len(value) for value in encoded], dtype=np.int64)
+        ordinals = np.full(len(encoded), -1, dtype=np.int64)
+        if len(encoded) == 0 or len(self.sorted_docids) == 0:
+            return ordinals
+        width = self.sorted_docids.dtype.itemsize
+        fits = lengths <= width
+        queries = np.array(encoded, dtype=f'S{width}')  # Longer docids are truncated here, they can not match
+        positions = np.minimum(np.searchsorted(self.sorted_docids, queries), len(self.sorted_docids) - 1)
+        found = fits & (self.sorted_docids[positions] == queries)
+        ordinals[found] = self.sorted_ordinals[positions[found]]
+        return ordinals
+
+    def docid(self, ordinal):
+        docid = self.sorted_docids[self.ranks[ordinal]].decode('utf-8')
+        return int(docid) if self.integer_ids else docid
+
+    def docids(self):
+        for ordinal in range(len(self)):
+            yield self.docid(ordinal)
+
+    def offset(self, ordinal):
+        return int(self.offsets[ordinal])
+
+    def document(self, ordinal):
+        # Random access to the raw line of a document
+        if self.source is None:
+            self.source = open_input_stream(self.source_file)
+        self.source.seek(self.offset(ordinal))
+        line = self.source.readline()
+        if line.endswith(b'\r\n'):  # Same newline translation as input_stream_gen_offsets
+            line = line[:-2] + b'\n'
+        return line.decode('utf-8')
+
+    def close(self):
+        if self.source is not None:
+            self.source.close()
+            self.source = None
@@ -0,0 +1,257 @@
+import argparse
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from .block_compression import BlockCompressedWriter
+from .docid_index import DocidIndex
+from .entity_id_index import EntityIdIndex
+from .json_codec import codec
+
+# Identifier key and fields (in the order of the field index of the ED output) of the JSON lines
+LAYOUTS = {
+    'doc': ('docid', ['title', 'headings', 'body']),
+    'doc_v1': ('docid', ['title', 'body']),
+    'passage': ('pid', ['passage'])
+}
+
+
+class EntityParquetToJSON:
+    layout = 'doc'
+
+    def __init__(self, **kwargs):
+        self.arguments = self.get_arguments(kwargs)
+        layout = self.arguments['layout'] or self.layout
+        if layout not in LAYOUTS:
+            raise IOError(f'Layout {layout} is not one of {", ".join(LAYOUTS)}')
+        self.identifier, self.fields = LAYOUTS[layout]
+        self.identifier = self.arguments['identifier'] or self.identifier
+        self.fields = self.arguments['fields'] or self.fields
+        self.ids = self.load_ids()
+        self.entity_id_map = self.load_entity_id_map()
+
+    def load_ids(self):
+        print("Start Loading ids", flush=True)
+        # The docid index is built on the first run and memory mapped on later runs
+        return DocidIndex.load_or_build(self.arguments['source_file'], self.identifier, self.arguments['docid_index'])
+
+    def load_entity_id_map(self):
+        # Built once from the local entity table and memory mapped on later runs, see EntityIdIndex
+        print("Start Loading entity_id_map", flush=True)
+        return EntityIdIndex.load_or_build(self.arguments['entity_maps'])
+
+    def mention_table(self, batch):
+        # Document ordinal, entity text and page id for a batch of the ED output, all vectorized
+        ordinals = self.ids.ordinals(batch.column('doc_id'))
+        if (ordinals < 0).any():
+            raise KeyError(f'Document {batch.column("doc_id")[int(np.argmax(ordinals < 0))]} is not in the source file')
+        entities, entity_ids = self.entity_id_map.resolve(batch.column('entity'))
+        return pa.table({
+            'ordinal': ordinals,
+            'field': batch.column('field').cast(pa.int64()),
+            'start_pos': batch.column('start_pos'),
+            'end_pos': batch.column('end_pos'),
+            'entity': entities,
+            'entity_id': entity_ids,
+            'tag': batch.column('tag').cast(pa.string()),
+            'md_score': batch.column('md_score')
+        })
+
+    def in_source_order(self):
+        # ED writes its output in the order of the source file, only the doc_id column is read to check this
+        last = -1
+        for batch in pq.ParquetFile(self.arguments['in_file']).iter_batches(columns=['doc_id']):
+            ordinals = self.ids.ordinals(batch.column('doc_id'))
+            if len(ordinals) == 0:
+                continue
+            if ordinals[0] < last or (np.diff(ordinals) < 0).any():
+                return False
+            last = ordinals[-1]
+        return True
+
+    def document_tables(self):
+        # Tables of complete documents, sorted on (ordinal, field, start_pos). The rows of the last document of a
+        # batch are held back until the next batch, so only one batch is in memory.
+        parquet_file = pq.ParquetFile(self.arguments['in_file'])
+        if not self.in_source_order():
+            print(f'{self.arguments["in_file"]} is not in the order of the source file, sorting it in memory',
+                  flush=True)
+            batches = [pa.concat_tables([self.mention_table(batch) for batch in parquet_file.iter_batches()])]
+        else:
+            batches = (self.mention_table(batch)
+                       for batch in parquet_file.iter_batches(batch_size=int(self.arguments['read_batch_size'])))
+        tail = None
+        for table in batches:
+            if tail is not None:
+                table = pa.concat_tables([tail, table])
+            if table.num_rows == 0:
+                continue
+            table = table.take(pc.sort_indices(table, sort_keys=[('ordinal', 'ascending'), ('field', 'ascending'),
+                                                                 ('start_pos', 'ascending')]))
+            ordinals = table.column('ordinal').to_numpy()
+            cut = int(np.searchsorted(ordinals, ordinals[-1]))
+            yield table.slice(0, cut)
+            tail = table.slice(cut)
+        if tail is not None:
+            yield tail
+
+    def documents(self):
+        # (ordinal, fields) for every document with mentions, in the order of the source file
+        for table in self.document_tables():
+            if table.num_rows == 0:
+                continue
+            ordinals = table.column('ordinal').to_numpy()
+            boundaries = np.concatenate([[0], np.flatnonzero(np.diff(ordinals)) + 1, [len(ordinals)]]).tolist()
+            columns = {name: table.column(name).to_pylist() for name in table.column_names if name != 'ordinal'}
+            for start, end in zip(boundaries[:-1], boundaries[1:]):
+                fields = {field: [] for field in self.fields}
+                for i in range(start, end):
+                    if not 0 <= columns['field'][i] < len(self.fields):
+                        raise IOError(f'Field {columns["field"][i]} is not in the fields {self.fields}')
+                    fields[self.fields[columns['field'][i]]].append({
+                        "entity_id": columns['entity_id'][i],
+                        "start_pos": columns['start_pos'][i],
+                        "end_pos": columns['end_pos'][i],
+                        "entity": columns['entity'][i],
+                        "details": {
+                            "tag": columns['tag'][i],
+                            "md_score": columns['md_score'][i]
+                        }
+                    })
+                yield int(ordinals[start]), fields
+
+    def json_lines(self):
+        # One line per document of the source file, written as soon as its mentions are complete
+        next_ordinal = 0
+        for ordinal, fields in self.documents():
+            for empty in range(next_ordinal, ordinal):
+                yield self.json_line(empty, {field: [] for field in self.fields})
+            yield self.json_line(ordinal, fields)
+            next_ordinal = ordinal + 1
+        for empty in range(next_ordinal, len(self.ids)):
+            yield self.json_line(empty, {field: [] for field in self.fields})
+
+    def json_line(self, ordinal, fields):
+        fields[self.identifier] = self.ids.docid(ordinal)
+        return codec.dumps(fields, compact=self.arguments['compact_json']) + '\n'
+
+    @staticmethod
+    def get_arguments(kwargs):
+        arguments = {
+            'in_file': None,
+            'out_file': None,
+            'source_file': None,
+            'docid_index': None,
+            'entity_maps': None,
+            'layout': None,
+            'identifier': None,
+            'fields': None,
+            'read_batch_size': '65536',
+            'compression': 'gzip',
+            'compress_threads': None,
+            'block_size': '1048576',
+            'compact_json': False
+        }
+        for key, item in arguments.items():
+            if kwargs.get(key) is not None:
+                arguments[key] = kwargs.get(key)
+        for key in ['in_file', 'out_file', 'source_file', 'entity_maps']:
+            if arguments[key] is None:
+                raise IOError(f'Argument {key} needs to be provided')
+        return arguments
+
+    def run(self):
+        print("Start creating JSON file", flush=True)
+        # Blocks of lines are compressed in parallel, a block index is written next to the output
+        with BlockCompressedWriter(self.arguments['out_file'], codec=self.arguments['compression'],
+                                   threads=self.arguments['compress_threads'],
+                                   block_size=self.arguments['block_size']) as f:
+            for i, line in enumerate(self.json_lines()):
+                if i % 100000 == 0:
+                    print(f"Finished {i} documents", flush=True)
+                f.write(line)
+
+
+def argument_parser(layout='doc'):
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-i',
+        '--in_file',
+        help='Name of file to change to JSON (gzipped)'
+    )
+    parser.add_argument(
+        '-o',
+        '--out_file',
+        help='Name of output file'
+    )
+    parser.add_argument(
+        '-s',
+        '--source_file',
+        help='Name of the original data file'
+    )
+    parser.add_argument(
+        '-di',
+        '--docid_index',
+        help='Directory of the docid index of the source file, defaults to the source file name + _docid_index'
+    )
+    parser.add_argument(
+        '-em',
+        '--entity_maps',
+        help='Name of the file containing the entities, and identifiers'
+    )
+    parser.add_argument(
+        '-l',
+        '--layout',
+        choices=list(LAYOUTS),
+        help='Identifier key and fields of the JSON lines',
+        default=layout
+    )
+    parser.add_argument(
+        '-id',
+        '--identifier',
+        help='Identifier key of the source file and the JSON lines, overrides the one of the layout'
+    )
+    parser.add_argument(
+        '-f',
+        '--fields',
+        nargs='*',
+        help='Fields in the order of the field index of the ED output, overrides the ones of the layout'
+    )
+    parser.add_argument(
+        '-rb',
+        '--read_batch_size',
+        help='Number of ED rows that are read and grouped at once',
+        default='65536'
+    )
+    parser.add_argument(
+        '-cm',
+        '--compression',
+        choices=['gzip', 'zstd'],
+        help='Compression of the output, gzip output is an ordinary .gz file made of independent members',
+        default='gzip'
+    )
+    parser.add_argument(
+        '-ct',
+        '--compress_threads',
+        help='Number of threads that compress blocks of the output, default is the number of cores'
+    )
+    parser.add_argument(
+        '-bs',
+        '--block_size',
+        help='Number of uncompressed bytes per compressed block of the output',
+        default='1048576'
+    )
+    parser.add_argument(
+        '-cj',
+        '--compact_json',
+        action='store_true',
+        help='Write compact JSON with non ascii characters as UTF-8, faster with orjson, numbers may be written '
+             'differently by each JSON backend'
+    )
+    return parser
+
+
+if __name__ == '__main__':
+    EntityParquetToJSON(**vars(argument_parser().parse_args())).run()
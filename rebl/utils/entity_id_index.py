@@ -0,0 +1,136 @@
+import argparse
+import hashlib
+import html
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from .sidecar_index import SidecarIndex, file_state, hash_positions
+
+
+def name_hash(name):
+    return int.from_bytes(hashlib.blake2b(name.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def entity_text(entity):
+    # Entity as written by ED (Wikipedia title with underscores, html escaped) to the text in the converter output
+    return html.unescape(entity.replace('_', ' '))
+
+
+class EntityIdIndex(SidecarIndex):
+    # Entity name -> Wikipedia page id, built once from a local entity table (columns entity and id, optionally
+    # redirect) and memory mapped afterwards. Names are found through a sorted array of 64 bit hashes, where the table
+    # has equal hashes the names are compared to rule out collisions. A name that occurs more than once maps to the
+    # page that is not a redirect, and then to the lowest page id, so the result never depends on the order of the
+    # table.
+
+    arrays = ['hashes', 'ids', 'rows', 'keys', 'key_offsets']
+    suffix = '_entity_id_index'
+    description = 'entity id index'
+
+    def __init__(self, hashes, ids, rows, keys, key_offsets):
+        self.hashes = hashes
+        self.ids = ids
+        self.rows = rows
+        self.keys = keys
+        self.key_offsets = key_offsets
+
+    @classmethod
+    def build(cls, entity_maps):
+        hashes, ids, redirects, keys, key_lengths = [], [], [], [], []
+        parquet_file = pq.ParquetFile(entity_maps)
+        columns = ['entity', 'id'] + (['redirect'] if 'redirect' in parquet_file.schema_arrow.names else [])
+        for batch in parquet_file.iter_batches(columns=columns):
+            names = batch.column('entity').to_pylist()
+            encoded = [name.encode('utf-8') for name in names]
+            hashes.append(np.fromiter((name_hash(name) for name in names), dtype=np.uint64, count=len(names)))
+            ids.append(batch.column('id').cast(pa.int64()).to_numpy(zero_copy_only=False))
+            if 'redirect' in columns:
+                redirects.append(batch.column('redirect').fill_null(False).to_numpy(zero_copy_only=False))
+            else:
+                redirects.append(np.zeros(len(encoded), dtype=bool))
+            keys.append(b''.join(encoded))
+            key_lengths.append(np.fromiter((len(name) for name in encoded), dtype=np.int64, count=len(encoded)))
+        hashes = np.concatenate(hashes) if hashes else np.zeros(0, dtype=np.uint64)
+        ids = np.concatenate(ids) if ids else np.zeros(0, dtype=np.int64)
+        redirects = np.concatenate(redirects) if redirects else np.zeros(0, dtype=bool)
+        keys = np.frombuffer(b''.join(keys), dtype=np.uint8)
+        key_offsets = np.zeros(len(hashes) + 1, dtype=np.int64)
+        np.cumsum(np.concatenate(key_lengths) if key_lengths else [], out=key_offsets[1:])
+        # Equal names have equal hashes, after sorting the preferred page of a name comes first
+        order = np.lexsort((ids, redirects, hashes))
+        index = cls(hashes[order], ids[order], order.astype(np.int64), keys, key_offsets)
+        keep = np.ones(len(order), dtype=bool)
+        group_hash, group_names = None, set()
+        for i in (np.flatnonzero(index.hashes[1:] == index.hashes[:-1]) + 1).tolist():
+            # Only the first position of a name is kept, different names with the same hash are all kept
+            if index.hashes[i] != group_hash:
+                group_hash, group_names = index.hashes[i], {index.key(i - 1)}
+            name = index.key(i)
+            keep[i] = name not in group_names
+            group_names.add(name)
+        return cls(index.hashes[keep], index.ids[keep], index.rows[keep], keys, key_offsets)
+
+    @classmethod
+    def load_or_build(cls, entity_maps, index_dir=None):
+        return cls.load_or_build_index(entity_maps, index_dir or cls.index_dir(entity_maps), file_state(entity_maps),
+                                       lambda: cls.build(entity_maps))
+
+    @classmethod
+    def load(cls, entity_maps, index_dir):
+        return cls.load_index(entity_maps, index_dir, file_state(entity_maps))
+
+    def info(self):
+        return {'entities': len(self)}
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def __getitem__(self, name):
+        page_id = int(self.lookup([name])[0])
+        if page_id < 0:
+            raise KeyError(name)
+        return page_id
+
+    def key(self, position):
+        row = self.rows[position]
+        return self.keys[self.key_offsets[row]:self.key_offsets[row + 1]].tobytes().decode('utf-8')
+
+    def lookup(self, names):
+        # Page id of every name, -1 for names that are not in the index
+        hashes = np.fromiter((name_hash(name) for name in names), dtype=np.uint64, count=len(names))
+        positions = hash_positions(self.hashes, hashes, names, self.key)
+        result = np.full(len(names), -1, dtype=np.int64)
+        found = positions >= 0
+        result[found] = self.ids[positions[found]]
+        return result
+
+    def resolve(self, entities):
+        # Entity text and page id (null if unknown) for a whole arrow column of entities as written by ED. Only the
+        # distinct entities of the column are normalized and looked up.
+        if isinstance(entities, pa.ChunkedArray):
+            resolved = [self.resolve(chunk) for chunk in entities.chunks]
+            return pa.chunked_array([texts for texts, _ in resolved], type=pa.string()), \
+                pa.chunked_array([ids for _, ids in resolved], type=pa.int64())
+        if not pa.types.is_dictionary(entities.type):
+            entities = entities.cast(pa.string()).dictionary_encode()
+        texts = [entity_text(entity) for entity in entities.dictionary.to_pylist()]
+        ids = self.lookup(texts)
+        return pc.take(pa.array(texts, type=pa.string()), entities.indices), \
+            pc.take(pa.array(ids, mask=ids < 0, type=pa.int64()), entities.indices)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-em',
+        '--entity_maps',
+        required=True,
+        help='Name of the parquet file containing the entities and identifiers (and optionally a boolean redirect '
+             'column)'
+    )
+    args = parser.parse_args()
+    index = EntityIdIndex.load_or_build(args.entity_maps)
+    print(f'Entity id index of {args.entity_maps} has {len(index)} entities', flush=True)
@@ -1,7 +1,7 @@
 import argparse
-import gzip
+import os
 
-from ..utils import input_stream_gen_lines
+from .input_stream_generator import input_stream_gen_lines, open_random_access
 
 
 class ErrorFileToDocuments:
@@ -15,38 +15,35 @@ class ErrorFileToDocuments:
         self.in_file_gen = input_stream_gen_lines(self.arguments['in_file'])
 
     def process(self):
+        # Documents are written as soon as they are read, gzip files are read through a GzipIndex that is built once
+        # per source file, so every document costs at most one checkpoint span of decompression
         current_file_id = '-1'
         current_source_file = None
-        output = ''
-        current_offset = 0
-        for filename in self.in_file_gen:
-            _, __, file_id, offset = filename.strip().split('_')  # Strip the newline
-            print(file_id + " " + offset)
-            offset = int(offset)
-            if file_id != current_file_id:
-                current_offset = 0
-                current_file_id = file_id
-                try:
-                    current_source_file = gzip.open(self.source_folder + f'msmarco_doc_{current_file_id}.gz', 'rb')
-                    current_source_file.seek(offset - current_offset, 1)
-                except (gzip.BadGzipFile, FileNotFoundError):
-                    current_source_file = open(self.source_folder + f'msmarco_doc_{current_file_id}.txt', 'rb')
-                    current_source_file.seek(offset - current_offset, 1)
-            else:
-                current_source_file.seek(offset - current_offset, 1)
-            current_offset = offset
-            line = current_source_file.readline()
-            current_offset += len(line)
-            output += line.decode()
         with open(self.out_file, 'wt') as out:
-            out.write(output)
+            for filename in self.in_file_gen:
+                _, __, file_id, offset = filename.strip().split('_')  # Strip the newline
+                print(file_id + " " + offset)
+                offset = int(offset)
+                if file_id != current_file_id:
+                    current_file_id = file_id
+                    if current_source_file is not None:
+                        current_source_file.close()
+                    source_file = self.source_folder + f'msmarco_doc_{current_file_id}.gz'
+                    if not os.path.isfile(source_file):
+                        source_file = self.source_folder + f'msmarco_doc_{current_file_id}.txt'
+                    current_source_file = open_random_access(source_file, int(self.arguments['checkpoint_span']))
+                current_source_file.seek(offset)
+                out.write(current_source_file.readline().decode())
+        if current_source_file is not None:
+            current_source_file.close()
 
     @staticmethod
     def get_arguments(kwargs):
         arguments = {
             'in_file': None,
             'out_file': None,
-            'source_files_folder': None
+            'source_files_folder': None,
+            'checkpoint_span': '1048576'
         }
         for key, item in arguments.items():
             if kwargs.get(key) is not None:
@@ -77,5 +74,11 @@ if __name__ == '__main__':
         '--out_file',
         help='Output file name'
     )
+    parser.add_argument(
+        '-cs',
+        '--checkpoint_span',
+        help='Number of decompressed bytes between the checkpoints of the gzip index of a source file',
+        default='1048576'
+    )
     ef_t_d = ErrorFileToDocuments(**vars(parser.parse_args()))
     ef_t_d.process()
@@ -0,0 +1,314 @@
+import argparse
+import ctypes
+import ctypes.util
+import zlib
+
+import numpy as np
+
+from .sidecar_index import SidecarIndex, file_state
+
+_WINDOW = 32768  # Largest distance a deflate match can look back
+_CHUNK = 1 << 16
+
+_Z_STREAM_END, _Z_NEED_DICT = 1, 2
+_Z_NO_FLUSH, _Z_BLOCK = 0, 5
+_GZIP, _RAW = 31, -15  # Window bits for a gzip stream with header, and for raw deflate data
+
+_LIBZ = []
+
+
+class _ZStream(ctypes.Structure):
+    _fields_ = [
+        ('next_in', ctypes.c_void_p),
+        ('avail_in', ctypes.c_uint),
+        ('total_in', ctypes.c_ulong),
+        ('next_out', ctypes.c_void_p),
+        ('avail_out', ctypes.c_uint),
+        ('total_out', ctypes.c_ulong),
+        ('msg', ctypes.c_char_p),
+        ('state', ctypes.c_void_p),
+        ('zalloc', ctypes.c_void_p),
+        ('zfree', ctypes.c_void_p),
+        ('opaque', ctypes.c_void_p),
+        ('data_type', ctypes.c_int),
+        ('adler', ctypes.c_ulong),
+        ('reserved', ctypes.c_ulong)
+    ]
+
+
+def _libz():
+    # The zlib module of Python can not stop at deflate block boundaries or start in the middle of a byte, so the
+    # system zlib is used directly, as in zran.c of the zlib examples
+    if not _LIBZ:
+        name = ctypes.util.find_library('z') or ctypes.util.find_library('zlib')
+        if name is None:
+            raise IOError('Random access to gzip files needs the zlib shared library')
+        lib = ctypes.CDLL(name)
+        stream = ctypes.POINTER(_ZStream)
+        lib.zlibVersion.restype = ctypes.c_char_p
+        lib.inflateInit2_.argtypes = [stream, ctypes.c_int, ctypes.c_char_p, ctypes.c_int]
+        lib.inflateReset2.argtypes = [stream, ctypes.c_int]
+        lib.inflate.argtypes = [stream, ctypes.c_int]
+        lib.inflatePrime.argtypes = [stream, ctypes.c_int, ctypes.c_int]
+        lib.inflateSetDictionary.argtypes = [stream, ctypes.c_char_p, ctypes.c_uint]
+        lib.inflateEnd.argtypes = [stream]
+        _LIBZ.append(lib)
+    return _LIBZ[0]
+
+
+def libz_available():
+    try:
+        _libz()
+    except (IOError, AttributeError):
+        return False
+    return True
+
+
+class _Inflater:
+
+    def __init__(self, wbits):
+        self.lib = _libz()
+        self.stream = _ZStream()
+        self.wbits = wbits
+        self.check(self.lib.inflateInit2_(ctypes.byref(self.stream), wbits, self.lib.zlibVersion(),
+                                          ctypes.sizeof(_ZStream)))
+
+    def check(self, ret):
+        if ret < 0 or ret == _Z_NEED_DICT:
+            message = self.stream.msg.decode('utf-8') if self.stream.msg else f'zlib error {ret}'
+            raise IOError(f'Corrupt gzip data: {message}')
+        return ret
+
+    def reset(self, wbits):
+        self.wbits = wbits
+        self.check(self.lib.inflateReset2(ctypes.byref(self.stream), wbits))
+
+    def prime(self, bits, value):
+        self.check(self.lib.inflatePrime(ctypes.byref(self.stream), bits, value))
+
+    def set_dictionary(self, window):
+        self.check(self.lib.inflateSetDictionary(ctypes.byref(self.stream), window, len(window)))
+
+    def inflate(self, flush):
+        return self.check(self.lib.inflate(ctypes.byref(self.stream), flush))
+
+    def close(self):
+        self.lib.inflateEnd(ctypes.byref(self.stream))
+
+
+class GzipIndex(SidecarIndex):
+    # Checkpoints of a gzip file (zran): about every span decompressed bytes, at the start of a deflate block, the
+    # decompressed offset, the compressed offset, the number of bits of the previous byte that belong to the block and
+    # the last 32 KiB of decompressed data (zlib compressed). Decompression can start at any checkpoint, so reading a
+    # line at a known offset costs at most one span of decompression. Built with one pass over the file. Files of
+    # several gzip members are supported.
+
+    arrays = ['points', 'windows', 'window_offsets']
+    suffix = '_gzip_index'
+    description = 'gzip index'
+
+    def __init__(self, points, windows, window_offsets, uncompressed_size):
+        self.points = points
+        self.windows = windows
+        self.window_offsets = window_offsets
+        self.uncompressed_size = uncompressed_size
+
+    @classmethod
+    def build(cls, source_file, span=1 << 20):
+        span = int(span)
+        points, windows = [], []
+        inflater = _Inflater(_GZIP)
+        stream = inflater.stream
+        input_buffer = ctypes.create_string_buffer(_CHUNK)
+        window = ctypes.create_string_buffer(_WINDOW)
+        total_in, total_out, last, finished = 0, 0, 0, False
+        try:
+            with open(source_file, 'rb') as f:
+                while True:
+                    read = f.readinto(input_buffer)
+                    if read == 0:
+                        if not finished:
+                            raise IOError(f'{source_file} is truncated')
+                        break
+                    stream.next_in, stream.avail_in = ctypes.addressof(input_buffer), read
+                    while stream.avail_in:
+                        if stream.avail_out == 0:  # The output wraps around the window buffer
+                            stream.next_out, stream.avail_out = ctypes.addressof(window), _WINDOW
+                        total_in += stream.avail_in
+                        total_out += stream.avail_out
+                        ret = inflater.inflate(_Z_BLOCK)  # Returns at the end of every deflate block
+                        total_in -= stream.avail_in
+                        total_out -= stream.avail_out
+                        if ret == _Z_STREAM_END:  # The next gzip member (if any) starts after this one
+                            inflater.reset(_GZIP)
+                            finished = True
+                            continue
+                        finished = False
+                        if stream.data_type & 128 and not stream.data_type & 64 and \
+                                (total_out == 0 or total_out - last > span):
+                            left = stream.avail_out
+                            data = window.raw[_WINDOW - left:] + window.raw[:_WINDOW - left]
+                            points.append((total_out, total_in, stream.data_type & 7))
+                            windows.append(zlib.compress(data[_WINDOW - min(total_out, _WINDOW):]))
+                            last = total_out
+        finally:
+            inflater.close()
+        window_offsets = np.zeros(len(windows) + 1, dtype=np.int64)
+        np.cumsum([len(w) for w in windows], out=window_offsets[1:])
+        return cls(np.array(points, dtype=np.int64).reshape(-1, 3),
+                   np.frombuffer(b''.join(windows), dtype=np.uint8), window_offsets, total_out)
+
+    @classmethod
+    def load_or_build(cls, source_file, span=1 << 20, index_dir=None):
+        # An existing index is reused whatever its span
+        return cls.load_or_build_index(source_file, index_dir or cls.index_dir(source_file), file_state(source_file),
+                                       lambda: cls.build(source_file, span))
+
+    @classmethod
+    def load(cls, source_file, index_dir):
+        return cls.load_index(source_file, index_dir, file_state(source_file))
+
+    @classmethod
+    def from_arrays(cls, arrays, meta, source_file):
+        return cls(*arrays, meta['uncompressed_size'])
+
+    def info(self):
+        return {'checkpoints': len(self), 'uncompressed_size': self.uncompressed_size}
+
+    def __len__(self):
+        return len(self.points)
+
+    def checkpoint(self, offset):
+        # Last checkpoint at or before the decompressed offset
+        return max(int(np.searchsorted(self.points[:, 0], offset, side='right')) - 1, 0)
+
+    def window(self, checkpoint):
+        return zlib.decompress(self.windows[self.window_offsets[checkpoint]:self.window_offsets[checkpoint + 1]]
+                               .tobytes())
+
+
+class IndexedGzipReader:
+    # Binary handle with seek and readline on a gzip file, through its GzipIndex. A seek decompresses from the closest
+    # checkpoint, or continues the current stream when that is closer, so offsets in increasing order are read in one
+    # pass and any other order costs at most one span of decompression per seek.
+
+    def __init__(self, source_file, span=1 << 20, index_dir=None):
+        self.source_file = source_file
+        self.index = GzipIndex.load_or_build(source_file, span, index_dir)
+        self.file = open(source_file, 'rb')
+        self.inflater = None
+        self.input = ctypes.create_string_buffer(_CHUNK)
+        self.output = ctypes.create_string_buffer(_CHUNK)
+        self.position = 0  # Decompressed offset of buffer[cursor]
+        self.buffer, self.cursor = b'', 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def start(self, checkpoint):
+        out, start, bits = (int(value) for value in self.index.points[checkpoint])
+        if self.inflater is None:
+            self.inflater = _Inflater(_RAW)
+        else:
+            self.inflater.reset(_RAW)
+        self.inflater.stream.avail_in = 0
+        self.file.seek(start - (1 if bits else 0))
+        if bits:  # The block starts in the middle of this byte
+            self.inflater.prime(bits, self.file.read(1)[0] >> (8 - bits))
+        window = self.index.window(checkpoint)
+        if window:
+            self.inflater.set_dictionary(window)
+        self.position, self.buffer, self.cursor = out, b'', 0
+
+    def decompress(self):
+        # Next piece of decompressed data, b'' at the end of the file
+        stream = self.inflater.stream
+        while True:
+            if stream.avail_in == 0:
+                read = self.file.readinto(self.input)
+                if read == 0:
+                    return b''
+                stream.next_in, stream.avail_in = ctypes.addressof(self.input), read
+            stream.next_out, stream.avail_out = ctypes.addressof(self.output), _CHUNK
+            ret = self.inflater.inflate(_Z_NO_FLUSH)
+            produced = _CHUNK - stream.avail_out
+            if ret == _Z_STREAM_END:
+                if self.inflater.wbits == _RAW:  # Skip the 8 byte gzip trailer, later members are read with header
+                    self.file.seek(self.file.tell() - stream.avail_in + 8)
+                    stream.avail_in = 0
+                self.inflater.reset(_GZIP)
+            if produced:
+                return ctypes.string_at(ctypes.addressof(self.output), produced)
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+    def seek(self, offset):
+        checkpoint = self.index.checkpoint(offset)
+        if self.inflater is None or not self.position <= offset or \
+                int(self.index.points[checkpoint][0]) > self.position + len(self.buffer) - self.cursor:
+            self.start(checkpoint)
+        while self.position + len(self.buffer) - self.cursor < offset:
+            self.position += len(self.buffer) - self.cursor
+            self.buffer, self.cursor = self.decompress(), 0
+            if not self.buffer:
+                break
+        if self.buffer:
+            self.cursor += offset - self.position
+        self.position = offset
+        return offset
+
+    def readline(self):
+        if self.inflater is None:
+            self.seek(0)
+        parts = []
+        while True:
+            end = self.buffer.find(b'\n', self.cursor)
+            if end >= 0:
+                parts.append(self.buffer[self.cursor:end + 1])
+                self.position += end + 1 - self.cursor
+                self.cursor = end + 1
+                break
+            parts.append(self.buffer[self.cursor:])
+            self.position += len(self.buffer) - self.cursor
+            self.buffer, self.cursor = self.decompress(), 0
+            if not self.buffer:
+                break
+        return b''.join(parts)
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        if self.inflater is not None:
+            self.inflater.close()
+            self.inflater = None
+        self.file.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-s',
+        '--source_files',
+        nargs='+',
+        required=True,
+        help='Names of the gzip files to build an index for'
+    )
+    parser.add_argument(
+        '-cs',
+        '--checkpoint_span',
+        help='Number of decompressed bytes between checkpoints',
+        default='1048576'
+    )
+    args = parser.parse_args()
+    for source_file in args.source_files:
+        index = GzipIndex.load_or_build(source_file, int(args.checkpoint_span))
+        print(f'Gzip index of {source_file} has {len(index)} checkpoints', flush=True)
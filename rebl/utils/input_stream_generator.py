@@ -1,21 +1,84 @@
 import gzip
+import os
+from array import array
+from bisect import bisect_left
+
 import pyarrow.parquet as pq
 
+from .gzip_index import IndexedGzipReader, libz_available
+
+_GZIP_MAGIC = b'\x1f\x8b'
+
+
+def is_gzipped(filename):
+    with open(filename, 'rb') as f:
+        return f.read(2) == _GZIP_MAGIC
+
+
+def open_input_stream(filename):
+    # Returns a binary handle, so positions are byte offsets into the (decompressed) data
+    if is_gzipped(filename):
+        return gzip.open(filename, 'rb')
+    return open(filename, 'rb')
+
+
+def open_random_access(filename, span=1 << 20, index_dir=None):
+    # Binary handle with cheap seeks, through a GzipIndex (built once and kept in index_dir, by default next to the
+    # file) for gzip files.
+    # Without the zlib shared library gzip files fall back to the gzip module, which decompresses from the start for
+    # every backward seek.
+    if is_gzipped(filename) and libz_available():
+        return IndexedGzipReader(filename, span, index_dir)
+    return open_input_stream(filename)
+
+
+def input_stream_gen_offsets(filename, skip_to=0, start_line=0, stop_at=None, index_dir=None):
+    # Yields (line number, byte offset, line) lazily, skip_to is the byte offset of the first line to read and reading
+    # stops at the first line that starts at or after stop_at.
+    # For plain files the seek is O(1), gzipped files are read from the checkpoint of their GzipIndex before skip_to.
+    with open_random_access(filename, index_dir=index_dir) if skip_to else open_input_stream(filename) as f:
+        f.seek(skip_to)
+        offset = skip_to
+        for line_number, line in enumerate(f, start_line):
+            if stop_at is not None and offset >= stop_at:
+                return
+            length = len(line)
+            if line.endswith(b'\r\n'):  # Same newline translation as reading in text mode
+                line = line[:-2] + b'\n'
+            yield line_number, offset, line.decode('utf-8')
+            offset += length
+
 
 def input_stream_gen_lines(filename, skip_to=0):
-    try:
-        # Try read first line as gzipped file
-        f = gzip.open(filename, 'rt', encoding='utf-8')
-        f.seek(1)  # To confirm the data is gzipped
-        f.seek(0)  # Resets to zero, because the default seek behaviour is to start from start of file
-    except Exception:
-        # If input is not gzipped, fallback to normal file I/O
-        f = open(filename, 'rt', encoding='utf-8')
-    # Generate rest of the input
-    f.seek(skip_to)
-    return (line for line in f.readlines())
-    # for line in f:
-    #     yield line
+    for _, __, line in input_stream_gen_offsets(filename, skip_to=skip_to):
+        yield line
+
+
+def line_aligned_shards(filename, shards, index_dir=None):
+    # Splits the (decompressed) input in up to `shards` byte ranges of similar size that start at the beginning of a
+    # line. Returns (start, end) offsets, end is None for the last range. For gzip files the GzipIndex gives the
+    # decompressed size and the line starts near the boundaries, and lets the shards start reading there.
+    with open_random_access(filename, index_dir=index_dir) as f:
+        if isinstance(f, gzip.GzipFile):  # The decompressed size is unknown, so collect where every line starts
+            line_starts, size = array('q'), 0
+            for line in f:
+                line_starts.append(size)
+                size += len(line)
+            boundaries = []
+            for i in range(1, shards):
+                index = bisect_left(line_starts, size * i // shards)
+                boundaries.append(line_starts[index] if index < len(line_starts) else size)
+        else:
+            size = f.index.uncompressed_size if isinstance(f, IndexedGzipReader) else os.fstat(f.fileno()).st_size
+            boundaries = []
+            for i in range(1, shards):
+                f.seek(max(size * i // shards - 1, 0))
+                f.readline()  # Move to the start of the next line
+                boundaries.append(f.tell())
+    boundaries = sorted(set(b for b in boundaries if 0 < b < size))
+    starts = [0] + boundaries
+    ends = boundaries + [None]
+    return list(zip(starts, ends))
 
 
 def stream_parquet_file_per_entry(filename):
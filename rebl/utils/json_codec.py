@@ -0,0 +1,102 @@
+import importlib.util
+import json
+import os
+import re
+import threading
+
+BACKENDS = ['orjson', 'simdjson', 'json']
+
+_COLON = re.compile(r'\s*:\s*')
+_STRUCTURE = re.compile(r'["{}\[\]]')
+_DECODER = json.JSONDecoder()
+
+
+def available_backends():
+    # The fastest installed backend comes first, the standard library is always available
+    return [backend for backend in BACKENDS if backend == 'json' or importlib.util.find_spec(backend) is not None]
+
+
+def _escaped(line, position):
+    # A quote that is preceded by an odd number of backslashes is part of a string
+    backslashes = 0
+    while position - backslashes > 0 and line[position - backslashes - 1] == '\\':
+        backslashes += 1
+    return backslashes % 2 == 1
+
+
+def _depth(line, position):
+    # Number of objects and arrays that are open at position, strings are skipped from quote to closing quote
+    depth, cursor = 0, 0
+    while True:
+        match = _STRUCTURE.search(line, cursor, position)
+        if match is None:
+            return depth
+        cursor = match.end()
+        if match.group() == '"':
+            cursor = line.find('"', cursor)
+            while cursor >= 0 and _escaped(line, cursor):
+                cursor = line.find('"', cursor + 1)
+            if cursor < 0 or cursor >= position:  # Not valid JSON up to position
+                return -1
+            cursor += 1
+        elif match.group() in '{[':
+            depth += 1
+        else:
+            depth -= 1
+
+
+class JsonCodec:
+    # JSON decoding and encoding for the JSONL readers and writers, with orjson or simdjson when installed. The
+    # backend is chosen with the REBL_JSON_BACKEND environment variable, by default the fastest installed one is used.
+
+    def __init__(self, backend=None):
+        self.backend = backend or os.environ.get('REBL_JSON_BACKEND') or available_backends()[0]
+        if self.backend not in available_backends():
+            raise IOError(f'JSON backend {self.backend} is not installed, available are '
+                          f'{", ".join(available_backends())}')
+        self.module = importlib.import_module(self.backend)
+        self.local = threading.local()
+
+    def parser(self):
+        # A simdjson parser reuses its buffers and can not be shared between threads
+        if not hasattr(self.local, 'parser'):
+            self.local.parser = self.module.Parser()
+        return self.local.parser
+
+    def loads(self, line):
+        if self.backend == 'orjson':
+            try:
+                return self.module.loads(line)
+            except self.module.JSONDecodeError:  # e.g. escaped lone surrogates, which the standard library accepts
+                return json.loads(line)
+        return self.module.loads(line)
+
+    def dumps(self, value, compact=False):
+        # The same text as json.dumps for every backend. Compact JSON with non ascii characters as UTF-8 is faster
+        # with orjson, but numbers may be written differently than by the standard library, e.g. 0.00001 for 1e-05.
+        if not compact:
+            return json.dumps(value)
+        if self.backend == 'orjson':
+            return self.module.dumps(value).decode('utf-8')
+        return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+
+    def identifier(self, line, key):
+        # Value of a top level key without decoding the rest of the line, e.g. the large body of a document. When the
+        # key is not found, the whole line is decoded.
+        if self.backend == 'simdjson':
+            value = self.parser().parse(line.encode('utf-8'))[key]  # Parsed lazily, only the key is materialized
+            return value if isinstance(value, (str, int, float, bool)) or value is None else self.loads(line)[key]
+        # The fast path only takes a key that occurs once and unescaped, so it is not inside a string, and that is in
+        # the outer object. With only the opening bracket of the outer object before the key, no strings are scanned.
+        quoted = '"' + key + '"'
+        start = line.find(quoted)
+        if start >= 0 and '"' not in key and '\\' not in key and line.find(quoted, start + 1) < 0 \
+                and not _escaped(line, start) \
+                and (line.count('{', 0, start) == 1 and line.find('[', 0, start) < 0 or _depth(line, start) == 1):
+            colon = _COLON.match(line, start + len(quoted))
+            if colon is not None:
+                return _DECODER.raw_decode(line, colon.end())[0]
+        return self.loads(line)[key]
+
+
+codec = JsonCodec()
@@ -0,0 +1,128 @@
+import json
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+import numpy as np
+
+
+def file_state(file_name):
+    stat = os.stat(file_name)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def read_meta(index_dir, state):
+    # Meta data of the index in index_dir, None when there is no index or when it was built for another state of its
+    # source (e.g. another version of the source file)
+    try:
+        with open(os.path.join(index_dir, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if any(meta.get(key) != value for key, value in state.items()):
+        return None
+    return meta
+
+
+def load_arrays(index_dir, names):
+    return [np.load(os.path.join(index_dir, name + '.npy'), mmap_mode='r') for name in names]
+
+
+def hash_positions(sorted_hashes, hashes, keys, key):
+    # Position of every key in the sorted hash array of an index, -1 for keys that are not in it. key(position) gives
+    # the key stored at a position. A hash that occurs once in the index is taken as is, only for hashes that occur
+    # more than once the keys are compared.
+    result = np.full(len(hashes), -1, dtype=np.int64)
+    if len(sorted_hashes) == 0:
+        return result
+    positions = np.searchsorted(sorted_hashes, hashes)
+    clipped = np.minimum(positions, len(sorted_hashes) - 1)
+    matched = (positions < len(sorted_hashes)) & (sorted_hashes[clipped] == hashes)
+    # A slot is ambiguous when the next stored hash is equal too
+    following = np.minimum(clipped + 1, len(sorted_hashes) - 1)
+    ambiguous = matched & (following != clipped) & (sorted_hashes[following] == hashes)
+    unique = matched & ~ambiguous
+    result[unique] = clipped[unique]
+    for i in np.flatnonzero(ambiguous).tolist():
+        # Equal hashes are adjacent, the key itself is compared to rule out collisions
+        position = int(positions[i])
+        while position < len(sorted_hashes) and sorted_hashes[position] == hashes[i]:
+            if key(position) == keys[i]:
+                result[i] = position
+                break
+            position += 1
+    return result
+
+
+@contextmanager
+def building_dir(index_dir, state, **info):
+    # Yields a temporary directory of its own next to index_dir to write the arrays to, which is moved in place with a
+    # meta.json of state and info when the block ends without an error. Readers never see a half written index and
+    # concurrent builders (e.g. the workers of a run) do not write into each other's files. When another builder
+    # already put an index of the same state in place, that one is kept.
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(index_dir)),
+                               prefix=os.path.basename(index_dir) + '.tmp')
+    try:
+        yield tmp_dir
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+            json.dump(dict(info, **state), f)
+        if os.path.isdir(index_dir):
+            if read_meta(index_dir, state) is not None:
+                return
+            shutil.rmtree(index_dir, ignore_errors=True)
+        os.replace(tmp_dir, index_dir)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+class SidecarIndex:
+    # An index that is built once for a file (its source) and kept as .npy files in a sidecar directory, which are
+    # memory mapped instead of read. The index is rebuilt when the state of the source (size, modification time and
+    # the parameters the index depends on) differs from the one it was built for.
+
+    arrays = []
+    suffix = '_index'
+    description = 'index'
+
+    @classmethod
+    def index_dir(cls, source_file):
+        return source_file + cls.suffix
+
+    @classmethod
+    def from_arrays(cls, arrays, meta, source_file):
+        return cls(*arrays)
+
+    def info(self):
+        # Additional meta data, e.g. values that from_arrays needs
+        return {}
+
+    @classmethod
+    def load_index(cls, source_file, index_dir, state):
+        meta = read_meta(index_dir, state)
+        if meta is None:
+            return None
+        return cls.from_arrays(load_arrays(index_dir, cls.arrays), meta, source_file)
+
+    @classmethod
+    def load_or_build_index(cls, source_file, index_dir, state, build):
+        # When the index directory can not be written (e.g. a read only source folder, an index_dir elsewhere can be
+        # given) the index that build() returns is only kept in memory
+        index = cls.load_index(source_file, index_dir, state)
+        if index is not None:
+            return index
+        print(f'Building {cls.description} {index_dir}', flush=True)
+        index = build()
+        try:
+            index.save(index_dir, state)
+        except OSError as error:
+            print(f'{cls.description.capitalize()} {index_dir} can not be saved ({error}), it is kept in memory',
+                  flush=True)
+            return index
+        saved = cls.load_index(source_file, index_dir, state)
+        return index if saved is None else saved
+
+    def save(self, index_dir, state):
+        with building_dir(index_dir, state, **self.info()) as tmp_dir:
+            for name in self.arrays:
+                np.save(os.path.join(tmp_dir, name + '.npy'), getattr(self, name))